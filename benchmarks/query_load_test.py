@@ -0,0 +1,169 @@
+'''
+	Load test the percentile query service (lib/query_service.py).
+
+	usage:
+		python -m benchmarks.query_load_test [--day-dir DIR] [--nx 1500] [--ny 1300] [--reaches 341437]
+			[--queries 20000] [--clients 8] [--batch-size 100] [--no-http]
+
+	Without --day-dir, percentile artifacts the size of the full Northeast domain are generated with random values.
+	Each query type is first timed in-process against the index, then over HTTP from --clients concurrent
+	keep-alive connections to a local server. Latency percentiles (p50, p99) and queries per second are
+	reported, and results are saved as JSON in benchmarks/results.
+'''
+import os
+import sys
+import json
+import time
+import argparse
+import datetime
+import threading
+import http.client
+
+import numpy as np
+
+from lib.percentile_artifacts import write_soil_m_percentiles, write_streamflow_percentiles, write_reach_order
+from lib.query_service import PercentileIndex, make_server
+from .synthetic_data import make_bench_config, grid_coordinates, NWM_PROJ4
+from .run_benchmarks import RESULTS_DIR, BENCH_DATE, git_commit
+
+def write_synthetic_artifacts(bench_config, nx, ny, nreaches, seed=0):
+	rng = np.random.default_rng(seed)
+	day_dir = os.path.join(bench_config.output_dir, f'{BENCH_DATE}_method1')
+	if not os.path.exists(day_dir): os.makedirs(day_dir)
+	x, y = grid_coordinates(bench_config.ll_lon, bench_config.ll_lat, bench_config.ur_lon, bench_config.ur_lat, nx, ny)
+	meta = {'x': x, 'y': y, 'proj4': NWM_PROJ4}
+	products = {p['varname']: p for p in bench_config.products}
+	for per in products['SOIL_M']['summary_lengths']:
+		write_soil_m_percentiles(day_dir, BENCH_DATE, per, rng.uniform(0., 1., size=(ny, 4, nx)), meta)
+	reach_ids = np.sort(rng.choice(np.arange(1000, 1000 + nreaches * 20), size=nreaches, replace=False)).astype('int64')
+	write_reach_order(day_dir, reach_ids)
+	for per in products['streamflow']['summary_lengths']:
+		write_streamflow_percentiles(day_dir, BENCH_DATE, per, rng.uniform(0., 1., size=nreaches), reach_ids, reach_ids)
+	return day_dir
+
+# Random queries of each type within the domain. 1 in 20 reach queries is for a COMID that does not exist.
+def make_queries(index, bbox, nqueries, batch_size, seed=1):
+	rng = np.random.default_rng(seed)
+	lons = rng.uniform(bbox[0], bbox[2], size=nqueries)
+	lats = rng.uniform(bbox[1], bbox[3], size=nqueries)
+	comids = np.array(list(index.reach_columns.keys()))[rng.integers(0, len(index.reach_columns), size=nqueries)]
+	comids[rng.random(nqueries) < 0.05] = -1
+	boxes = []
+	for lon, lat, size in zip(lons, lats, rng.uniform(0.05, 0.5, size=nqueries)):
+		boxes.append((lon, lat, min(lon + size, bbox[2]), min(lat + size, bbox[3])))
+	return {
+		'point': [(float(lon), float(lat)) for lon, lat in zip(lons, lats)],
+		'reach': [int(c) for c in comids],
+		'bbox': [tuple(float(v) for v in box) for box in boxes],
+		'batch': [{'points': [[float(lons[j]), float(lats[j])] for j in range(i, i + batch_size)], 'reaches': [int(c) for c in comids[i:i + batch_size]]}
+			for i in range(0, nqueries - batch_size + 1, batch_size)]
+	}
+
+def summarize(latencies, elapsed):
+	latencies = np.array(latencies)
+	return {
+		'queries': len(latencies),
+		'p50_us': float(np.percentile(latencies, 50) * 1e6),
+		'p99_us': float(np.percentile(latencies, 99) * 1e6),
+		'qps': len(latencies) / elapsed
+	}
+
+def run_in_process(index, queries):
+	calls = {
+		'point': lambda q: index.point(*q),
+		'reach': lambda q: index.reach(q),
+		'bbox': lambda q: index.bbox(*q),
+		'batch': lambda q: index.batch(q['points'], q['reaches'])
+	}
+	results = {}
+	for name, call in calls.items():
+		latencies = []
+		start = time.perf_counter()
+		for q in queries[name]:
+			t = time.perf_counter()
+			call(q)
+			latencies.append(time.perf_counter() - t)
+		results[name] = summarize(latencies, time.perf_counter() - start)
+	return results
+
+def http_request(query_type, q):
+	if query_type == 'point': return 'GET', f'/point?lon={q[0]}&lat={q[1]}', None
+	if query_type == 'reach': return 'GET', f'/reach?comid={q}', None
+	if query_type == 'bbox': return 'GET', f'/bbox?west={q[0]}&south={q[1]}&east={q[2]}&north={q[3]}', None
+	return 'POST', '/batch', json.dumps(q)
+
+def run_http(index, queries, nclients):
+	server = make_server(index, port=0)
+	threading.Thread(target=server.serve_forever, daemon=True).start()
+	port = server.server_address[1]
+	results = {}
+	try:
+		for name, type_queries in queries.items():
+			per_client = [type_queries[i::nclients] for i in range(nclients)]
+			latencies = [[] for _ in range(nclients)]
+			def client(idx):
+				conn = http.client.HTTPConnection('127.0.0.1', port)
+				for q in per_client[idx]:
+					method, path, body = http_request(name, q)
+					t = time.perf_counter()
+					conn.request(method, path, body=body, headers={'Content-Type': 'application/json'} if body else {})
+					conn.getresponse().read()
+					latencies[idx].append(time.perf_counter() - t)
+				conn.close()
+			threads = [threading.Thread(target=client, args=(i,)) for i in range(nclients)]
+			start = time.perf_counter()
+			for thread in threads: thread.start()
+			for thread in threads: thread.join()
+			results[name] = summarize([l for client_latencies in latencies for l in client_latencies], time.perf_counter() - start)
+	finally:
+		server.shutdown()
+		server.server_close()
+	return results
+
+def print_results(title, results):
+	print(title)
+	for name, result in results.items():
+		print(f'  {name:8s} p50 {result["p50_us"]:10.1f} us   p99 {result["p99_us"]:10.1f} us   {result["qps"]:10.0f} queries/s')
+
+def main():
+	parser = argparse.ArgumentParser(description='Load test the percentile query service')
+	parser.add_argument('--day-dir', default=None, help='output date directory to query, instead of synthetic artifacts')
+	parser.add_argument('--nx', type=int, default=1500, help='synthetic land grid columns')
+	parser.add_argument('--ny', type=int, default=1300, help='synthetic land grid rows')
+	parser.add_argument('--reaches', type=int, default=341437, help='synthetic stream reaches')
+	parser.add_argument('--queries', type=int, default=20000, help='queries of each type')
+	parser.add_argument('--clients', type=int, default=8, help='concurrent HTTP clients')
+	parser.add_argument('--batch-size', type=int, default=100, help='points and reaches in each batch query')
+	parser.add_argument('--no-http', action='store_true', help='only time queries in-process')
+	parser.add_argument('--data-dir', default='/tmp/nwm_drought_bench', help='where synthetic artifacts are written')
+	args = parser.parse_args()
+
+	bench_config = make_bench_config(args.data_dir)
+	day_dir = args.day_dir or write_synthetic_artifacts(bench_config, args.nx, args.ny, args.reaches)
+	start = time.perf_counter()
+	index = PercentileIndex(day_dir)
+	load_seconds = time.perf_counter() - start
+	print(f'loaded {day_dir} in {load_seconds:.2f} s')
+
+	bbox = [bench_config.ll_lon, bench_config.ll_lat, bench_config.ur_lon, bench_config.ur_lat]
+	queries = make_queries(index, bbox, args.queries, args.batch_size)
+	results = {'load_seconds': load_seconds, 'in_process': run_in_process(index, queries)}
+	print_results('in-process', results['in_process'])
+	if not args.no_http:
+		results['http'] = run_http(index, queries, args.clients)
+		print_results(f'http ({args.clients} clients)', results['http'])
+
+	commit = git_commit()
+	if not os.path.exists(RESULTS_DIR): os.makedirs(RESULTS_DIR)
+	out_path = os.path.join(RESULTS_DIR, f'query_{datetime.datetime.now().strftime("%Y%m%d_%H%M%S")}_{commit}.json')
+	with open(out_path, 'w') as f:
+		json.dump({
+			'commit': commit,
+			'timestamp': datetime.datetime.now().isoformat(),
+			'params': {k: v for k, v in vars(args).items() if k != 'data_dir'},
+			'results': results
+		}, f, indent=2)
+	print('results saved to', out_path)
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,171 @@
+'''
+	Time the pipeline hot paths against synthetic NWM-shaped data. No network access or real NWM data is needed.
+
+	usage:
+		python -m benchmarks.run_benchmarks [--nx 200] [--ny 150] [--reaches 20000] [--years 10] [--regions 2] [--repeat 3]
+		python -m benchmarks.run_benchmarks --compare <old_results.json> <new_results.json>
+
+	Results are saved as JSON in benchmarks/results, named with the time and current git commit,
+	so runs from different commits can be compared with --compare.
+'''
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import datetime
+import subprocess
+import statistics
+
+import numpy as np
+import cartopy.crs as ccrs
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+
+from lib.utils import subset_soil_m_data, build_map_palette, classify_percentiles
+from lib.prepare import prepare_climatologies, load_prepared_climatology
+from lib.reach_alignment import get_reach_alignment, get_constant_reaches, gather_line_percentiles
+from lib.create_nwm_nedews_products import get_retro_climatology, get_oper_period_average, calc_event_percentiles, group_flowlines_by_color, take_snapshots, load_basemap
+from .synthetic_data import make_bench_config, generate
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+BENCH_DATE = '20200815'
+
+def time_call(fn, repeat):
+	runs = []
+	for _ in range(repeat):
+		start = time.perf_counter()
+		fn()
+		runs.append(time.perf_counter() - start)
+	return {'min': min(runs), 'median': statistics.median(runs), 'runs': runs}
+
+def git_commit():
+	try:
+		return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+	except (subprocess.CalledProcessError, FileNotFoundError):
+		return 'unknown'
+
+def bench_subset_soil_m(bench_config, repeat):
+	if shutil.which('ncks') is None: return None
+	in_file = f'{BENCH_DATE}1200.LDASOUT_DOMAIN1'
+	return time_call(lambda: subset_soil_m_data(
+		in_file, bench_config.temp_dir, f'SUBSET_{in_file}', bench_config.temp_dir,
+		bench_config.ll_lon, bench_config.ll_lat, bench_config.ur_lon, bench_config.ur_lat
+	), repeat)
+
+# Same steps as the start of each summary length loop in create_products
+def bench_percentiles(bench_config, syear, product, per, repeat):
+	def run():
+		data_clim = get_retro_climatology(bench_config, BENCH_DATE, syear, product['varname'], product['dstype'], per)
+		data_event, _ = get_oper_period_average(bench_config, BENCH_DATE, product['varname'], per)
+		calc_event_percentiles(data_clim, data_event)
+	return time_call(run, repeat)
+
+# The same steps on the critical path of a daily run whose climatology was prepared the day before (see lib/prepare.py)
+def bench_prepared_percentiles(bench_config, syear, product, per, repeat):
+	prepare_climatologies(bench_config, BENCH_DATE, syear)
+	def run():
+		data_clim = load_prepared_climatology(bench_config, BENCH_DATE, syear, product['varname'], per)
+		data_event, _ = get_oper_period_average(bench_config, BENCH_DATE, product['varname'], per)
+		calc_event_percentiles(data_clim, data_event)
+	return time_call(run, repeat)
+
+# Same steps as the streamflow mapping section of create_products, up to adding shapes to the figure
+def bench_streamflow_coloring(bench_config, syear, product, repeat):
+	data_clim = get_retro_climatology(bench_config, BENCH_DATE, syear, 'streamflow', product['dstype'], 1)
+	data_event, oper_meta = get_oper_period_average(bench_config, BENCH_DATE, 'streamflow', 1)
+	event_percentiles = calc_event_percentiles(data_clim, data_event)
+	basemap = load_basemap(bench_config, 'streamflow')
+	line_rows, line_present = get_reach_alignment(bench_config, basemap['flowline_comids'], oper_meta['feature_ids'])
+	def run():
+		line_valid = line_present & ~get_constant_reaches(data_clim)[line_rows]
+		classes = classify_percentiles(gather_line_percentiles(event_percentiles, line_rows, line_valid), product['clevs_cmap'])
+		group_flowlines_by_color(basemap['flowline_shapes'], classes, product['ccols_cmap'])
+	return time_call(run, repeat)
+
+# Render a soil moisture style figure once, then time saving the regional snapshots
+def bench_take_snapshots(bench_config, nregions, repeat):
+	x = np.linspace(bench_config.ll_lon, bench_config.ur_lon, 200)
+	y = np.linspace(bench_config.ll_lat, bench_config.ur_lat, 150)
+	lon_mesh, lat_mesh = np.meshgrid(x, y)
+	values = np.random.default_rng(0).uniform(0, 100, size=lon_mesh.shape)
+	product = bench_config.products[0]
+	out_dir = os.path.join(bench_config.output_dir, 'bench_snapshots')
+	if not os.path.exists(out_dir): os.makedirs(out_dir)
+	regions = dict(list(bench_config.regions.items())[:nregions])
+	palette = build_map_palette(product['ccols_cmap'])
+
+	fig = plt.figure()
+	fig.subplots_adjust(bottom=0.2)
+	ax = plt.axes(projection=ccrs.PlateCarree())
+	ax.contourf(lon_mesh, lat_mesh, values, product['clevs_cmap'], colors=product['ccols_cmap'], zorder=1)
+	result = time_call(lambda: take_snapshots(ax, product['varname'], 0, 1, out_dir, regions, palette), repeat)
+	plt.close(fig)
+	return result
+
+def run(args):
+	bench_config = make_bench_config(args.data_dir)
+	print('generating synthetic data in', args.data_dir)
+	syear = generate(bench_config, BENCH_DATE, nx=args.nx, ny=args.ny, nreaches=args.reaches, nyears=args.years)
+
+	results = {}
+	results['subset_soil_m_data'] = bench_subset_soil_m(bench_config, args.repeat)
+	for product in bench_config.products:
+		for per in product['summary_lengths']:
+			results[f'percentiles_{product["varname"]}_{per}day'] = bench_percentiles(bench_config, syear, product, per, args.repeat)
+			results[f'prepared_percentiles_{product["varname"]}_{per}day'] = bench_prepared_percentiles(bench_config, syear, product, per, args.repeat)
+	streamflow_product = [p for p in bench_config.products if p['varname']=='streamflow'][0]
+	results['streamflow_coloring'] = bench_streamflow_coloring(bench_config, syear, streamflow_product, args.repeat)
+	results['take_snapshots'] = bench_take_snapshots(bench_config, args.regions, args.repeat)
+
+	for name, result in results.items():
+		if result is None:
+			print(f'{name:40s} skipped')
+		else:
+			print(f'{name:40s} min {result["min"]:8.3f} s   median {result["median"]:8.3f} s')
+
+	commit = git_commit()
+	if not os.path.exists(RESULTS_DIR): os.makedirs(RESULTS_DIR)
+	out_path = os.path.join(RESULTS_DIR, f'{datetime.datetime.now().strftime("%Y%m%d_%H%M%S")}_{commit}.json')
+	with open(out_path, 'w') as f:
+		json.dump({
+			'commit': commit,
+			'timestamp': datetime.datetime.now().isoformat(),
+			'params': {k: v for k, v in vars(args).items() if k not in ['compare', 'data_dir']},
+			'results': results
+		}, f, indent=2)
+	print('results saved to', out_path)
+
+def compare(old_path, new_path):
+	with open(old_path) as f: old = json.load(f)
+	with open(new_path) as f: new = json.load(f)
+	if old['params'] != new['params']:
+		print('WARNING: benchmark parameters differ between runs')
+	print(f'{"benchmark":40s} {old["commit"]:>10s} {new["commit"]:>10s}   ratio')
+	for name in new['results']:
+		old_result, new_result = old['results'].get(name), new['results'][name]
+		if old_result is None or new_result is None: continue
+		old_t, new_t = old_result['min'], new_result['min']
+		print(f'{name:40s} {old_t:9.3f}s {new_t:9.3f}s   {new_t/old_t:5.2f}x')
+
+def main():
+	parser = argparse.ArgumentParser(description='Benchmark pipeline hot paths with synthetic data')
+	parser.add_argument('--nx', type=int, default=200, help='land grid columns')
+	parser.add_argument('--ny', type=int, default=150, help='land grid rows')
+	parser.add_argument('--reaches', type=int, default=20000, help='number of stream reaches')
+	parser.add_argument('--years', type=int, default=10, help='number of retrospective years')
+	parser.add_argument('--regions', type=int, default=2, help='number of config.regions snapshots to time')
+	parser.add_argument('--repeat', type=int, default=3, help='timed repetitions of each benchmark')
+	parser.add_argument('--data-dir', default='/tmp/nwm_drought_bench', help='where synthetic data is written')
+	parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two saved result files')
+	args = parser.parse_args()
+
+	if args.compare:
+		compare(*args.compare)
+	else:
+		run(args)
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,174 @@
+'''
+	Generate NWM-shaped synthetic inputs so the pipeline hot paths can be benchmarked offline.
+
+	Files are written with the same names, dimensions and attributes that the pipeline expects:
+		nwm_retro_data : <prefix>_<YYYYMMDD>1200.LDASOUT_DOMAIN1, <prefix>_<YYYYMMDD>1200.CHRTOUT_DOMAIN1
+		nwm_oper_data  : <prefix>_<YYYYMMDD>_nwm.t12z.analysis_assim.{land,channel_rt}.tm00.conus.nc
+		(prefix is config.domain_prefix, e.g. NEUS)
+		workspace      : an uncropped <YYYYMMDD>1200.LDASOUT_DOMAIN1 for subset_soil_m_data
+		NHDPlus        : NHDFlowline_Network.shp keyed by COMID, and the flowline artifact built from it
+		us_shapefile   : st99_d00.shp with one rectangle per state in config.state_list
+	Values are random but deterministic for a given seed.
+'''
+import os
+import json
+import math
+import datetime
+from types import SimpleNamespace
+
+import numpy as np
+import pyproj
+import fiona
+from netCDF4 import Dataset
+
+import config
+from lib.flowlines import FLOWLINE_VERSION, get_flowline_artifact_path, build_flowline_artifact
+from lib.utils import get_subset_file_name
+
+# Lambert conformal conic projection used by the NWM land grid
+NWM_PROJ4 = '+proj=lcc +units=m +a=6370000.0 +b=6370000.0 +lat_1=30.0 +lat_2=60.0 +lat_0=40.0 +lon_0=-97.0 +x_0=0 +y_0=0 +k_0=1.0 +nadgrids=@null +wktext +no_defs'
+FILL_VALUE = -9999.
+
+# Build a copy of config with every directory moved under root_dir
+def make_bench_config(root_dir):
+	attrs = {k: getattr(config, k) for k in dir(config) if not k.startswith('__')}
+	for k, v in attrs.items():
+		if isinstance(v, str) and k != 'writable_dir' and v.startswith(config.writable_dir + '/'):
+			attrs[k] = root_dir + v[len(config.writable_dir):]
+	attrs['writable_dir'] = root_dir
+	bench_config = SimpleNamespace(**attrs)
+	for k, v in attrs.items():
+		if k.endswith('_dir') and isinstance(v, str) and v.startswith(root_dir) and not os.path.exists(v):
+			os.makedirs(v)
+	return bench_config
+
+# x/y coordinates of an LCC grid covering the lat/lon box, with nx by ny cells
+def grid_coordinates(ll_lon, ll_lat, ur_lon, ur_lat, nx, ny):
+	transformer = pyproj.Transformer.from_proj(pyproj.Proj(proj='latlong', datum='WGS84'), pyproj.Proj(NWM_PROJ4))
+	corner_lons = [ll_lon, ll_lon, ur_lon, ur_lon]
+	corner_lats = [ll_lat, ur_lat, ll_lat, ur_lat]
+	xs, ys = transformer.transform(corner_lons, corner_lats)
+	x = np.linspace(min(xs), max(xs), nx)
+	y = np.linspace(min(ys), max(ys), ny)
+	return x, y
+
+def write_ldasout(path, x, y, soil_m, proj4=NWM_PROJ4):
+	with Dataset(path, 'w') as ncfile:
+		ncfile.setncattr('proj4', proj4)
+		ncfile.createDimension('time', 1)
+		ncfile.createDimension('y', len(y))
+		ncfile.createDimension('soil_layers_stag', soil_m.shape[1])
+		ncfile.createDimension('x', len(x))
+		ncfile.createVariable('x', 'f8', ('x',))[:] = x
+		ncfile.createVariable('y', 'f8', ('y',))[:] = y
+		var = ncfile.createVariable('SOIL_M', 'f4', ('time', 'y', 'soil_layers_stag', 'x'), fill_value=FILL_VALUE)
+		# Keep the raw fill values visible to readers, as in NWM output where negatives mark non-land cells
+		var.set_auto_mask(False)
+		var[0,:,:,:] = soil_m
+
+def write_chrtout(path, feature_ids, streamflow, proj4=NWM_PROJ4):
+	with Dataset(path, 'w') as ncfile:
+		ncfile.setncattr('proj4', proj4)
+		ncfile.createDimension('feature_id', len(feature_ids))
+		ncfile.createVariable('feature_id', 'i4', ('feature_id',))[:] = feature_ids
+		ncfile.createVariable('streamflow', 'f4', ('feature_id',))[:] = streamflow
+
+def write_flowlines(path, comids, bbox, rng):
+	schema = {'geometry': 'LineString', 'properties': {'COMID': 'int', 'TotDASqKm': 'float'}}
+	with fiona.open(path, 'w', driver='ESRI Shapefile', schema=schema, crs='EPSG:4326') as dst:
+		for comid in comids:
+			lon = rng.uniform(bbox[0], bbox[2])
+			lat = rng.uniform(bbox[1], bbox[3])
+			steps = rng.normal(0, 0.01, size=(rng.integers(2, 8), 2)).cumsum(axis=0)
+			coords = [(float(lon + dx), float(lat + dy)) for dx, dy in steps]
+			dst.write({
+				'geometry': {'type': 'LineString', 'coordinates': coords},
+				'properties': {'COMID': int(comid), 'TotDASqKm': float(rng.uniform(1, 1000))}
+			})
+
+def write_states(path, state_names, bbox):
+	schema = {'geometry': 'Polygon', 'properties': {'NAME': 'str'}}
+	ncols = math.ceil(math.sqrt(len(state_names)))
+	nrows = math.ceil(len(state_names) / ncols)
+	dx = (bbox[2] - bbox[0]) / ncols
+	dy = (bbox[3] - bbox[1]) / nrows
+	with fiona.open(path, 'w', driver='ESRI Shapefile', schema=schema, crs='EPSG:4326') as dst:
+		for i, name in enumerate(state_names):
+			x0 = bbox[0] + (i % ncols) * dx
+			y0 = bbox[1] + (i // ncols) * dy
+			ring = [(x0, y0), (x0, y0 + dy), (x0 + dx, y0 + dy), (x0 + dx, y0), (x0, y0)]
+			dst.write({'geometry': {'type': 'Polygon', 'coordinates': [ring]}, 'properties': {'NAME': name}})
+
+# Dates (YYYYMMDD) within the lookback window ending on MMDD of year
+def lookback_dates(year, MMDD, ndays):
+	end = datetime.datetime.strptime(f'{year}{MMDD}', '%Y%m%d')
+	return [(end - datetime.timedelta(days=i)).strftime('%Y%m%d') for i in range(ndays)]
+
+def generate(bench_config, YYYYMMDD, nx=200, ny=150, nreaches=20000, nyears=10, seed=0):
+	'''Write a synthetic data set for YYYYMMDD into the directories of bench_config.
+		Skips generation if a data set with identical parameters already exists.
+		Returns the first retro year, for use as syear.
+	'''
+	params = {'YYYYMMDD': YYYYMMDD, 'nx': nx, 'ny': ny, 'nreaches': nreaches, 'nyears': nyears, 'seed': seed, 'flowline_version': FLOWLINE_VERSION}
+	params_path = os.path.join(bench_config.writable_dir, 'synthetic_params.json')
+	syear = str(2021 - nyears)
+	if os.path.exists(params_path):
+		with open(params_path) as f:
+			if json.load(f) == params: return syear
+
+	rng = np.random.default_rng(seed)
+	bbox = [bench_config.ll_lon, bench_config.ll_lat, bench_config.ur_lon, bench_config.ur_lat]
+	products = {p['varname']: p for p in bench_config.products}
+	soil_days = max(products['SOIL_M']['summary_lengths'])
+	flow_days = max(products['streamflow']['summary_lengths'])
+
+	# Land grid, with a block of fill values standing in for ocean cells
+	x, y = grid_coordinates(*bbox, nx, ny)
+	land_mask = np.ones((ny, 4, nx), dtype=bool)
+	land_mask[:ny//4, :, -nx//4:] = False
+	def soil_m():
+		values = rng.uniform(0.05, 0.45, size=(ny, 4, nx)).astype('f4')
+		return np.where(land_mask, values, FILL_VALUE)
+
+	# Reach ids, with a few constant-flow reaches standing in for lakes
+	feature_ids = np.sort(rng.choice(np.arange(1000, 1000 + nreaches * 20), size=nreaches, replace=False)).astype('i4')
+	lake_reaches = rng.random(nreaches) < 0.02
+	def streamflow():
+		values = rng.lognormal(mean=1.0, sigma=1.0, size=nreaches).astype('f4')
+		values[lake_reaches] = 0.
+		return values
+
+	# Retrospective files for every year and lookback day
+	for year in range(int(syear), 2021):
+		for date in lookback_dates(year, YYYYMMDD[4:], soil_days):
+			write_ldasout(os.path.join(bench_config.retro_data_dir, get_subset_file_name(bench_config.domain_prefix, 'LDASOUT', date, bench_config.hour)), x, y, soil_m())
+		for date in lookback_dates(year, YYYYMMDD[4:], flow_days):
+			write_chrtout(os.path.join(bench_config.retro_data_dir, get_subset_file_name(bench_config.domain_prefix, 'CHRTOUT', date, bench_config.hour)), feature_ids, streamflow())
+
+	# Operational files for the lookback window ending on YYYYMMDD
+	for date in lookback_dates(YYYYMMDD[:4], YYYYMMDD[4:], soil_days):
+		write_ldasout(os.path.join(bench_config.oper_data_dir, get_subset_file_name(bench_config.domain_prefix, 'land', date, bench_config.hour, bench_config.lookback)), x, y, soil_m())
+	for date in lookback_dates(YYYYMMDD[:4], YYYYMMDD[4:], flow_days):
+		write_chrtout(os.path.join(bench_config.oper_data_dir, get_subset_file_name(bench_config.domain_prefix, 'channel_rt', date, bench_config.hour, bench_config.lookback)), feature_ids, streamflow())
+
+	# Uncropped land file covering a wider area, for timing the subset step
+	pad = 5.
+	wide_nx, wide_ny = nx * 2, ny * 2
+	wide_x, wide_y = grid_coordinates(bbox[0] - pad, bbox[1] - pad, bbox[2] + pad, bbox[3] + pad, wide_nx, wide_ny)
+	wide_soil_m = rng.uniform(0.05, 0.45, size=(wide_ny, 4, wide_nx)).astype('f4')
+	write_ldasout(os.path.join(bench_config.temp_dir, f'{YYYYMMDD}1200.LDASOUT_DOMAIN1'), wide_x, wide_y, wide_soil_m)
+
+	# Shapefiles. Some flowlines reference COMIDs that are missing from the NWM files, as in NHDPlus.
+	comids = np.concatenate([feature_ids, feature_ids[-1] + 1 + np.arange(nreaches // 50)])
+	write_flowlines(os.path.join(bench_config.nhdplus_dir, 'NHDFlowline_Network.shp'), comids, bbox, rng)
+	write_states(os.path.join(bench_config.us_shp_dir, 'st99_d00.shp'), bench_config.state_list, bbox)
+
+	# Precalculated reach list, as extracted by main.setup from lib/streamflow_ids.npy.gz
+	np.save(bench_config.reach_ids_path, feature_ids.astype('int64'))
+
+	# Regional flowline artifact, as get_shapefiles builds from the cropped NHDPlus shapefile
+	build_flowline_artifact(os.path.join(bench_config.nhdplus_dir, 'NHDFlowline_Network.shp'), get_flowline_artifact_path(bench_config), bbox)
+
+	with open(params_path, 'w') as f:
+		json.dump(params, f)
+	return syear
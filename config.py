@@ -1,25 +1,71 @@
+import os
+from dotenv import load_dotenv
+load_dotenv()
+
 #####################
 # Project structure #
 #####################
 root_dir = ''
 
-lib_dir = root_dir + '/lib'
-writable_dir = root_dir + '/nwm_drought_volume'
+lib_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'lib')
+### NWM_DROUGHT_VOLUME can be set to run against a volume other than /nwm_drought_volume (see replay.py)
+writable_dir = os.environ.get('NWM_DROUGHT_VOLUME', root_dir + '/nwm_drought_volume')
 
 us_shp_dir = writable_dir + '/us_shapefile'
 nhdplus_dir = writable_dir + '/NHDPlus'
 
-### location to store full downloaded NWM files temporarily
+### location to store full downloaded NWM files temporarily, in a workspace for each running process (see lib/coordination.py)
 temp_dir = writable_dir + '/workspace'
 
+### location of lease files used to coordinate overlapping runs (see lib/coordination.py)
+lock_dir = writable_dir + '/locks'
+### seconds to wait for a lease held by another run before giving up
+lease_timeout = 25*60
+
 ### location to store subset NWM files
 retro_data_dir = writable_dir + '/nwm_retro_data'
 oper_data_dir = writable_dir + '/nwm_oper_data'
 
 output_dir = writable_dir + '/nwm_drought_indicator_output'
+
+### location of running sums used to update operational lookback averages incrementally
+rolling_state_dir = writable_dir + '/rolling_state'
+### number of incremental updates after which a rolling state is rebuilt from all files in its window
+rolling_state_max_updates = 30
+
+### location of per-stage reports written when main.py is run with --profile
+profile_dir = writable_dir + '/profiles'
+
+### location of next-day climatologies built after each publish (see lib/prepare.py)
+prepared_dir = writable_dir + '/prepared'
+### time from the start of each run to its maps being published, one line per published run
+critical_path_log = writable_dir + '/critical_path_log.csv'
 #####################
 
 
+##########################
+# Data source endpoints #
+##########################
+### Each endpoint can be overridden with an environment variable, e.g. to point at local S3/HTTP stand-ins (see replay.py).
+### An endpoint of None uses the service default (AWS for S3 buckets, the Cloudflare account endpoint for R2).
+nwm_retro_bucket = 'noaa-nwm-retrospective-3-0-pds'
+nwm_retro_endpoint_url = os.environ.get('NWM_RETRO_ENDPOINT_URL')
+nomads_url = os.environ.get('NOMADS_URL', 'https://nomads.ncep.noaa.gov/pub/data/nccf/com/nwm/prod')
+r2_endpoint_url = os.environ.get('R2_ENDPOINT_URL')
+s3_endpoint_url = os.environ.get('S3_ENDPOINT_URL')
+##########################
+
+### Files of each day's output directory published to S3 (see lib/s3_bucket.py). Published files are public, so only
+### the maps are by default. Add '.mbtiles' (tile pyramids), '.npz' (percentile artifacts) or '.csv' (zonal statistics)
+### to publish those too.
+publish_extensions = ['.png']
+### Number of published runs kept in S3, including the live one
+publish_keep_runs = 3
+### Also copy each published run to the flat S3_PREFIX/<file> keys the nedews site reads. Set to False once the site
+### reads S3_PREFIX/current.json.
+publish_legacy_keys = True
+
+
 ### Region definitions. These are used to create filtered and cropped NHDPlus data files.
 regions = {
 	'ne': [-83.0, 37.0, -66.5, 48.0],
@@ -33,6 +79,20 @@ regions = {
 	'ri': [-72.50, 41.00, -70.50, 42.50],
 	'wv':  [-83.00, 37.00, -77.50, 40.80]
 }
+### Region the NHDPlus flowlines are cropped to for the streamflow maps (see lib/flowlines.py)
+flowline_region = 'ne'
+
+### Web map tile output (see lib/tiles.py), enabled with main.py --tiles.
+### Each map is also written as an MBTiles tile pyramid for these zoom levels.
+tile_output = False
+tile_min_zoom = 4
+tile_max_zoom = 8
+
+### Percentile query service (see query.py and lib/query_service.py)
+query_host = os.environ.get('QUERY_HOST', '127.0.0.1')
+query_port = int(os.environ.get('QUERY_PORT', 8080))
+### how often (seconds) the service checks output_dir for a newer date to load
+query_reload_seconds = 300
 
 # Product definitions. These are looped over for configuration info when creating product maps
 products = [{
@@ -83,6 +143,12 @@ ll_lat = 37.00
 ur_lon = -65.00
 ur_lat = 48.10
 
+### start of the subset NWM file names, e.g. NEUS_20250601_nwm.t12z.analysis_assim.land.tm00.conus.nc (cannot contain '_')
+domain_prefix = 'NEUS'
+### precalculated feature ids of the reaches channel files are cropped to, extracted by main.setup from lib_dir (and sorted, if they are not)
+reach_ids_file = 'streamflow_ids.npy.gz'
+reach_ids_path = writable_dir + '/streamflow_ids.npy'
+
 # Number of retro days to retrieve
 # # NOTE this will include two days after YYYYMMDD and remainder of days before YYYYMMDD, so minimum value is 3 for summary length of 1.
 # # Example: If YYYYMMDD='20220815' and numdays_in_period=7, then the following dates are retrived for each year: ['0811','0812','0813','0814','0815','0816','0817']
@@ -93,8 +159,42 @@ numdays_in_period = 33
 # The files for 12Z become available after 9:30 AM ET.
 hour='12'
 
+### Availability watcher (see watch.py and lib/availability.py), which starts the pipeline as soon as the files are published.
+### Poll intervals and lead are in seconds. availability_timeout should leave time for the pipeline within the job limit.
+availability_log = writable_dir + '/availability_log.json'
+availability_history_days = 30
+availability_min_interval = 20
+availability_max_interval = 300
+availability_backoff = 1.2
+availability_lead = 300
+availability_timeout = 20*60
+
 # Use '00', not really sure what the file difference is
 lookback='00'
 
 # Used to determine which state shapes to add to maps
-state_list = ['West Virginia', 'Maine', 'Massachusetts', 'Pennsylvania', 'Connecticut', 'Rhode Island', 'New Jersey', 'New York', 'Delaware', 'Maryland', 'New Hampshire', 'Vermont']
\ No newline at end of file
+state_list = ['West Virginia', 'Maine', 'Massachusetts', 'Pennsylvania', 'Connecticut', 'Rhode Island', 'New Jersey', 'New York', 'Delaware', 'Maryland', 'New Hampshire', 'Vermont']
+
+### Zonal statistics (see lib/zonal_stats.py): the share of each zone's area (SOIL_M) or reach length (streamflow)
+### in each percentile class, written next to the maps as zonal-<varname>.csv.
+zonal_output = True
+### location of cached grid cell and flowline zone assignments
+zonal_cache_dir = writable_dir + '/zonal_cache'
+### Zone layers: 'shapefile' is in us_shp_dir, 'name_field' names each zone (features with the same name are merged),
+### and 'include' optionally limits the zones. A county layer can be added by placing a county shapefile in us_shp_dir, e.g.
+###   {'name': 'county', 'shapefile': 'counties.shp', 'name_field': 'GEOID'}
+### Layers whose shapefile is missing are skipped.
+zonal_layers = [
+	{'name': 'state', 'shapefile': 'st99_d00.shp', 'name_field': 'NAME', 'include': state_list}
+]
+
+### Domains products are made for (see lib/domains.py). Each CONUS file is downloaded once and subset for every domain.
+### A domain sets the values above that differ for it, typically domain_prefix, ll_lon/ll_lat/ur_lon/ur_lat,
+### reach_ids_file, regions (the first region's maps are named without a suffix), flowline_region, products,
+### state_list and zonal_layers. The first domain uses the values above as they are. For example:
+###   'mw': {'domain_prefix': 'MW', 'll_lon': -97.5, 'll_lat': 36.0, 'ur_lon': -80.5, 'ur_lat': 49.5,
+###     'reach_ids_file': 'streamflow_ids_mw.npy.gz', 'regions': {'mw': [-97.5, 36.0, -80.5, 49.5]}, 'flowline_region': 'mw',
+###     'state_list': mw_state_list, 'zonal_layers': [{'name': 'state', 'shapefile': 'st99_d00.shp', 'name_field': 'NAME', 'include': mw_state_list}]}
+domains = {
+	'neus': {}
+}
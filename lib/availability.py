@@ -0,0 +1,118 @@
+'''
+	Watch NOMADS for the operational files of a date, so that products can be made as soon as both are published
+	instead of at the next fixed cron time.
+
+	The exact file URLs are polled with HEAD requests over one keep-alive session, so each check transfers only
+	headers. When each file was first seen, and when it was last seen missing, is recorded in
+	config.availability_log as a delay after the model cycle time (12Z). The polling schedule adapts from this
+	history: well before files have usually appeared, checks are spaced config.availability_max_interval apart.
+	From config.availability_lead seconds before the earliest usual appearance, checks start at
+	config.availability_min_interval and back off by config.availability_backoff after every miss.
+'''
+import os
+import json
+import time
+import datetime
+import requests
+
+from .utils import get_oper_url
+
+OPER_FTYPES = ['channel_rt', 'land']
+
+# Model cycle time of YYYYMMDD as a unix timestamp, e.g. 12Z for config.hour '12'
+def get_cycle_timestamp(YYYYMMDD, hour):
+	cycle = datetime.datetime.strptime(f'{YYYYMMDD}{hour}', '%Y%m%d%H').replace(tzinfo=datetime.timezone.utc)
+	return cycle.timestamp()
+
+def load_history(path):
+	if not os.path.exists(path): return []
+	with open(path) as f:
+		return json.load(f)
+
+# Append records, keeping the most recent max_records for each file type
+def save_history(path, history, records, max_records):
+	history = history + records
+	kept = []
+	for ftype in set([r['ftype'] for r in history]):
+		kept += [r for r in history if r['ftype'] == ftype][-max_records:]
+	kept.sort(key=lambda r: (r['date'], r['ftype']))
+	tmp_path = f'{path}.{os.getpid()}.tmp'
+	with open(tmp_path, 'w') as f:
+		json.dump(kept, f, indent=1)
+	os.replace(tmp_path, path)
+
+# Earliest usual delay (seconds after the cycle time) at which a file type appears, or None without history.
+#   A file appeared sometime between when it was last seen missing and when it was first seen.
+def get_expected_delay(history, ftype, quantile=0.1):
+	delays = sorted([r['last_missing'] if r['last_missing'] is not None else r['first_seen'] for r in history if r['ftype'] == ftype])
+	if not delays: return None
+	return delays[int(quantile * (len(delays) - 1))]
+
+def is_available(session, url):
+	try:
+		r = session.head(url, timeout=30, allow_redirects=True)
+		return r.status_code == 200
+	except requests.exceptions.RequestException:
+		return False
+
+class AvailabilityWatcher:
+	'''Polls for the operational files of one date until all are published or the timeout passes.'''
+	def __init__(self, config, YYYYMMDD):
+		self.config = config
+		self.YYYYMMDD = YYYYMMDD
+		self.cycle_timestamp = get_cycle_timestamp(YYYYMMDD, config.hour)
+		self.urls = {ftype: get_oper_url(config.nomads_url, ftype, YYYYMMDD, config.hour, config.lookback) for ftype in OPER_FTYPES}
+		self.history = load_history(config.availability_log)
+		expected = [get_expected_delay(self.history, ftype) for ftype in OPER_FTYPES]
+		expected = [delay for delay in expected if delay is not None]
+		# Without history, poll quickly from the start
+		self.fast_from = self.cycle_timestamp + min(expected) - config.availability_lead if expected else 0.
+		self.last_missing = {ftype: None for ftype in OPER_FTYPES}
+		self.first_seen = {}
+		self.checks = 0
+
+	def next_interval(self, now, misses):
+		config = self.config
+		if now < self.fast_from:
+			return max(min(config.availability_max_interval, self.fast_from - now), 1.)
+		return min(config.availability_min_interval * config.availability_backoff**misses, config.availability_max_interval)
+
+	def check(self, session):
+		now = time.time()
+		for ftype, url in self.urls.items():
+			if ftype in self.first_seen: continue
+			self.checks += 1
+			if is_available(session, url):
+				self.first_seen[ftype] = now
+			else:
+				self.last_missing[ftype] = now
+		return len(self.first_seen) == len(self.urls)
+
+	def wait(self, timeout):
+		'''Returns True once every file is available, False if timeout (seconds) passes first.'''
+		deadline = time.time() + timeout
+		misses = 0
+		with requests.Session() as session:
+			while not self.check(session):
+				now = time.time()
+				if now >= deadline: return False
+				if now >= self.fast_from: misses += 1
+				time.sleep(min(self.next_interval(now, misses), max(deadline - now, 0.)))
+		self.record()
+		return True
+
+	# Add this date's appearance times to the history used to schedule future polling
+	def record(self):
+		records = []
+		for ftype in self.urls:
+			last_missing = self.last_missing[ftype]
+			records.append({
+				'date': self.YYYYMMDD,
+				'ftype': ftype,
+				'first_seen': round(self.first_seen[ftype] - self.cycle_timestamp, 1),
+				'last_missing': round(last_missing - self.cycle_timestamp, 1) if last_missing is not None else None
+			})
+		# A date's files are only recorded once, when they are first found
+		history = [r for r in self.history if r['date'] != self.YYYYMMDD]
+		save_history(self.config.availability_log, history, records, self.config.availability_history_days)
+		return records
@@ -0,0 +1,94 @@
+'''
+	Reprocess products for a range of dates.
+
+	Dates are split into contiguous chunks, one per worker process. Each worker loads the map shapes
+	(basemaps) once, then walks its dates in order. The daily arrays read for one date are kept in a
+	SlidingWindowCache, so each following date only reads the day that entered its lookback windows
+	instead of re-reading every retrospective and operational file.
+'''
+import multiprocessing
+
+from .create_nwm_nedews_products import create_products, load_basemap, check_product_status
+from .utils import log_errors
+from .coordination import lease
+
+class SlidingWindowCache(dict):
+	'''Maps file path -> data read from the file.
+		Call next_step() before each date. Entries that were not used during the previous date are dropped.
+		Because lookback windows move forward one day per date, this drops the day that left the windows.
+	'''
+	def __init__(self):
+		super().__init__()
+		self.used = set()
+
+	def __getitem__(self, key):
+		self.used.add(key)
+		return super().__getitem__(key)
+
+	def __setitem__(self, key, value):
+		self.used.add(key)
+		super().__setitem__(key, value)
+
+	def next_step(self):
+		for key in [k for k in self.keys() if k not in self.used]:
+			del self[key]
+		self.used = set()
+
+# Split dates into at most n contiguous chunks of nearly equal length
+def split_dates(dates, n):
+	n = max(1, min(n, len(dates)))
+	size, extra = divmod(len(dates), n)
+	chunks = []
+	start = 0
+	for i in range(n):
+		end = start + size + (1 if i < extra else 0)
+		chunks.append(dates[start:end])
+		start = end
+	return chunks
+
+# Create products for each date in order, reusing basemaps and cached daily arrays. Returns {date: {varname: status}}.
+def process_dates(config, dates, retro_start_years):
+	basemaps = {p['varname']: load_basemap(config, p['varname']) for p in config.products}
+	cache = SlidingWindowCache()
+	results = {}
+	for YYYYMMDD in dates:
+		cache.next_step()
+		results[YYYYMMDD] = {}
+		for dataset_type_dict in config.products:
+			varname = dataset_type_dict['varname']
+			# Under the same lease as main.py, so a date being made by another run is waited for and then found to exist
+			with lease(config, 'products', f'{config.domain_prefix}-{YYYYMMDD}-{varname}'):
+				ncfile_exists, pngfile_exists = check_product_status(config, YYYYMMDD, varname)
+				if pngfile_exists:
+					results[YYYYMMDD][varname] = 'exists'
+				elif not ncfile_exists:
+					results[YYYYMMDD][varname] = 'missing operational data'
+				else:
+					try:
+						create_products(config, YYYYMMDD, retro_start_years[YYYYMMDD], dataset_type_dict, basemaps[varname], cache)
+						results[YYYYMMDD][varname] = 'created'
+					except Exception as e:
+						# Log the error and carry on with the rest of the range
+						log_errors(e, config.writable_dir, 'error_logs.txt')
+						results[YYYYMMDD][varname] = f'error: {e}'
+	return results
+
+# Worker processes are forked, so they inherit the config object instead of receiving a pickled copy
+_worker_config = None
+
+def _process_chunk(dates, retro_start_years):
+	return process_dates(_worker_config, dates, retro_start_years)
+
+def run_batch(config, dates, retro_start_years, workers=1):
+	chunks = split_dates(dates, workers)
+	if len(chunks) == 1:
+		return process_dates(config, dates, retro_start_years)
+
+	global _worker_config
+	_worker_config = config
+	with multiprocessing.get_context('fork').Pool(len(chunks)) as pool:
+		chunk_results = pool.starmap(_process_chunk, [(chunk, {d: retro_start_years[d] for d in chunk}) for chunk in chunks])
+	results = {}
+	for chunk_result in chunk_results:
+		results.update(chunk_result)
+	return results
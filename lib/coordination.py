@@ -0,0 +1,153 @@
+'''
+	Coordination between overlapping runs, e.g. a manual backfill of main.py started while the scheduled run is going.
+
+	Leases: a process takes a lease (an flock on a file in config.lock_dir, named after the stage and date) while it
+	produces that stage's files. A second process that needs the same files waits for the lease, then finds the files
+	made and skips them. Stages that can be split (the retro download of each date) try leases without waiting and come
+	back to busy ones at the end, so two runs fetch different dates instead of the same ones. The OS releases a lease
+	when its process exits or is killed, so a failed run never leaves a stale lease behind. Lease files are removed
+	when released, so lock_dir does not grow with every date.
+
+	Workspaces: each process downloads full NWM files into its own directory in config.temp_dir, so files with the same
+	name (e.g. nwm.t12z.analysis_assim.land.tm00.conus.nc for different dates) are never shared between runs. A
+	workspace is locked while its process runs. Workspaces that are no longer locked are left over from runs that
+	were killed, and are removed. The locks also tell a run whether others are active, in which case cleanup steps
+	that could remove files another run is using (rotating old data and output) are left for a later run.
+'''
+import os
+import time
+import fcntl
+import shutil
+import atexit
+import socket
+import tempfile
+from contextlib import contextmanager
+
+# Take an exclusive flock on an open file, waiting up to timeout seconds (None to wait forever, 0 to not wait)
+def acquire_lock(f, timeout=None, poll=1.0):
+	start = time.time()
+	while True:
+		try:
+			fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+			return True
+		except BlockingIOError:
+			if timeout is not None and time.time() - start >= timeout: return False
+			time.sleep(poll)
+
+# Opened read only, so a lock file removed in the meantime is not created again
+def is_locked(path):
+	try:
+		f = open(path)
+	except FileNotFoundError:
+		return False
+	with f:
+		if not acquire_lock(f, timeout=0): return True
+		fcntl.flock(f, fcntl.LOCK_UN)
+		return False
+
+def get_lease_path(config, stage, key):
+	return os.path.join(config.lock_dir, f'{stage}-{key}.lock')
+
+def read_holder(path):
+	try:
+		with open(path) as f:
+			return f.read().strip() or 'another process'
+	except FileNotFoundError:
+		return 'another process'
+
+# True when the locked file f is still the one at path, i.e. its holder did not remove it while this process waited
+def is_current(f, path):
+	try:
+		stat = os.stat(path)
+	except FileNotFoundError:
+		return False
+	return (stat.st_dev, stat.st_ino) == (os.fstat(f.fileno()).st_dev, os.fstat(f.fileno()).st_ino)
+
+@contextmanager
+def lease(config, stage, key, wait=True):
+	'''Hold the lease for a stage and key (usually a date) for the duration of the with block.
+		Waits up to config.lease_timeout seconds for another process to release it (raising TimeoutError after),
+		or with wait=False yields False right away when the lease is held elsewhere, and True when it was taken.
+	'''
+	path = get_lease_path(config, stage, key)
+	start = time.time()
+	waiting = False
+	while True:
+		f = open(path, 'a+')
+		if not acquire_lock(f, timeout=0):
+			if not wait:
+				f.close()
+				yield False
+				return
+			if not waiting: print(f'waiting for {stage} {key} lease held by {read_holder(path)}')
+			waiting = True
+			if not acquire_lock(f, timeout=max(config.lease_timeout - (time.time() - start), 0)):
+				f.close()
+				raise TimeoutError(f'{stage} {key} lease still held by {read_holder(path)} after {config.lease_timeout} s')
+		# A lease file removed by its holder on release is opened again, as another process may have created a new one
+		if is_current(f, path): break
+		f.close()
+	try:
+		f.seek(0)
+		f.truncate()
+		f.write(f'pid {os.getpid()} on {socket.gethostname()} since {time.strftime("%Y-%m-%d %H:%M:%S")}\n')
+		f.flush()
+		yield True
+	finally:
+		# Removed while still locked, so a process that opens the path after this creates a new lease file
+		os.remove(path)
+		fcntl.flock(f, fcntl.LOCK_UN)
+		f.close()
+
+class Workspace:
+	'''A directory in config.temp_dir for this process, locked until the process exits.'''
+	def __init__(self, config):
+		self.pid = os.getpid()
+		# The lock is taken before the directory is made, so other processes never see an unlocked new workspace
+		fd, lock_path = tempfile.mkstemp(prefix=f'{self.pid}-', suffix='.lock', dir=config.temp_dir)
+		self.lock_file = os.fdopen(fd, 'a')
+		# Other processes checking for stale workspaces (is_locked) can hold the lock for a moment
+		if not acquire_lock(self.lock_file, timeout=10, poll=0.05):
+			raise TimeoutError(f'could not lock workspace {lock_path}')
+		self.path = lock_path[:-len('.lock')]
+		os.mkdir(self.path)
+		atexit.register(self.remove)
+
+	def remove(self):
+		shutil.rmtree(self.path, ignore_errors=True)
+		if os.path.exists(f'{self.path}.lock'): os.remove(f'{self.path}.lock')
+		self.lock_file.close()
+
+# One workspace per process, keyed by the temp_dir it is in (benchmark and replay configs use their own)
+_workspaces = {}
+
+def get_workspace(config):
+	'''Path of this process' workspace, created on first use. Workspaces of processes that are gone are removed then.'''
+	workspace = _workspaces.get(config.temp_dir)
+	# Forked worker processes get their own
+	if workspace is None or workspace.pid != os.getpid():
+		remove_stale_workspaces(config)
+		workspace = Workspace(config)
+		_workspaces[config.temp_dir] = workspace
+	return workspace.path
+
+# Remove workspaces whose lock is not held by a running process, and files left directly in temp_dir by older versions
+def remove_stale_workspaces(config):
+	for name in os.listdir(config.temp_dir):
+		path = os.path.join(config.temp_dir, name)
+		if name.endswith('.lock'): continue
+		lock_path = f'{path}.lock'
+		if os.path.exists(lock_path) and is_locked(lock_path): continue
+		if os.path.isdir(path): shutil.rmtree(path, ignore_errors=True)
+		elif os.path.exists(path): os.remove(path)
+		if os.path.exists(lock_path): os.remove(lock_path)
+
+def other_runs_active(config):
+	'''True when a workspace of another running process exists.'''
+	own = _workspaces.get(config.temp_dir)
+	for name in os.listdir(config.temp_dir):
+		if not name.endswith('.lock'): continue
+		lock_path = os.path.join(config.temp_dir, name)
+		if own is not None and lock_path == f'{own.path}.lock': continue
+		if is_locked(lock_path): return True
+	return False
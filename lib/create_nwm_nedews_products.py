@@ -10,31 +10,32 @@
 	orig bnb2, updated to python3 be99
 '''
 import os,sys
+import io
 import copy
 import datetime
 import numpy as np
-from netCDF4 import Dataset
 import pyproj
 import cartopy.crs as ccrs
 from cartopy import feature
 import fiona
 from shapely.geometry import shape, MultiPolygon, Polygon
 from operator import itemgetter
+from PIL import Image
+
+from .utils import read_product_file, classify_percentiles, build_map_palette, save_palette_png, get_subset_file_name
+from .tiles import GridTiler, LineTiler, palette_rgba, write_mbtiles
+from .rolling_means import get_rolling_period_average
+from .percentile_artifacts import write_soil_m_percentiles, write_streamflow_percentiles, write_reach_order
+from .flowlines import get_flowline_artifact_path, read_flowline_artifact
+from .prepare import load_prepared_climatology
+from .reach_alignment import get_reach_alignment, get_constant_reaches, gather_line_percentiles
+from .zonal_stats import get_zone_layers, get_grid_zones, get_reach_zones, zonal_class_totals, get_csv_header, get_csv_rows, write_zonal_csv
 
 import matplotlib
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 from matplotlib.colors import LinearSegmentedColormap
 
-# Uses data value to determine color stream shape should be
-def get_relative_streamflow_color(info, data, levs, cols):
-	key = info['COMID']
-	if key in data:
-		for idx in range(len(levs)-1):
-			if data[key] >= levs[idx] and data[key] < levs[idx+1]:
-				return cols[idx]
-	return (1.0, 1.0, 1.0, 1.0)
-
 def add_colorbar(fig, clevs_cmap, cmap_data, labelsize):
 	ax_legend = fig.add_axes([0.3, 0.17, 0.4, 0.03], zorder=3)
 	cb = matplotlib.colorbar.ColorbarBase(ax_legend, cmap=cmap_data, ticks=clevs_cmap, norm=matplotlib.colors.BoundaryNorm(clevs_cmap, cmap_data.N), orientation='horizontal')
@@ -44,27 +45,192 @@ def add_colorbar(fig, clevs_cmap, cmap_data, labelsize):
 def add_titlebox(text, ax, fontsize):
 	ax.text(0.05, 0.95, text, transform=ax.transAxes, fontsize=fontsize, bbox=dict(color='white'), verticalalignment='top')
 
-def take_snapshots(ax, varname, varidx, per, out_dir, regions):
-	# Loop regions to take zoomed in snapshots
+# Name shared by all outputs of one map, e.g. 'SOIL_M-1day-lev0' or 'streamflow-7day'
+def get_output_basename(varname, varidx, per):
+	fname_parts = [f'{varname}-{str(per)}day']
+	if varname=='SOIL_M':
+		fname_parts.append(f'-lev{str(varidx)}')
+	return ''.join(fname_parts)
+
+# Render the current figure to an RGBA array, at the size and resolution the maps are saved with
+def render_figure():
+	buffer = io.BytesIO()
+	plt.savefig(buffer, format='png', bbox_inches='tight', pad_inches=0.05, dpi=300)
+	buffer.seek(0)
+	return np.asarray(Image.open(buffer).convert('RGBA'))
+
+def take_snapshots(ax, varname, varidx, per, out_dir, regions, palette):
+	# Loop regions to take zoomed in snapshots. The first region (the whole domain) is saved without a suffix.
 	for bbox_key in regions.keys():
 		# Get bbox and rezoom plot
 		bbox = regions[bbox_key]
 		ax.set_extent([bbox[0],bbox[2],bbox[1],bbox[3]])
 
 		# Construct output filename
-		fname_parts = [f'{varname}-{str(per)}day']
-		if varname=='SOIL_M':
-			fname_parts.append(f'-lev{str(varidx)}')
-		if bbox_key != 'ne':
+		fname_parts = [get_output_basename(varname, varidx, per)]
+		if bbox_key != next(iter(regions)):
 			fname_parts.append(f'-{bbox_key}')
 		fname_parts.append('.png')
 		output_filename = ''.join(fname_parts)
 
-		# Save figure
-		plt.savefig(os.path.join(out_dir, output_filename), bbox_inches='tight', pad_inches=0.05, dpi=300)
+		# Save figure as an 8-bit palette image
+		save_palette_png(render_figure(), os.path.join(out_dir, output_filename), palette)
 
 
-def create_products(config, YYYYMMDD, syear, dataset_type_dict):
+# Load the shapes drawn on every map of a product. These do not change from day to day,
+#   so batch runs load them once and pass them into each create_products call.
+def load_basemap(config, varname):
+	basemap = {}
+	if varname == 'streamflow':
+		# Load the regional flowlines: their COMIDs and shapes, in the same order
+		flowlines = read_flowline_artifact(get_flowline_artifact_path(config))
+		basemap['flowline_comids'] = flowlines['comid']
+		basemap['flowline_shapes'] = flowlines['lines']
+	elif varname == 'SOIL_M':
+		# Create mask to cover data outside of area of interest
+		mask_polygon = Polygon([
+			(config.ll_lon, config.ll_lat),
+			(config.ll_lon, config.ur_lat),
+			(config.ur_lon, config.ur_lat),
+			(config.ur_lon, config.ll_lat),
+			(config.ll_lon, config.ll_lat)
+		])
+
+	# Load states shapefile and make list of states of interest, unmasking them if SOIL_M
+	states_shapefile = os.path.join(config.us_shp_dir, 'st99_d00.shp')
+	states_shp = fiona.open(states_shapefile, 'r')
+	state_border_polygons = []
+	for feat in states_shp:
+		if feat['properties']['NAME'] in config.state_list or varname=='streamflow':
+			state_shp = shape(feat['geometry'])
+			state_border_polygons.append(state_shp)
+			if varname == 'SOIL_M':
+				mask_polygon = mask_polygon.difference(state_shp)
+	states_shp.close()
+	basemap['state_border_polygons'] = MultiPolygon(state_border_polygons)
+	if varname == 'SOIL_M': basemap['mask_polygon'] = mask_polygon
+	return basemap
+
+# Check whether operational data for the date is available and whether its maps already exist
+def check_product_status(config, YYYYMMDD, varname):
+	day_out_dir = os.path.join(config.output_dir, f'{YYYYMMDD}_method1')
+	if varname=='SOIL_M':
+		ncfilename = get_subset_file_name(config.domain_prefix, 'land', YYYYMMDD, config.hour, config.lookback)
+		pngfilename = 'SOIL_M-1day-lev0.png'
+	elif varname=='streamflow':
+		ncfilename = get_subset_file_name(config.domain_prefix, 'channel_rt', YYYYMMDD, config.hour, config.lookback)
+		pngfilename = 'streamflow-1day.png'
+	ncfile_exists = os.path.exists(os.path.join(config.oper_data_dir, ncfilename))
+	pngfile_exists = os.path.exists(os.path.join(day_out_dir, pngfilename))
+	return ncfile_exists, pngfile_exists
+
+# Dates of the retro files averaged for each year of a climatology, one list of per dates for each year
+def get_retro_period_dates(YYYYMMDD, syear, per):
+	period_dates = []
+	sdate = f'{syear}{YYYYMMDD[4:]}'
+	edate = f'2020{YYYYMMDD[4:]}'
+	this_date = sdate
+	while this_date <= edate:
+		per_dates = []
+		for i in range(per):
+			# Change to day i within period
+			if this_date[4:] == '0229' and int(this_date[:4]) % 4 != 0:
+				dt_date = datetime.datetime.strptime(f'{this_date[:4]}0301','%Y%m%d')
+			else:
+				dt_date = datetime.datetime.strptime(this_date,'%Y%m%d')
+			dt_next = dt_date - datetime.timedelta(days=i)
+			per_dates.append(dt_next.strftime('%Y%m%d'))
+		period_dates.append(per_dates)
+
+		# Increment this_date
+		thisyear = this_date[:4]
+		nextyear = int(thisyear) + 1
+		this_date = str(nextyear)+this_date[4:]
+	return period_dates
+
+def get_retro_climatology(config, YYYYMMDD, syear, varname, dstype, per, cache=None):
+	######################################
+	### Create climatology for this averaging period.
+	### 1) Loop through each year
+	### 2) In each year:
+	###	- calculate period averages over period of interest (period_ave).
+	###	- save period averages to a list (data_clim). These will be used to
+	###	calculate percentiles later.
+	######################################
+	data_clim = []
+	for per_dates in get_retro_period_dates(YYYYMMDD, syear, per):
+		# Calculate average conditions over period
+		data_period = []
+		for per_date in per_dates:
+			# Extract variable for this data and append to list
+			ncfilename = get_subset_file_name(config.domain_prefix, dstype, per_date, config.hour)
+			data, _ = read_product_file(os.path.join(config.retro_data_dir, ncfilename), varname, cache)
+			data_period.append(data)
+		
+		# Convert to np array to average period, add averages to climatology, delete old copies of data to save memory
+		data_period = np.array(data_period)
+		period_ave = np.average(data_period,axis=0)
+		data_clim.append(period_ave[:])
+		del data_period
+		del period_ave
+
+	# Convert climatology to numpy array for use with built-in numpy/scipy methods.
+	data_clim = np.array(data_clim)
+	if varname=='SOIL_M': data_clim = np.ma.masked_where(data_clim<0, data_clim)
+	return data_clim
+
+# Calculate average conditions over period for target date. Returns the average and the
+#   coordinate information needed for mapping (proj4 string and x/y or feature ids).
+def get_oper_period_average(config, YYYYMMDD, varname, per, cache=None):
+	this_date = copy.deepcopy(YYYYMMDD)
+	data_period = []
+	for i in range(per):
+		# Change to day i within period
+		dt_date = datetime.datetime.strptime(this_date,'%Y%m%d')
+		dt_next = dt_date - datetime.timedelta(days=i)
+		per_date = dt_next.strftime('%Y%m%d')
+
+		# Extract variable for this data and append to list
+		if varname=='SOIL_M':
+			ncfilename = get_subset_file_name(config.domain_prefix, 'land', per_date, config.hour, config.lookback)
+		elif varname=='streamflow':
+			ncfilename = get_subset_file_name(config.domain_prefix, 'channel_rt', per_date, config.hour, config.lookback)
+		data, oper_meta = read_product_file(os.path.join(config.oper_data_dir, ncfilename), varname, cache, with_meta=True)
+		data_period.append(data)
+	
+	# Convert to numpy array, average the period, delete old data copies
+	data_period = np.array(data_period)
+	data_event = np.average(data_period,axis=0)
+	if varname=='SOIL_M': data_event = np.ma.masked_where(data_event<0, data_event)
+	del data_period
+	return data_event, oper_meta
+
+def calc_event_percentiles(data_clim, data_event):
+	# There are 42 years in data_clim (for NWM v3.0) and 1 current event year. We add 1 to the numerator
+	# and denominator for the current year.
+	# Percentiles are calculated as rank/(n+1).
+	# In numerator, 1 is added to adjust rank for the data event.
+	# In denominator, an additional 1 is added for the data event.
+	event_percentiles1 = ((data_clim<data_event).sum(axis=0)+1)/float(data_clim.shape[0]+2)
+	event_percentiles2 = ((data_clim<=data_event).sum(axis=0)+1)/float(data_clim.shape[0]+2)
+	return (event_percentiles1 + event_percentiles2)/2.
+
+# Place each stream shape into a key in the returned object where each key is a color definition.
+#   The result is [color]: list of shapes. This allows the shapes to quickly be added to the figure
+#   with the defined color. Adding individually is extremely slow and adding them like in the
+#   original script results in all shapes being the same color
+#   shapes is the array of flowline shapes from load_basemap, and classes their class indices from
+#   utils.classify_percentiles. Flowlines without data (class 255) are white.
+def group_flowlines_by_color(shapes, classes, ccols_cmap):
+	flowline_relativestreamflow_color = {}
+	# Colors are added in the order they first appear among the flowlines, which is the order they are drawn in
+	present_classes, first_index = np.unique(classes, return_index=True)
+	for cls in present_classes[np.argsort(first_index)]:
+		color = ccols_cmap[cls] if cls != 255 else (1.0, 1.0, 1.0, 1.0)
+		flowline_relativestreamflow_color[color] = list(shapes[classes == cls])
+	return flowline_relativestreamflow_color
+
+def create_products(config, YYYYMMDD, syear, dataset_type_dict, basemap=None, cache=None):
 	varname, varlen, summary_lengths, dstype, clevs_cmap, ccols_cmap = itemgetter('varname', 'varlen', 'summary_lengths', 'dstype', 'clevs_cmap', 'ccols_cmap')(dataset_type_dict)
 	
 	# Make sure output dir for day exists
@@ -72,17 +238,10 @@ def create_products(config, YYYYMMDD, syear, dataset_type_dict):
 	if not os.path.exists(day_out_dir): os.mkdir(day_out_dir)
 
 	# Check if operational data is available and if analysis has already run
-	if varname=='SOIL_M':
-		ncfilename = f'NEUS_{YYYYMMDD}_nwm.t12z.analysis_assim.land.tm00.conus.nc'
-		pngfilename = 'SOIL_M-1day-lev0.png'
-	elif varname=='streamflow':
-		ncfilename = f'NEUS_{YYYYMMDD}_nwm.t12z.analysis_assim.channel_rt.tm00.conus.nc'
-		pngfilename = 'streamflow-1day.png'
-	ncfile_exists = os.path.exists(os.path.join(config.oper_data_dir, ncfilename))
+	ncfile_exists, pngfile_exists = check_product_status(config, YYYYMMDD, varname)
 	if not ncfile_exists:
 		# Exit with message if data doesn't exist
 		sys.exit(f'nc file does not exist for {YYYYMMDD}')
-	pngfile_exists = os.path.exists(os.path.join(day_out_dir, pngfilename))
 	if pngfile_exists:
 		# Exit silently if analysis has already run
 		sys.exit()
@@ -98,34 +257,38 @@ def create_products(config, YYYYMMDD, syear, dataset_type_dict):
 	# Define projection of shapefiles
 	shp_proj = ccrs.PlateCarree()
 
-	if varname == 'streamflow':
-		# Load streamflow shapefile
-		inshape = os.path.join(config.nhdplus_dir, f'NHDFlowline_Network.shp')
-		shp_10k = fiona.open(inshape, 'r')
-	elif varname == 'SOIL_M':
-		# Create mask to cover data outside of area of interest
-		mask_polygon = Polygon([
-			(config.ll_lon, config.ll_lat),
-			(config.ll_lon, config.ur_lat),
-			(config.ur_lon, config.ur_lat),
-			(config.ur_lon, config.ll_lat),
-			(config.ll_lon, config.ll_lat)
-		])
-
-	# Load states shapefile and make list of states of interest, unmasking them if SOIL_M
-	states_shapefile = os.path.join(config.us_shp_dir, 'st99_d00.shp')
-	states_shp = fiona.open(states_shapefile, 'r')
-	state_border_polygons = []
-	for feat in states_shp:
-		if feat['properties']['NAME'] in config.state_list or varname=='streamflow':
-			state_shp = shape(feat['geometry'])
-			state_border_polygons.append(state_shp)
-			if varname == 'SOIL_M':
-				mask_polygon = mask_polygon.difference(state_shp)
-	state_border_polygons = MultiPolygon(state_border_polygons)
+	# Load shapes drawn on the maps, unless they were provided by the caller
+	if basemap is None: basemap = load_basemap(config, varname)
+	state_border_polygons = basemap['state_border_polygons']
+	if varname == 'SOIL_M': mask_polygon = basemap['mask_polygon']
 
 	# Define colors and ticks
 	cmap_data = LinearSegmentedColormap.from_list("cmap_data",ccols_cmap)
+	map_palette = build_map_palette(ccols_cmap)
+
+	# Percentile artifacts for streamflow are written in the reach order of the precalculated streamflow ids
+	if varname == 'streamflow':
+		reach_ids = np.load(config.reach_ids_path)
+		write_reach_order(day_out_dir, reach_ids)
+		# Rows of the flowlines in the streamflow arrays, looked up with the first period's feature ids
+		line_rows = None
+
+	# Web map tiles cover the cropped domain. Flowline pixel coordinates do not change between maps, so they are set up once.
+	if config.tile_output:
+		tile_bbox = [config.ll_lon, config.ll_lat, config.ur_lon, config.ur_lat]
+		tile_zooms = range(config.tile_min_zoom, config.tile_max_zoom + 1)
+		tile_palette = palette_rgba(ccols_cmap)
+		if varname == 'streamflow':
+			line_tiler = LineTiler(basemap['flowline_shapes'], tile_bbox, tile_zooms)
+
+	# Zone assignments for zonal statistics. Flowline zones are known now; grid zones need the grid, read with the first period.
+	if config.zonal_output:
+		zone_layers = get_zone_layers(config)
+		nclasses = len(clevs_cmap) - 1
+		zonal_rows = []
+		grid_zones = None
+		if varname == 'streamflow':
+			reach_zones = [(layer['name'],) + get_reach_zones(config, layer, basemap['flowline_comids'], basemap['flowline_shapes']) for layer in zone_layers]
 
 	# Figure font sizes
 	SMALL_SIZE = 4
@@ -136,112 +299,37 @@ def create_products(config, YYYYMMDD, syear, dataset_type_dict):
 
 	# Loop through averaging periods
 	for per in summary_lengths:
-		######################################
-		### Create climatology for this averaging period.
-		### 1) Loop through each year
-		### 2) In each year:
-		###	- calculate period averages over period of interest (period_ave).
-		###	- save period averages to a list (data_clim). These will be used to
-		###	calculate percentiles later.
-		######################################
-		data_clim = []
-		sdate = f'{syear}{YYYYMMDD[4:]}'
-		edate = f'2020{YYYYMMDD[4:]}'
-		this_date = sdate
-		while this_date <= edate:
-			# Calculate average conditions over period
-			per_date = copy.deepcopy(this_date)
-			data_period = []
-			for i in range(per):
-				# Change to day i within period
-				if this_date[4:] == '0229' and int(this_date[:4]) % 4 != 0:
-					dt_date = datetime.datetime.strptime(f'{this_date[:4]}0301','%Y%m%d')
-				else:
-					dt_date = datetime.datetime.strptime(this_date,'%Y%m%d')
-				dt_next = dt_date - datetime.timedelta(days=i)
-				per_date = dt_next.strftime('%Y%m%d')
-				
-				# Extract variable for this data and append to list
-				ncfilename = f'NEUS_{per_date}1200.{dstype}_DOMAIN1'
-				ncfile = Dataset(os.path.join(config.retro_data_dir, ncfilename),'r')
-				if varname=='SOIL_M':
-					data_period.append(ncfile.variables[varname][0,:,:,:])
-				elif varname=='streamflow':
-					data_period.append(ncfile.variables[varname][:])
-				ncfile.close()
-			
-			# Convert to np array to average period, add averages to climatology, delete old copies of data to save memory
-			data_period = np.array(data_period)
-			period_ave = np.average(data_period,axis=0)
-			data_clim.append(period_ave[:])
-			del data_period
-			del period_ave
-
-			# Increment this_date
-			thisyear = this_date[:4]
-			nextyear = int(thisyear) + 1
-			this_date = str(nextyear)+this_date[4:]
-
-		# Convert climatology to numpy array for use with built-in numpy/scipy methods.
-		data_clim = np.array(data_clim)
-		if varname=='SOIL_M': data_clim = np.ma.masked_where(data_clim<0, data_clim)
-
-		# Calculate average conditions over period for target date
-		this_date = copy.deepcopy(YYYYMMDD)
-		data_period = []
-		for i in range(per):
-			# Change to day i within period
-			dt_date = datetime.datetime.strptime(this_date,'%Y%m%d')
-			dt_next = dt_date - datetime.timedelta(days=i)
-			per_date = dt_next.strftime('%Y%m%d')
+		# Build climatology and current conditions for this averaging period, then rank current conditions
+		# Daily runs use the climatology prepared after the previous day's publish when there is one (see lib/prepare.py)
+		data_clim = load_prepared_climatology(config, YYYYMMDD, syear, varname, per) if cache is None else None
+		if data_clim is None:
+			data_clim = get_retro_climatology(config, YYYYMMDD, syear, varname, dstype, per, cache)
+		if cache is None and per > 1:
+			# Daily runs update a persisted running sum instead of re-reading every day of the lookback
+			data_event, oper_meta = get_rolling_period_average(config, YYYYMMDD, varname, per)
+		else:
+			data_event, oper_meta = get_oper_period_average(config, YYYYMMDD, varname, per, cache)
+		event_percentiles = calc_event_percentiles(data_clim, data_event)
+		proj4_string = oper_meta['proj4']
+		if varname=='SOIL_M':
+			# Create 2D grid from 1D lat and lon
+			x_mesh, y_mesh = np.meshgrid(oper_meta['x'], oper_meta['y'])
+		elif varname=='streamflow':
+			feature_idsa = oper_meta['feature_ids']
+			if line_rows is None:
+				line_rows, line_present = get_reach_alignment(config, basemap['flowline_comids'], feature_idsa)
 
-			# Extract variable for this data and append to list
-			if varname=='SOIL_M':
-				ncfilename = f'NEUS_{per_date}_nwm.t12z.analysis_assim.land.tm00.conus.nc'
-			elif varname=='streamflow':
-				ncfilename = f'NEUS_{per_date}_nwm.t12z.analysis_assim.channel_rt.tm00.conus.nc'
-			ncfile = Dataset(os.path.join(config.oper_data_dir, ncfilename),'r')
-			proj4_string = ncfile.getncattr('proj4')
-			if varname=='SOIL_M':
-				# Get x and y coords
-				x = ncfile.variables['x'][:]
-				y = ncfile.variables['y'][:]
-
-				# Create 2D grid from 1D lat and lon
-				x_mesh, y_mesh = np.meshgrid(x, y)
-
-				data_period.append(ncfile.variables[varname][0,:,:,:])
-			elif varname=='streamflow':
-				# Remove features that do not exist in v3 data
-				feature_idsa = np.array(ncfile.variables['feature_id'])
-				data_period.append(ncfile.variables[varname][:])
-			ncfile.close()
-		
-		# Convert to numpy array, average the period, delete old data copies
-		data_period = np.array(data_period)
-		data_event = np.average(data_period,axis=0)
-		if varname=='SOIL_M': data_event = np.ma.masked_where(data_event<0, data_event)
-		del data_period
+			# Find stream reaches that have the same value for all years.
+			# At least some of these cases appear to be lake locations.
+			# These reaches have no data on the maps and in the artifacts.
+			constant_reaches = get_constant_reaches(data_clim)
+			line_valid = line_present & ~constant_reaches[line_rows]
 
-		# Find stream reaches that have the same value for all years.
-		# At least some of these cases appear to be lake locations.
-		# These reaches will be removed prior to map creation, from variables that need it.
-		if varname=='streamflow':
-			reaches_to_delete = np.argwhere( np.min(data_clim,axis=0)==np.max(data_clim,axis=0) )
-
-		# There are 42 years in data_clim (for NWM v3.0) and 1 current event year. We add 1 to the numerator
-		# and denominator for the current year.
-		# Percentiles are calculated as rank/(n+1).
-		# In numerator, 1 is added to adjust rank for the data event.
-		# In denominator, an additional 1 is added for the data event.
+		# Save the percentiles behind the maps as a compact data artifact
 		if varname=='SOIL_M':
-			event_percentiles1 = ((data_clim<data_event).sum(axis=0)+1)/float(data_clim.shape[0]+2)
-			event_percentiles2 = ((data_clim<=data_event).sum(axis=0)+1)/float(data_clim.shape[0]+2)
-			event_percentiles = (event_percentiles1 + event_percentiles2)/2.
+			write_soil_m_percentiles(day_out_dir, YYYYMMDD, per, event_percentiles, oper_meta)
 		elif varname=='streamflow':
-			event_percentiles1 = ((data_clim<data_event).sum(axis=0)+1)/float(data_clim.shape[0]+2)
-			event_percentiles2 = ((data_clim<=data_event).sum(axis=0)+1)/float(data_clim.shape[0]+2)
-			event_percentiles = (event_percentiles1 + event_percentiles2)/2.
+			write_streamflow_percentiles(day_out_dir, YYYYMMDD, per, event_percentiles, feature_idsa, reach_ids, np.flatnonzero(constant_reaches))
 
 		###########################
 		### MAPPING BEGINS HERE ###
@@ -254,6 +342,10 @@ def create_products(config, YYYYMMDD, syear, dataset_type_dict):
 			p2 = pyproj.Proj(proj='latlong', datum='WGS84')
 			transformer = pyproj.Transformer.from_proj(p1,p2)
 			lon_mesh,lat_mesh = transformer.transform(x_mesh,y_mesh)
+			if config.tile_output:
+				grid_tiler = GridTiler(oper_meta['x'], oper_meta['y'], proj4_string, tile_bbox, tile_zooms, state_border_polygons)
+			if config.zonal_output and grid_zones is None:
+				grid_zones = [(layer['name'],) + get_grid_zones(config, layer, oper_meta['x'], oper_meta['y'], proj4_string) for layer in zone_layers]
 			
 			for varidx in range(varlen):
 				# Set up figure
@@ -290,38 +382,29 @@ def create_products(config, YYYYMMDD, syear, dataset_type_dict):
 				add_titlebox(title_str, ax, 5)
 
 				# Loop regions to take zoomed in snapshots
-				take_snapshots(ax, varname, varidx, per, day_out_dir, config.regions)
+				take_snapshots(ax, varname, varidx, per, day_out_dir, config.regions, map_palette)
 
 				# Close the figure
 				plt.close()
 
+				# Classify the layer for the tile pyramid and zonal statistics
+				classes = classify_percentiles(event_percentiles[:,varidx,:]*100., clevs_cmap)
+				if config.tile_output:
+					basename = get_output_basename(varname, varidx, per)
+					write_mbtiles(os.path.join(day_out_dir, f'{basename}.mbtiles'), grid_tiler.render(classes, tile_palette), basename, tile_bbox, tile_palette)
+				if config.zonal_output:
+					for layer_name, names, cells, zones, weights in grid_zones:
+						totals = zonal_class_totals(zones, classes.ravel()[cells], weights, len(names), nclasses)
+						zonal_rows += get_csv_rows(layer_name, names, totals, per, varidx)
+
 		# Plot streamflow percentiles
 		elif varname=='streamflow':
 			for varidx in range(varlen):
-				###############
-				### This section could be moved for efficiency or maybe incorporated into the streamflow_ids
-				###   precalculated file, but streamflow is only calculated with varlen of 1, so this only 
-				###   executes once. It is left here for code readability
-				
-				# Remove reaches that have constant value for all years. These were found above.
-				feature_idsa_clean = np.delete(feature_idsa,reaches_to_delete,axis=0)
-				event_percentiles_clean = np.delete(event_percentiles,reaches_to_delete,axis=0)
-				streamflow = {key: value for (key, value) in zip(feature_idsa_clean, event_percentiles_clean[:]*100.)}
-				
-				###############
-
-				# Place each stream shape into a key in flowline_relativestreamflow_color object where
-				#   each key is a color definition. The result is [color]: list of shapes. This allows
-				#   the shapes to quickly be added to the figure with the defined color. Adding individually
-				#   is extremely slow and adding them like in the original script results in all shapes
-				#   being the same color
-				flowline_relativestreamflow_color = {}
-				for line in shp_10k:
-					color = get_relative_streamflow_color(line['properties'],streamflow,clevs_cmap,ccols_cmap)
-					stream_shape = shape(line['geometry'])
-					if color not in flowline_relativestreamflow_color:
-						flowline_relativestreamflow_color[color] = []
-					flowline_relativestreamflow_color[color].append(stream_shape)
+				# Classify each flowline from its row in the streamflow arrays, for the map, tile pyramid and zonal statistics
+				classes = classify_percentiles(gather_line_percentiles(event_percentiles, line_rows, line_valid), clevs_cmap)
+
+				# Group stream shapes by color so each color can be added to the figure at once
+				flowline_relativestreamflow_color = group_flowlines_by_color(basemap['flowline_shapes'], classes, ccols_cmap)
 
 				# Set up figure
 				fig = plt.figure()
@@ -346,7 +429,20 @@ def create_products(config, YYYYMMDD, syear, dataset_type_dict):
 				add_colorbar(fig, clevs_cmap, cmap_data, SMALL_SIZE)
 
 				# Loop regions to take zoomed in snapshots
-				take_snapshots(ax, varname, varidx, per, day_out_dir, config.regions)
+				take_snapshots(ax, varname, varidx, per, day_out_dir, config.regions, map_palette)
 
 				# Close the figure
-				plt.close()
\ No newline at end of file
+				plt.close()
+
+				if config.tile_output:
+					basename = get_output_basename(varname, varidx, per)
+					write_mbtiles(os.path.join(day_out_dir, f'{basename}.mbtiles'), line_tiler.render(classes, tile_palette), basename, tile_bbox, tile_palette)
+				if config.zonal_output:
+					for layer_name, names, lines, zones, weights in reach_zones:
+						totals = zonal_class_totals(zones, classes[lines], weights, len(names), nclasses)
+						zonal_rows += get_csv_rows(layer_name, names, totals, per, varidx)
+
+	# Zone shares of each class, for every map of the product
+	if config.zonal_output:
+		units = 'km2' if varname=='SOIL_M' else 'km'
+		write_zonal_csv(os.path.join(day_out_dir, f'zonal-{varname}.csv'), get_csv_header(clevs_cmap, units), zonal_rows)
\ No newline at end of file
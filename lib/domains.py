@@ -0,0 +1,44 @@
+'''
+	Domains: the regions products are made for (see config.domains).
+
+	Each domain has its own file name prefix, bbox, reach list, map regions and products. The ingest stages
+	(lib/get_nwm_retro.py, lib/get_nwm_oper.py) are given the top-level config and download each CONUS file once,
+	writing every domain's subset from it into the shared retro_data_dir and oper_data_dir, where the prefix keeps
+	them apart. Everything after that (shapefiles, products, publishing) is run with a domain config: a copy of
+	config with the domain's values set.
+
+	The first domain uses the volume's existing layout. The directories in DOMAIN_PATHS of any other domain are
+	moved under writable_dir/domains/<name>, and its maps are published under S3_PREFIX/<name> (s3_subprefix).
+'''
+import os
+from types import SimpleNamespace
+
+from .utils import check_file_exists
+
+# Paths holding a domain's own files (reach list, flowlines, caches and output)
+DOMAIN_PATHS = ['reach_ids_path', 'nhdplus_dir', 'output_dir', 'rolling_state_dir', 'zonal_cache_dir', 'prepared_dir', 'critical_path_log']
+
+def get_domain_config(config, name):
+	attrs = {k: getattr(config, k) for k in dir(config) if not k.startswith('__')}
+	first = name == next(iter(config.domains))
+	if not first:
+		domain_dir = os.path.join(config.writable_dir, 'domains', name)
+		for k in DOMAIN_PATHS:
+			attrs[k] = domain_dir + attrs[k][len(config.writable_dir):]
+	attrs['domain'] = name
+	attrs['s3_subprefix'] = None if first else name
+	attrs.update(config.domains[name])
+	if '_' in attrs['domain_prefix']:
+		raise ValueError(f'domain_prefix of {name} cannot contain "_", it separates the prefix from the date in file names')
+	return SimpleNamespace(**attrs)
+
+def get_domain_configs(config):
+	return [get_domain_config(config, name) for name in config.domains]
+
+# Domains whose subset of a file type for thisdate is not in data_dir yet (lookback for operational files)
+def get_domains_missing(config, domain_configs, ftype, thisdate, data_dir, lookback=None):
+	return [d for d in domain_configs if not check_file_exists(d.domain_prefix, ftype, thisdate, config.hour, data_dir, lookback)]
+
+# [ll_lon, ll_lat, ur_lon, ur_lat] the domain's LDASOUT/land and CHRTOUT files are cropped to
+def get_domain_bbox(config):
+	return [config.ll_lon, config.ll_lat, config.ur_lon, config.ur_lat]
@@ -0,0 +1,105 @@
+'''
+	Regional flowline artifact: the NHDPlus flowlines drawn on the streamflow maps, in one compact numpy archive.
+
+	Building it from NHDPlus means a ~7GB download, so the artifact is versioned and kept in the R2 bucket under
+	pre/ (which R2Bucket.sync_bucket leaves alone). lib/get_shapefiles.py fetches it from there and only builds it
+	from NHDPlus when the bucket does not have it.
+
+	The archive holds:
+		comid        : COMID of each flowline
+		coords       : lon/lat of every vertex (float32)
+		part_offsets : start of each line part in coords
+		line_offsets : start of each flowline in the line parts
+		bbox, version : the region and FLOWLINE_VERSION
+
+	The row of each flowline in the streamflow arrays is worked out from comid by lib/reach_alignment.py.
+	Artifacts built before this layout also hold reach_index and reach_ids_key, which are not read.
+'''
+import os
+import numpy as np
+import fiona
+import shapely
+from shapely.geometry import shape, MultiLineString
+from botocore.exceptions import BotoCoreError, ClientError
+from boto3.exceptions import S3UploadFailedError
+
+from .percentile_artifacts import save_artifact
+from .r2_bucket import R2Bucket
+from .utils import record_transfer
+
+# Increase when the contents of the artifact or how it is built change, so older artifacts are not reused
+FLOWLINE_VERSION = 1
+BUCKET_PREFIX = 'pre/NHDPlus'
+
+def get_flowline_artifact_path(config):
+	return os.path.join(config.nhdplus_dir, f'flowlines-{config.flowline_region}-v{FLOWLINE_VERSION}.npz')
+
+def build_flowline_artifact(shp_path, path, bbox):
+	'''Write the flowlines of a cropped NHDFlowline_Network shapefile (see get_shapefiles.crop_and_simplify_nhdplus)
+		to path. Returns the number of flowlines.
+	'''
+	comids = []
+	lines = []
+	with fiona.open(shp_path, 'r') as shp:
+		for feat in shp:
+			line = shape(feat['geometry'])
+			comids.append(feat['properties']['COMID'])
+			# Every flowline is stored as a MultiLineString, so single and multi part lines share one layout
+			lines.append(line if line.geom_type == 'MultiLineString' else MultiLineString([line]))
+	comids = np.array(comids, dtype='int64')
+	_, coords, (part_offsets, line_offsets) = shapely.to_ragged_array(shapely.force_2d(np.array(lines, dtype=object)))
+	save_artifact(path,
+		comid=comids,
+		coords=coords.astype('float32'),
+		part_offsets=part_offsets.astype('int64'),
+		line_offsets=line_offsets.astype('int64'),
+		bbox=np.array(bbox, dtype='float64'),
+		version=FLOWLINE_VERSION
+	)
+	return len(comids)
+
+def read_flowline_artifact(path):
+	'''Returns the artifact's comid array, and its flowlines as an array of shapely lines.
+		Single part flowlines are returned as LineStrings, as read from the NHDPlus shapefile.
+	'''
+	with np.load(path) as artifact:
+		if int(artifact['version']) != FLOWLINE_VERSION:
+			raise ValueError(f'{path} is version {int(artifact["version"])}, expected {FLOWLINE_VERSION}')
+		lines = shapely.from_ragged_array(shapely.GeometryType.MULTILINESTRING, artifact['coords'].astype('float64'),
+			(artifact['part_offsets'], artifact['line_offsets']))
+		single = shapely.get_num_geometries(lines) == 1
+		lines[single] = shapely.get_geometry(lines[single], 0)
+		return {'comid': artifact['comid'], 'lines': lines}
+
+def get_r2_bucket(config):
+	return R2Bucket(
+		os.environ['R2_BUCKET_NAME'],
+		os.environ['CF_ACCOUNT_ID'],
+		os.environ['R2_ACCESS_KEY_ID'],
+		os.environ['R2_SECRET_ACCESS_KEY'],
+		endpoint_url=config.r2_endpoint_url
+	)
+
+# Download the artifact from the R2 bucket. Returns False when the bucket is not configured or does not have it.
+def fetch_flowline_artifact(config, path):
+	key = f'{BUCKET_PREFIX}/{os.path.basename(path)}'
+	part_path = f'{path}.part'
+	try:
+		get_r2_bucket(config).bucket.download_file(key, part_path)
+	except (KeyError, BotoCoreError, ClientError) as e:
+		print(f'flowline artifact {key} not fetched from R2 bucket: {e!r}')
+		if os.path.exists(part_path): os.remove(part_path)
+		return False
+	os.replace(part_path, path)
+	record_transfer('download', os.path.getsize(path))
+	return True
+
+# Upload a newly built artifact, so other volumes can fetch it instead of building it
+def publish_flowline_artifact(config, path):
+	key = f'{BUCKET_PREFIX}/{os.path.basename(path)}'
+	try:
+		get_r2_bucket(config).upload_file(path, key)
+	except (KeyError, BotoCoreError, ClientError, S3UploadFailedError) as e:
+		print(f'flowline artifact {key} not uploaded to R2 bucket: {e!r}')
+		return False
+	return True
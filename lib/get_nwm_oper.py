@@ -5,70 +5,67 @@
 		'channel' files (contains streamflow), and
 		'land' files (contains soil moisture).
 	The files for 12Z become available after 9:30 AM ET.
+	Each file is downloaded once and subset for every domain in config.domains (see lib/domains.py).
 
 	orig bnb2, updated to python3 and NWM v3 be99
 '''
 import sys
 import os
 import datetime
+import requests
 import xarray as xr
 import numpy as np
 
-from .utils import download_nwm, remove_nwm, increment_date, check_file_exists, subset_soil_m_data
+from .utils import download_nwm, remove_nwm, increment_date, get_subset_file_name, get_subset_file_date, subset_soil_m_domains, record_transfer
+from .domains import get_domain_configs, get_domain_bbox, get_domains_missing
 from .r2_bucket import R2Bucket
+from .coordination import lease, get_workspace, other_runs_active
+
+# Download an operational file into work_dir. Returns the file name, or None when NOMADS does not have it
+#   (not published yet, or no longer kept). Missing dates are reported once all downloads have been tried.
+def download_oper_file(config, ftype, YYYYMMDD, work_dir):
+	try:
+		return download_nwm(ftype,YYYYMMDD,hour=config.hour,lookback=config.lookback,destdir=work_dir,nomads_url=config.nomads_url)
+	except requests.exceptions.RequestException as e:
+		print(f'{ftype} file for {YYYYMMDD} could not be downloaded: {e}')
+		return None
+
+def oper_files_exist(config, domain_configs, thisdate):
+	return not get_domains_missing(config, domain_configs, 'channel_rt', thisdate, config.oper_data_dir, config.lookback) and not get_domains_missing(config, domain_configs, 'land', thisdate, config.oper_data_dir, config.lookback)
 
 def get_nwm_oper(config, YYYYMMDD):
+	domain_configs = get_domain_configs(config)
+
 	# Get yesterday's date
 	dt_yesterday = datetime.datetime.strptime(YYYYMMDD,'%Y%m%d') - datetime.timedelta(days=1)
 	yesterdaydate = dt_yesterday.strftime('%Y%m%d')
 
 	# Check if yesterday and today files already exist, use this to determine which days we need to fetch
-	yesterdayExists = check_file_exists('channel_rt', yesterdaydate, config.hour, config.oper_data_dir, config.lookback) and check_file_exists('land', yesterdaydate, config.hour, config.oper_data_dir, config.lookback)
-	todayExists = check_file_exists('channel_rt', YYYYMMDD, config.hour, config.oper_data_dir, config.lookback) and check_file_exists('land', YYYYMMDD, config.hour, config.oper_data_dir, config.lookback)
+	yesterdayExists = oper_files_exist(config, domain_configs, yesterdaydate)
+	todayExists = oper_files_exist(config, domain_configs, YYYYMMDD)
 	if yesterdayExists and todayExists: return
 
 	sdate = YYYYMMDD if yesterdayExists else yesterdaydate
 	edate = yesterdaydate if todayExists else YYYYMMDD
 	thisdate = sdate
 
-	# Load streamflow ids for cropping CHANNEL data
-	streamflow_ids = np.load(os.path.join(config.writable_dir, 'streamflow_ids.npy'))
+	# Load each domain's streamflow ids for cropping CHANNEL data
+	streamflow_ids = {d.domain: np.load(d.reach_ids_path) for d in domain_configs}
 
+	# Each date is fetched under a lease, so a run that overlaps another waits for it instead of fetching the same files
+	work_dir = get_workspace(config)
 	while thisdate <= edate:
-		######################################
-		### CHANNEL file does not contain auxiliary coordinates,
-		###   so it is cropped using xarray and streamflow feature ids from a precalculated file.
-		######################################
-		ncfilename = download_nwm('channel_rt',thisdate,hour=config.hour,lookback=config.lookback,destdir=config.temp_dir)
-		ncfilename_out = f'NEUS_{thisdate}_{ncfilename}'
-		uncropped = xr.open_dataset(os.path.join(config.temp_dir, ncfilename), engine='netcdf4')
-		cropped = uncropped.where(uncropped['feature_id'].isin(streamflow_ids), drop=True)[['streamflow']]
-		cropped.to_netcdf(os.path.join(config.oper_data_dir, ncfilename_out))
-		remove_nwm('channel_rt',hour=config.hour,lookback=config.lookback,locdir=config.temp_dir)
-
-		######################################
-		### SUBSET LAND FILE (retain SOIL_M for NEUS)
-		### Subsetting this file requires transforming known lat/lon boundaries of region
-		### of interest into the x/y coordinates specified by the projection. Once these
-		### regional boundaries are known in x/y coordinates, grid indices of the regional
-		### boundaries are obtained. We can then subset this dataset using ncks with the
-		### following options:
-		### 1) variables to retain: -v SOIL_M
-		### 2) region of interest: -d x,sw_x_idx,ne_x_idx -d y,sw_y_idx,ne_y_idx
-		######################################
-		ncfilename = download_nwm('land',thisdate,hour=config.hour,lookback=config.lookback,destdir=config.temp_dir)
-		ncfilename_out = f'NEUS_{thisdate}_{ncfilename}'
-		subset_soil_m_data(ncfilename, config.temp_dir, ncfilename_out, config.oper_data_dir, config.ll_lon, config.ll_lat, config.ur_lon, config.ur_lat)
-		remove_nwm('land',hour=config.hour,lookback=config.lookback,locdir=config.temp_dir)
+		with lease(config, 'oper', thisdate):
+			get_oper_date(config, domain_configs, thisdate, streamflow_ids, work_dir)
 
 		# Increment thisdate
 		thisdate = increment_date(thisdate)
 
 	# Make sure both files now exist
-	yesterdayExists = check_file_exists('channel_rt', yesterdaydate, config.hour, config.oper_data_dir, config.lookback) and check_file_exists('land', yesterdaydate, config.hour, config.oper_data_dir, config.lookback)
-	todayExists = check_file_exists('channel_rt', YYYYMMDD, config.hour, config.oper_data_dir, config.lookback) and check_file_exists('land', YYYYMMDD, config.hour, config.oper_data_dir, config.lookback)
+	yesterdayExists = oper_files_exist(config, domain_configs, yesterdaydate)
+	todayExists = oper_files_exist(config, domain_configs, YYYYMMDD)
 	dts = None
-	if not yesterdaydate and not todayExists:
+	if not yesterdayExists and not todayExists:
 		dts = f'{YYYYMMDD} and {yesterdaydate}'
 	elif not yesterdayExists:
 		dts = yesterdaydate
@@ -76,15 +73,61 @@ def get_nwm_oper(config, YYYYMMDD):
 		dts = YYYYMMDD
 
 	if dts: sys.exit(f'ERROR: files for {dts} were not downloaded')
-
+	archive_nwm_oper(config, YYYYMMDD)
+
+# Download the files of one date and subset them for the domains that do not have them yet. Subsets are written
+#   in work_dir and then moved into oper_data_dir, so other runs never read (or archive) a partly written file.
+#   streamflow_ids : {domain name: feature ids of its reaches}
+def get_oper_date(config, domain_configs, thisdate, streamflow_ids, work_dir):
+	######################################
+	### CHANNEL file does not contain auxiliary coordinates,
+	###   so it is cropped using xarray and streamflow feature ids from a precalculated file.
+	###   Streamflow is read once, and each domain's reaches are taken from it.
+	######################################
+	domains_missing = get_domains_missing(config, domain_configs, 'channel_rt', thisdate, config.oper_data_dir, config.lookback)
+	if domains_missing:
+		ncfilename = download_oper_file(config, 'channel_rt', thisdate, work_dir)
+		if ncfilename:
+			with xr.open_dataset(os.path.join(work_dir, ncfilename), engine='netcdf4') as uncropped:
+				streamflow = uncropped[['streamflow']].load()
+			for d in domains_missing:
+				ncfilename_out = f'{d.domain_prefix}_{thisdate}_{ncfilename}'
+				cropped = streamflow.where(streamflow['feature_id'].isin(streamflow_ids[d.domain]), drop=True)
+				cropped.to_netcdf(os.path.join(work_dir, ncfilename_out))
+				os.replace(os.path.join(work_dir, ncfilename_out), os.path.join(config.oper_data_dir, ncfilename_out))
+			remove_nwm('channel_rt',hour=config.hour,lookback=config.lookback,locdir=work_dir)
+
+	######################################
+	### SUBSET LAND FILE (retain SOIL_M for each domain)
+	### Subsetting this file requires transforming known lat/lon boundaries of region
+	### of interest into the x/y coordinates specified by the projection. Once these
+	### regional boundaries are known in x/y coordinates, grid indices of the regional
+	### boundaries are obtained. We can then subset this dataset using ncks with the
+	### following options:
+	### 1) variables to retain: -v SOIL_M
+	### 2) region of interest: -d x,sw_x_idx,ne_x_idx -d y,sw_y_idx,ne_y_idx
+	######################################
+	domains_missing = get_domains_missing(config, domain_configs, 'land', thisdate, config.oper_data_dir, config.lookback)
+	if domains_missing:
+		ncfilename = download_oper_file(config, 'land', thisdate, work_dir)
+		if ncfilename:
+			ncfilenames_out = [f'{d.domain_prefix}_{thisdate}_{ncfilename}' for d in domains_missing]
+			subset_soil_m_domains(ncfilename, work_dir, [(os.path.join(work_dir, f), get_domain_bbox(d)) for f, d in zip(ncfilenames_out, domains_missing)])
+			for ncfilename_out in ncfilenames_out:
+				os.replace(os.path.join(work_dir, ncfilename_out), os.path.join(config.oper_data_dir, ncfilename_out))
+			remove_nwm('land',hour=config.hour,lookback=config.lookback,locdir=work_dir)
+
+# Copy local files to the R2 archive, and remove those outside the lookback window of YYYYMMDD
+def archive_nwm_oper(config, YYYYMMDD):
 	# Get list of files currently in R2 bucket
 	r2 = R2Bucket(
 		os.environ['R2_BUCKET_NAME'],
 		os.environ['CF_ACCOUNT_ID'],
 		os.environ['R2_ACCESS_KEY_ID'],
-		os.environ['R2_SECRET_ACCESS_KEY']
+		os.environ['R2_SECRET_ACCESS_KEY'],
+		endpoint_url=config.r2_endpoint_url
 	)
-	bucket_files = [obj.key for obj in r2.bucket.objects.all()]
+	bucket_files = set(obj.key for obj in r2.bucket.objects.all())
 
 	# Construct list of dates to keep locally. Each date in list is of the format YYYYMMDD.
 	start_YYYYMMDD = (datetime.datetime.strptime(YYYYMMDD,'%Y%m%d') + datetime.timedelta(days=2)).strftime('%Y%m%d')
@@ -94,12 +137,46 @@ def get_nwm_oper(config, YYYYMMDD):
 	]
 
 	# Dates that are not in the range of interest are moved to R2 bucket in case they are needed later.
+	others_active = other_runs_active(config)
 	local_files = os.listdir(config.oper_data_dir)
 	for f in local_files:
-		file_YYYYMMDD = f[5:13]
+		file_YYYYMMDD = get_subset_file_date(f)
+		# Only subset files are archived and rotated
+		if file_YYYYMMDD is None: continue
 		f_path = os.path.join(config.oper_data_dir,f)
 
 		if f not in bucket_files:
-			r2.bucket.upload_file(f_path, f)
-		if file_YYYYMMDD not in dates_to_keep and os.path.exists(f_path):
-			os.remove(f_path)
\ No newline at end of file
+			r2.upload_file(f_path, f)
+		# Files are only removed locally when no other run (e.g. a backfill of older dates) may be reading them
+		if file_YYYYMMDD not in dates_to_keep and os.path.exists(f_path) and not others_active:
+			os.remove(f_path)
+
+# Copy archived operational files for past dates back from the R2 bucket when they are not available locally.
+#   Returns the dates for which files could not be found.
+def restore_nwm_oper(config, dates):
+	r2 = R2Bucket(
+		os.environ['R2_BUCKET_NAME'],
+		os.environ['CF_ACCOUNT_ID'],
+		os.environ['R2_ACCESS_KEY_ID'],
+		os.environ['R2_SECRET_ACCESS_KEY'],
+		endpoint_url=config.r2_endpoint_url
+	)
+	bucket_files = set(obj.key for obj in r2.bucket.objects.all())
+	local_files = set(os.listdir(config.oper_data_dir))
+
+	domain_configs = get_domain_configs(config)
+	work_dir = get_workspace(config)
+	missing_dates = []
+	for thisdate in dates:
+		# Files of every domain
+		fnames = [get_subset_file_name(d.domain_prefix, ftype, thisdate, config.hour, config.lookback) for d in domain_configs for ftype in ['channel_rt', 'land']]
+		for fname in fnames:
+			if fname in local_files: continue
+			if fname in bucket_files:
+				# Downloaded into the workspace first, so other runs never read a partial file
+				r2.bucket.download_file(fname, os.path.join(work_dir, fname))
+				os.replace(os.path.join(work_dir, fname), os.path.join(config.oper_data_dir, fname))
+				record_transfer('download', os.path.getsize(os.path.join(config.oper_data_dir, fname)))
+			elif thisdate not in missing_dates:
+				missing_dates.append(thisdate)
+	return missing_dates
\ No newline at end of file
@@ -3,15 +3,23 @@
 
 	Download NWM v3 retrospective model (1979-2020) for specified variable and dates.
 	A rolling window of data is maintained, specified by YYYYMMDD and numdays_in_period.
+	Each file is downloaded once and subset for every domain in config.domains (see lib/domains.py).
 
 	orig bnb2, updated to python3 and NWM v3 be99
 '''
 import os
 import datetime
 
-from .utils import download_nwm, remove_nwm, increment_date, check_file_exists, subset_soil_m_data
+from .utils import download_nwm, remove_nwm, increment_date, get_subset_file_date, subset_soil_m_domains, subset_streamflow_domains
+from .domains import get_domain_configs, get_domain_bbox, get_domains_missing
+from .coordination import lease, get_workspace, other_runs_active
+
+# numdays overrides config.numdays_in_period, e.g. so that a batch run can keep the window for a whole date range
+# rotate=False keeps saved files outside the window, e.g. so that a batch run leaves the daily run's window in place
+def get_nwm_retro(config, YYYYMMDD, syear, numdays=None, rotate=True):
+	if numdays is None: numdays = config.numdays_in_period
+	domain_configs = get_domain_configs(config)
 
-def get_nwm_retro(config, YYYYMMDD, syear):
 	# First year of retro output does not include beginning of year.
 	sdate = f'{syear}0101'
 	# As of 2022, NWM restrospective output only available through 2020
@@ -23,18 +31,22 @@ def get_nwm_retro(config, YYYYMMDD, syear):
 	start_YYYYMMDD = (datetime.datetime.strptime('2016'+YYYYMMDD[-4:],'%Y%m%d') + datetime.timedelta(days=2)).strftime('%Y%m%d')
 	dates_to_get = [
 		(datetime.datetime.strptime(start_YYYYMMDD,'%Y%m%d') - datetime.timedelta(days=idy)).strftime('%m%d')
-		for idy in range(config.numdays_in_period)
+		for idy in range(numdays)
 	]
 
 	# Remove files from output directory that are not in the date range of interest.
 	# These files are large, and rotating the saved files will save space.
-	savedFiles = os.listdir(config.retro_data_dir)
-	for f in savedFiles:
-		MMDD = f[9:13]
-		f_path = os.path.join(config.retro_data_dir,f)
-		if MMDD not in dates_to_get and os.path.exists(f_path): os.remove(f_path)
+	# Rotation is left for a later run while other runs are active, as they may use a different window.
+	if rotate and not other_runs_active(config):
+		savedFiles = os.listdir(config.retro_data_dir)
+		for f in savedFiles:
+			if get_subset_file_date(f) is None: continue
+			MMDD = get_subset_file_date(f)[4:]
+			f_path = os.path.join(config.retro_data_dir,f)
+			if MMDD not in dates_to_get and os.path.exists(f_path): os.remove(f_path)
 
-	# Loop through days between start and end dates
+	# Loop through days between start and end dates, collecting the dates that still need to be downloaded
+	dates_missing = []
 	thisdate = sdate
 	while thisdate <= edate:
 		# Check if we should be downloading this date. If not, continue to next date.
@@ -42,44 +54,59 @@ def get_nwm_retro(config, YYYYMMDD, syear):
 		# 2) skip date if the file already exists in the output directory (previously downloaded)
 		# # NOTE: these checks are done separately because checking date first is much faster
 		validDate = thisdate[-4:] in dates_to_get
-		if not validDate: 
-			thisdate = increment_date(thisdate)
-			continue
-		CHRTOUT_fileExists = check_file_exists('CHRTOUT',thisdate,hour=config.hour,destdir=config.retro_data_dir)
-		LDASOUT_fileExists = check_file_exists('LDASOUT',thisdate,hour=config.hour,destdir=config.retro_data_dir)
-		fileExists = CHRTOUT_fileExists and LDASOUT_fileExists
-		if fileExists:
-			thisdate = increment_date(thisdate)
-			continue
+		if validDate and not retro_files_exist(config, domain_configs, thisdate):
+			dates_missing.append(thisdate)
+		thisdate = increment_date(thisdate)
+
+	# Dates that another run is downloading are skipped at first, so overlapping runs split the work.
+	# They are then waited on, and only downloaded here if the other run did not finish them.
+	work_dir = get_workspace(config)
+	dates_busy = []
+	for thisdate in dates_missing:
+		with lease(config, 'retro', thisdate, wait=False) as acquired:
+			if acquired: get_retro_date(config, domain_configs, thisdate, work_dir)
+			else: dates_busy.append(thisdate)
+	for thisdate in dates_busy:
+		with lease(config, 'retro', thisdate):
+			get_retro_date(config, domain_configs, thisdate, work_dir)
 
-		######################################
-		### SUBSET CHRTOUT FILE (retain streamflow variable for NEUS)
-		### The file for CHRTOUT_DOMAIN1 contain auxiliary coordinates. We can subset this type
-		### of file by using ncks with the following options:
-		### 1) the variables to retain: -v streamflow
-		### 2) the extreme lat/lon for region of interest: -X ll_lon,ur_lon,ll_lat,ur_lat
-		######################################
-		ncfilename = download_nwm('CHRTOUT',thisdate,hour=config.hour,destdir=config.temp_dir)
-		ncfilename_out = f'NEUS_{ncfilename}'
-		subset_region = f'-X {str(config.ll_lon)},{str(config.ur_lon)},{str(config.ll_lat)},{str(config.ur_lat)}'
-		crop_command = f'ncks {subset_region} -v streamflow {os.path.join(config.temp_dir, ncfilename)} -O {os.path.join(config.retro_data_dir, ncfilename_out)}'
-		os.system(crop_command)
-		remove_nwm('CHRTOUT',day=thisdate,hour=config.hour,locdir=config.temp_dir)
+def retro_files_exist(config, domain_configs, thisdate):
+	return not get_domains_missing(config, domain_configs, 'CHRTOUT', thisdate, config.retro_data_dir) and not get_domains_missing(config, domain_configs, 'LDASOUT', thisdate, config.retro_data_dir)
 
-		######################################
-		### SUBSET LDASOUT FILE (retain SOIL_M variable for NEUS)
-		### Subsetting this file requires transforming known lat/lon boundaries of region
-		### of interest into the x/y coordinates specified by the projection. Once these
-		### regional boundaries are known in x/y coordinates, grid indices of the regional
-		### boundaries are obtained. We can then subset this dataset using ncks with the
-		### following options:
-		### 1) variables to retain: -v SOIL_M
-		### 2) region of interest: -d x,sw_x_idx,ne_x_idx -d y,sw_y_idx,ne_y_idx
-		######################################
-		ncfilename = download_nwm('LDASOUT',thisdate,hour=config.hour,destdir=config.temp_dir)
-		ncfilename_out = f'NEUS_{ncfilename}'
-		subset_soil_m_data(ncfilename, config.temp_dir, ncfilename_out, config.retro_data_dir, config.ll_lon, config.ll_lat, config.ur_lon, config.ur_lat)
-		remove_nwm('LDASOUT',day=thisdate,hour=config.hour,locdir=config.temp_dir)
+# Download the files of one date and subset them for the domains that do not have them yet. Subsets are written
+#   in work_dir and then moved into retro_data_dir, so other runs never read a partly written file.
+def get_retro_date(config, domain_configs, thisdate, work_dir):
+	######################################
+	### SUBSET CHRTOUT FILE (retain streamflow variable for each domain)
+	### The file for CHRTOUT_DOMAIN1 contain auxiliary coordinates. We can subset this type
+	### of file by using ncks with the following options:
+	### 1) the variables to retain: -v streamflow
+	### 2) the extreme lat/lon for region of interest: -X ll_lon,ur_lon,ll_lat,ur_lat
+	######################################
+	domains_missing = get_domains_missing(config, domain_configs, 'CHRTOUT', thisdate, config.retro_data_dir)
+	if domains_missing:
+		ncfilename = download_nwm('CHRTOUT',thisdate,hour=config.hour,destdir=work_dir,retro_bucket=config.nwm_retro_bucket,retro_endpoint_url=config.nwm_retro_endpoint_url)
+		ncfilenames_out = [f'{d.domain_prefix}_{ncfilename}' for d in domains_missing]
+		subset_streamflow_domains(ncfilename, work_dir, [(os.path.join(work_dir, f), get_domain_bbox(d)) for f, d in zip(ncfilenames_out, domains_missing)])
+		for ncfilename_out in ncfilenames_out:
+			os.replace(os.path.join(work_dir, ncfilename_out), os.path.join(config.retro_data_dir, ncfilename_out))
+		remove_nwm('CHRTOUT',day=thisdate,hour=config.hour,locdir=work_dir)
 
-		# Increment thisdate
-		thisdate = increment_date(thisdate)
\ No newline at end of file
+	######################################
+	### SUBSET LDASOUT FILE (retain SOIL_M variable for each domain)
+	### Subsetting this file requires transforming known lat/lon boundaries of region
+	### of interest into the x/y coordinates specified by the projection. Once these
+	### regional boundaries are known in x/y coordinates, grid indices of the regional
+	### boundaries are obtained. We can then subset this dataset using ncks with the
+	### following options:
+	### 1) variables to retain: -v SOIL_M
+	### 2) region of interest: -d x,sw_x_idx,ne_x_idx -d y,sw_y_idx,ne_y_idx
+	######################################
+	domains_missing = get_domains_missing(config, domain_configs, 'LDASOUT', thisdate, config.retro_data_dir)
+	if domains_missing:
+		ncfilename = download_nwm('LDASOUT',thisdate,hour=config.hour,destdir=work_dir,retro_bucket=config.nwm_retro_bucket,retro_endpoint_url=config.nwm_retro_endpoint_url)
+		ncfilenames_out = [f'{d.domain_prefix}_{ncfilename}' for d in domains_missing]
+		subset_soil_m_domains(ncfilename, work_dir, [(os.path.join(work_dir, f), get_domain_bbox(d)) for f, d in zip(ncfilenames_out, domains_missing)])
+		for ncfilename_out in ncfilenames_out:
+			os.replace(os.path.join(work_dir, ncfilename_out), os.path.join(config.retro_data_dir, ncfilename_out))
+		remove_nwm('LDASOUT',day=thisdate,hour=config.hour,locdir=work_dir)
@@ -5,11 +5,10 @@
 	'us_shapefile' - for political boundaries
 	'NHDPlus' - for stream reach info/IDs
 
-	NOTE: National NHDPlus geodatabase files are very large (~25GB), so they are deleted automatically to save on storage space.
-	These items include:
-		'NHDPlus/NHDPlusNationalData' directory and contents
-		'NHDPlus/NHDPlusV21_NationalData_Seamless_Geodatabase_Lower48_07.7z'
-	One cropped set of shapefiles is retained within the 'NHDPlus' directory for NWM drought index maps.
+	The flowlines drawn on the maps are kept in 'NHDPlus' as one regional flowline artifact (see lib/flowlines.py).
+	It is fetched from the R2 bucket when available. Otherwise it is built from the national NHDPlus geodatabase,
+	which is streamed to disk, and only the flowline table is extracted from it. The archive and the extracted table
+	are deleted once the cropped flowlines are written, and a newly built artifact is uploaded to the R2 bucket.
 
 	For details on NHDPlus usage:
 	http://www.horizon-systems.com/NHDPlusData/NHDPlusV21/Data/NationalData/0Release_Notes_NationalData_Seamless_GeoDatabase.pdf
@@ -18,7 +17,15 @@
 '''
 import os
 import shutil
-import requests
+import subprocess
+import fiona
+
+from .utils import download_file
+from .flowlines import get_flowline_artifact_path, build_flowline_artifact, fetch_flowline_artifact, publish_flowline_artifact
+
+NHDPLUS_URL = 'https://dmap-data-commons-ow.s3.amazonaws.com/NHDPlusV21/Data/NationalData/NHDPlusV21_NationalData_Seamless_Geodatabase_Lower48_07.7z'
+NHDPLUS_GDB = 'NHDPlusNationalData/NHDPlusV21_National_Seamless_Flattened_Lower48.gdb'
+NHDPLUS_LAYER = 'NHDFlowline_Network'
 
 # Return boolean indicating existance of shapefile
 def check_for_shapefiles(fnames, local_dir):
@@ -31,21 +38,54 @@ def check_for_shapefiles(fnames, local_dir):
 def download_shapefiles(file_group_dict, local_dir):
 	source_url = file_group_dict['source']
 	for fname in file_group_dict['source_file_names']:
-		url = source_url + fname
-		r = requests.get(url, allow_redirects=True)
-		open(os.path.join(local_dir, fname), 'wb').write(r.content)
-		
-		# Extract if necessary
-		ext = fname.split('.')[-1]
-		if ext=='7z':
-			cmd = f'7za x {local_dir}/{fname} -o{local_dir}/.'
-			os.system(cmd)
+		download_file(source_url + fname, os.path.join(local_dir, fname))
+
+# Extract files matching patterns (paths inside the archive, wildcards allowed) from a 7z archive
+def extract_from_7z(archive_path, patterns, out_dir):
+	subprocess.run(['7za', 'x', archive_path, f'-o{out_dir}', '-y'] + patterns, check=True, stdout=subprocess.DEVNULL)
+
+# Extract a single table of a file geodatabase from a 7z archive, instead of the whole geodatabase.
+#   A table's files are named after its row in the GDB_SystemCatalog table (a00000001), so the system tables are
+#   extracted first to look up the name.
+def extract_gdb_layer(archive_path, gdb_path, layer, out_dir):
+	system_files = [f'{gdb_path}/a0000000{i}.*' for i in range(1, 5)] + [f'{gdb_path}/gdb', f'{gdb_path}/timestamps']
+	extract_from_7z(archive_path, system_files, out_dir)
+	with fiona.open(os.path.join(out_dir, gdb_path), layer='GDB_SystemCatalog', LIST_ALL_TABLES='YES') as catalog:
+		table_ids = [int(row.id) for row in catalog if row['properties']['Name'] == layer]
+	if not table_ids:
+		raise ValueError(f'{layer} not found in {gdb_path}')
+	extract_from_7z(archive_path, [f'{gdb_path}/a{table_ids[0]:08x}.*'], out_dir)
 
 # Reduce resolution and geographic bounds of NHDPlus stream geometries, this greatly saves on data storage needs
 def crop_and_simplify_nhdplus(config):
-	bbox_string = ' '.join([str(v) for v in config.regions['ne']])
-	cmd = f'ogr2ogr -simplify 0.001 -f "ESRI Shapefile" -sql "SELECT COMID, TotDASqKm FROM NHDFlowline_Network WHERE TotDASqKm>0.0" -spat {bbox_string} {config.nhdplus_dir}/NHDFlowline_Network.shp {config.nhdplus_dir}/NHDPlusNationalData/NHDPlusV21_National_Seamless_Flattened_Lower48.gdb'
-	os.system(cmd)
+	bbox_string = ' '.join([str(v) for v in config.regions[config.flowline_region]])
+	cmd = f'ogr2ogr -simplify 0.001 -f "ESRI Shapefile" -sql "SELECT COMID, TotDASqKm FROM {NHDPLUS_LAYER} WHERE TotDASqKm>0.0" -spat {bbox_string} {config.nhdplus_dir}/{NHDPLUS_LAYER}.shp {config.nhdplus_dir}/{NHDPLUS_GDB}'
+	subprocess.run(cmd, shell=True, check=True)
+
+# Build the cropped flowline shapefile from the national NHDPlus geodatabase
+def download_nhdplus(config):
+	archive_path = os.path.join(config.nhdplus_dir, os.path.basename(NHDPLUS_URL))
+	download_file(NHDPLUS_URL, archive_path)
+	try:
+		extract_gdb_layer(archive_path, NHDPLUS_GDB, NHDPLUS_LAYER, config.nhdplus_dir)
+	finally:
+		os.remove(archive_path)
+	try:
+		crop_and_simplify_nhdplus(config)
+	finally:
+		shutil.rmtree(os.path.join(config.nhdplus_dir, NHDPLUS_GDB.split('/')[0]))
+
+# Get the regional flowline artifact: kept on the volume, fetched from the R2 bucket, or built from NHDPlus
+def get_flowlines(config):
+	artifact_path = get_flowline_artifact_path(config)
+	if not os.path.exists(artifact_path) and not fetch_flowline_artifact(config, artifact_path):
+		# Volumes set up before the artifact existed already have the cropped shapefile
+		shp_path = os.path.join(config.nhdplus_dir, f'{NHDPLUS_LAYER}.shp')
+		if not os.path.exists(shp_path):
+			download_nhdplus(config)
+		nlines = build_flowline_artifact(shp_path, artifact_path, config.regions[config.flowline_region])
+		print(f'built flowline artifact {os.path.basename(artifact_path)} with {nlines} flowlines')
+		publish_flowline_artifact(config, artifact_path)
 
 # Delete any files that are not needed for creating the maps, this greatly saves on data storage needs
 def clean_up(file_group_dict, local_dir):
@@ -66,12 +106,6 @@ def get_shapefiles(config):
 			'source_file_names':[ 'st99_d00.dbf', 'st99_d00.shp', 'st99_d00.shx' ],
 			'check_file_names':[ 'st99_d00.dbf', 'st99_d00.shp', 'st99_d00.shx' ],
 			'remove_files': []
-		},
-		config.nhdplus_dir:{
-			'source': 'https://dmap-data-commons-ow.s3.amazonaws.com/NHDPlusV21/Data/NationalData/',
-			'source_file_names':[ 'NHDPlusV21_NationalData_Seamless_Geodatabase_Lower48_07.7z' ],
-			'check_file_names':[ 'NHDFlowline_Network.dbf', 'NHDFlowline_Network.prj', 'NHDFlowline_Network.shp', 'NHDFlowline_Network.shx' ],
-			'remove_files': [ 'NHDPlusNationalData', 'NHDPlusV21_NationalData_Seamless_Geodatabase_Lower48_07.7z' ]
 		}
 	}
 
@@ -85,9 +119,8 @@ def get_shapefiles(config):
 			# Get new shapefiles
 			download_shapefiles(file_group_dict, local_dir)
 
-			# If they are NHDPlus stream shapefiles then reduce them
-			if local_dir == config.nhdplus_dir:
-				crop_and_simplify_nhdplus(config)
-
 			# Delete any unnecessary files
-			clean_up(file_group_dict, local_dir)
\ No newline at end of file
+			clean_up(file_group_dict, local_dir)
+
+	# Stream reaches drawn on the streamflow maps
+	get_flowlines(config)
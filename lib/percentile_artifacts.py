@@ -0,0 +1,80 @@
+'''
+	Compact percentile data artifacts.
+
+	Alongside the PNG maps, each run writes the percentiles behind them to the day's output directory as
+	compressed numpy archives, so consumers can use the values without re-deriving them from the images:
+
+	SOIL_M-{per}day.npz      'percentile' : uint8 (layer, y, x) grid, with the grid's 'x', 'y' and 'proj4'
+	streamflow-{per}day.npz  'percentile' : uint8 array in the reach order of streamflow-reaches.npz
+	streamflow-reaches.npz   'feature_id' : NWM feature ids (COMIDs) of the reaches, from streamflow_ids.npy
+	published.json           written by main.py once the day's maps have been published, marking its artifacts complete
+
+	Percentiles are stored as whole numbers 0-100, rounded down so that every value falls in the same
+	clevs_cmap class as on the maps. 255 marks cells and reaches with no data (masked soil moisture, reaches
+	missing from the operational file, and reaches removed from the maps for having a constant climatology).
+'''
+import os
+import json
+import datetime
+import numpy as np
+
+from .utils import percentiles_to_uint8
+
+REACH_ORDER_FILENAME = 'streamflow-reaches.npz'
+PUBLISHED_MARKER_FILENAME = 'published.json'
+
+# Written under a temporary name and moved into place, so readers (lib/query_service.py) never see a partial file.
+#   The temporary name includes the process id, as caches built with this (e.g. lib/flowlines.py) may be written by overlapping runs.
+def save_artifact(path, **arrays):
+	tmp_path = f'{path}.{os.getpid()}.tmp.npz'
+	np.savez_compressed(tmp_path, **arrays)
+	os.replace(tmp_path, path)
+
+def get_artifact_path(out_dir, varname, per):
+	return os.path.join(out_dir, f'{varname}-{str(per)}day.npz')
+
+# event_percentiles : (y, layer, x) percentiles (0-1) as calculated in create_products
+def write_soil_m_percentiles(out_dir, YYYYMMDD, per, event_percentiles, oper_meta):
+	percentile = percentiles_to_uint8(np.ma.transpose(event_percentiles, (1, 0, 2)) * 100.)
+	path = get_artifact_path(out_dir, 'SOIL_M', per)
+	save_artifact(path, percentile=percentile, x=np.ma.getdata(oper_meta['x']), y=np.ma.getdata(oper_meta['y']),
+		proj4=oper_meta['proj4'], date=YYYYMMDD, per=per)
+	return path
+
+# event_percentiles : percentiles (0-1) for each reach in feature_ids
+# reach_ids : the stable reach order (streamflow_ids.npy), sorted
+# invalid : indices into feature_ids of reaches to store as no data
+def write_streamflow_percentiles(out_dir, YYYYMMDD, per, event_percentiles, feature_ids, reach_ids, invalid=None):
+	values = percentiles_to_uint8(np.ravel(event_percentiles) * 100.)
+	if invalid is not None: values[np.ravel(invalid)] = 255
+
+	# Place each reach at its position in the stable order, dropping any that are not part of it
+	positions = np.minimum(np.searchsorted(reach_ids, feature_ids), len(reach_ids) - 1)
+	found = reach_ids[positions] == feature_ids
+	percentile = np.full(len(reach_ids), 255, dtype='uint8')
+	percentile[positions[found]] = values[found]
+
+	path = get_artifact_path(out_dir, 'streamflow', per)
+	save_artifact(path, percentile=percentile, date=YYYYMMDD, per=per)
+	return path
+
+def write_reach_order(out_dir, reach_ids):
+	path = os.path.join(out_dir, REACH_ORDER_FILENAME)
+	save_artifact(path, feature_id=reach_ids)
+	return path
+
+# Mark the artifacts of out_dir complete, once its maps have been published (stats as returned by send_to_s3)
+def write_published_marker(out_dir, stats):
+	path = os.path.join(out_dir, PUBLISHED_MARKER_FILENAME)
+	tmp_path = f'{path}.{os.getpid()}.tmp'
+	with open(tmp_path, 'w') as f:
+		json.dump({'published': datetime.datetime.now(datetime.timezone.utc).isoformat(), **stats}, f)
+	os.replace(tmp_path, path)
+	return path
+
+# Returns a dict of the arrays in an artifact, with 'percentile' as a masked array (255 masked)
+def read_percentile_artifact(path):
+	with np.load(path) as artifact:
+		contents = {key: artifact[key] for key in artifact.files}
+	contents['percentile'] = np.ma.masked_equal(contents['percentile'], 255)
+	return contents
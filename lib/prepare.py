@@ -0,0 +1,94 @@
+'''
+	Prepare mode: build a day's retrospective climatologies ahead of time.
+
+	Everything in a day's products except the operational data for that day can be worked out a day early. After
+	each successful publish, main.py builds the next day's climatology (the lookback average of every retrospective
+	year) for every product and lookback and saves it to config.prepared_dir. The next day's run loads these instead
+	of reading every retrospective file of every lookback, so the time between the 12Z files appearing and the maps
+	going live is spent on the operational data, ranking and rendering.
+
+	Climatologies are saved sorted along the year axis. Percentiles only depend on how many years are below or equal
+	to the current value, and constant reaches on the smallest and largest value, so sorting does not change either.
+	They are sorted in place, so preparing does not hold a second copy, and saved compressed: the soil moisture
+	climatology is over a GB uncompressed, and cells outside the land mask hold the same value in every year.
+	A climatology only depends on the month and day, the first retrospective year and the lookback, which name the file.
+	Only the climatologies of the date last prepared are kept, as the earlier date's were used by the run that
+	published it.
+
+	A date can need retrospective files the daily window does not hold yet, when its first retrospective year is
+	earlier than the previous day's (0315, see main.get_retro_start_year). Those climatologies are skipped, and
+	built by that date's run from the files it downloads.
+'''
+import os
+import time
+import numpy as np
+
+from .utils import get_subset_file_name
+from .percentile_artifacts import save_artifact
+
+# Increase when how climatologies are built or stored changes, so older prepared files are not used
+PREPARED_VERSION = 2
+
+def get_prepared_path(config, varname, YYYYMMDD, syear, per):
+	return os.path.join(config.prepared_dir, f'{varname}-{YYYYMMDD[4:]}-{syear}-{per}day-v{PREPARED_VERSION}.npz')
+
+# Sorts data_clim in place, which is not used after it is saved
+def save_prepared_climatology(path, data_clim):
+	data = np.ma.getdata(data_clim)
+	data.sort(axis=0)
+	save_artifact(path, clim=data)
+
+# The prepared climatology of a product and lookback, or None if it was not prepared
+def load_prepared_climatology(config, YYYYMMDD, syear, varname, per):
+	path = get_prepared_path(config, varname, YYYYMMDD, syear, per)
+	if not os.path.exists(path): return None
+	with np.load(path) as prepared:
+		data_clim = prepared['clim']
+	# Same mask as get_retro_climatology
+	if varname=='SOIL_M': data_clim = np.ma.masked_where(data_clim<0, data_clim)
+	return data_clim
+
+# Number of product lookbacks prepared for YYYYMMDD, and the total
+def count_prepared(config, YYYYMMDD, syear):
+	paths = [get_prepared_path(config, p['varname'], YYYYMMDD, syear, per) for p in config.products for per in p['summary_lengths']]
+	return sum([os.path.exists(path) for path in paths]), len(paths)
+
+# True when every retro file the climatology needs is saved
+def retro_files_saved(config, YYYYMMDD, syear, dstype, per):
+	from .create_nwm_nedews_products import get_retro_period_dates
+	return all([
+		os.path.exists(os.path.join(config.retro_data_dir, get_subset_file_name(config.domain_prefix, dstype, per_date, config.hour)))
+		for per_dates in get_retro_period_dates(YYYYMMDD, syear, per) for per_date in per_dates
+	])
+
+def prepare_climatologies(config, YYYYMMDD, syear):
+	'''Build and save the climatology of every product and lookback for YYYYMMDD, skipping any already prepared,
+		and any whose retro files are not saved yet. Prepared files of other dates are removed.
+		Returns the number of climatologies built and the number skipped for missing retro files.
+	'''
+	# Imported here, as create_nwm_nedews_products loads prepared climatologies from this module
+	from .create_nwm_nedews_products import get_retro_climatology
+
+	if not os.path.exists(config.prepared_dir): os.mkdir(config.prepared_dir)
+	built = 0
+	skipped = 0
+	paths = []
+	for product in config.products:
+		for per in product['summary_lengths']:
+			path = get_prepared_path(config, product['varname'], YYYYMMDD, syear, per)
+			paths.append(path)
+			if os.path.exists(path): continue
+			if not retro_files_saved(config, YYYYMMDD, syear, product['dstype'], per):
+				skipped += 1
+				continue
+			data_clim = get_retro_climatology(config, YYYYMMDD, syear, product['varname'], product['dstype'], per)
+			save_prepared_climatology(path, data_clim)
+			del data_clim
+			built += 1
+
+	for f in os.listdir(config.prepared_dir):
+		f_path = os.path.join(config.prepared_dir, f)
+		# Files still being written by another run are left, unless they are old enough to be left over from a killed run
+		if f.endswith('.tmp.npz') and time.time() - os.path.getmtime(f_path) < config.lease_timeout: continue
+		if f_path not in paths: os.remove(f_path)
+	return built, skipped
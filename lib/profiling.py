@@ -0,0 +1,76 @@
+'''
+	On-demand profiling of pipeline stages.
+
+	Enabled with `python main.py <YYYYMMDD> --profile`. Each wrapped stage is run under cProfile
+	and tracemalloc, and two files are written to a dated directory inside config.profile_dir:
+		'<stage>.prof'       : cProfile stats, readable with pstats or snakeviz
+		'<stage>_alloc.txt'  : peak traced memory and the top-N allocation sites
+	When profiling is off, the stage wrapper only records the wall time of the stage.
+	Wall times of every stage are kept in StageProfiler.timings either way, for the critical path report in main.py.
+'''
+import os
+import io
+import time
+import pstats
+import cProfile
+import tracemalloc
+from contextlib import contextmanager
+
+class StageProfiler:
+	def __init__(self, out_dir=None, top_n=25):
+		self.out_dir = out_dir
+		self.top_n = top_n
+		self.timings = {}
+		if self.enabled and not os.path.exists(out_dir): os.makedirs(out_dir)
+
+	@property
+	def enabled(self):
+		return self.out_dir is not None
+
+	@contextmanager
+	def stage(self, name):
+		if not self.enabled:
+			start = time.perf_counter()
+			try:
+				yield
+			finally:
+				self.timings[name] = time.perf_counter() - start
+			return
+
+		tracemalloc.start()
+		profiler = cProfile.Profile()
+		start = time.perf_counter()
+		profiler.enable()
+		try:
+			yield
+		finally:
+			# Stages may stop the run with sys.exit(), so results are written no matter how the stage ends
+			profiler.disable()
+			elapsed = time.perf_counter() - start
+			self.timings[name] = elapsed
+			snapshot = tracemalloc.take_snapshot()
+			_, peak = tracemalloc.get_traced_memory()
+			tracemalloc.stop()
+			self.__write_results(name, profiler, snapshot, peak, elapsed)
+
+	def __write_results(self, name, profiler, snapshot, peak, elapsed):
+		profiler.dump_stats(os.path.join(self.out_dir, f'{name}.prof'))
+
+		# Ignore allocations made by the profiling tools themselves
+		snapshot = snapshot.filter_traces([
+			tracemalloc.Filter(False, tracemalloc.__file__),
+			tracemalloc.Filter(False, cProfile.__file__),
+		])
+		with open(os.path.join(self.out_dir, f'{name}_alloc.txt'), 'w') as f:
+			f.write(f'stage: {name}\n')
+			f.write(f'wall time: {elapsed:.2f} s\n')
+			f.write(f'peak traced memory: {peak / 1024**2:.1f} MiB\n\n')
+			f.write(f'top {self.top_n} allocation sites still held at end of stage:\n')
+			for stat in snapshot.statistics('lineno')[:self.top_n]:
+				f.write(f'{stat}\n')
+
+			# Include the slowest functions so the report can be read without pstats
+			stream = io.StringIO()
+			pstats.Stats(profiler, stream=stream).sort_stats('cumulative').print_stats(self.top_n)
+			f.write(f'\ntop {self.top_n} functions by cumulative time:\n')
+			f.write(stream.getvalue())
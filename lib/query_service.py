@@ -0,0 +1,278 @@
+'''
+	Point, bounding box and reach queries over the percentile artifacts written by create_products
+	(see lib/percentile_artifacts.py), served from memory over HTTP.
+
+	Only date directories whose maps have been published (holding the marker written by main.py) are served, so a
+	date is never served while its artifacts are being written, or when its run failed.
+	The artifacts of one output date are loaded into a PercentileIndex:
+	- soil moisture values are stacked into one (period, layer, y, x) array. A point is converted to the
+	  grid's LCC coordinates with the proj4 string stored in the artifact, and the grid cell is found
+	  directly from the regular x/y spacing, without any search.
+	- streamflow values are stacked into one (period, reach) array, with a dict from COMID to column.
+
+	Values are whole-number percentiles (0-100); cells and reaches with no data are returned as None.
+
+	HTTP endpoints (all responses are JSON):
+		GET  /info
+		GET  /point?lon=<lon>&lat=<lat>
+		GET  /reach?comid=<COMID>
+		GET  /bbox?west=<lon>&south=<lat>&east=<lon>&north=<lat>
+		POST /batch   body: {"points": [[lon, lat], ...], "reaches": [COMID, ...]}
+'''
+import os
+import re
+import json
+import math
+import time
+import threading
+import numpy as np
+import pyproj
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from .percentile_artifacts import REACH_ORDER_FILENAME, PUBLISHED_MARKER_FILENAME
+
+ARTIFACT_PATTERN = re.compile(r'^(SOIL_M|streamflow)-(\d+)day\.npz$')
+NODATA = 255
+
+# Most recent published date directory in output_dir, or None
+def find_latest_day_dir(output_dir):
+	if not os.path.exists(output_dir): return None
+	for d in sorted(os.listdir(output_dir), reverse=True):
+		if os.path.exists(os.path.join(output_dir, d, PUBLISHED_MARKER_FILENAME)):
+			return os.path.join(output_dir, d)
+	return None
+
+# Modification time of day_dir's published marker (None when not published), to tell when the date was published again
+def get_published_signature(day_dir):
+	path = os.path.join(day_dir, PUBLISHED_MARKER_FILENAME)
+	return os.stat(path).st_mtime_ns if os.path.exists(path) else None
+
+def to_values(values):
+	return [None if v == NODATA else v for v in values]
+
+class PercentileIndex:
+	'''In-memory lookup tables for the percentile artifacts of one output date directory.'''
+	def __init__(self, day_dir):
+		self.day_dir = day_dir
+		self.signature = get_published_signature(day_dir)
+		self.date = None
+		files = {}
+		for f in os.listdir(day_dir):
+			match = ARTIFACT_PATTERN.match(f)
+			if match: files.setdefault(match.group(1), []).append((int(match.group(2)), os.path.join(day_dir, f)))
+
+		# Soil moisture grid and its affine index
+		self.soil_pers = []
+		self.soil = None
+		if 'SOIL_M' in files:
+			arrays = []
+			for per, path in sorted(files['SOIL_M']):
+				with np.load(path) as artifact:
+					arrays.append(artifact['percentile'])
+					x, y, proj4 = artifact['x'], artifact['y'], str(artifact['proj4'])
+					self.date = str(artifact['date'])
+				self.soil_pers.append(per)
+			self.soil = np.ascontiguousarray(np.stack(arrays))
+			self.soil_labels = [f'{per}day' for per in self.soil_pers]
+			self.x0, self.dx, self.nx = float(x[0]), float(x[1] - x[0]), len(x)
+			self.y0, self.dy, self.ny = float(y[0]), float(y[1] - y[0]), len(y)
+			self.transformer = pyproj.Transformer.from_proj(pyproj.Proj(proj='latlong', datum='WGS84'), pyproj.Proj(proj4))
+			self.inverse_transformer = pyproj.Transformer.from_proj(pyproj.Proj(proj4), pyproj.Proj(proj='latlong', datum='WGS84'))
+			# Lon/lat of every cell center, used to trim bounding box queries to the exact box
+			self.cell_lon, self.cell_lat = self.inverse_transformer.transform(*np.meshgrid(x, y))
+
+		# Streamflow values and the COMID -> column table
+		self.flow_pers = []
+		self.flow = None
+		self.reach_columns = {}
+		if 'streamflow' in files:
+			with np.load(os.path.join(day_dir, REACH_ORDER_FILENAME)) as reaches:
+				self.reach_columns = {int(comid): col for col, comid in enumerate(reaches['feature_id'])}
+			arrays = []
+			for per, path in sorted(files['streamflow']):
+				with np.load(path) as artifact:
+					arrays.append(artifact['percentile'])
+					self.date = str(artifact['date'])
+				self.flow_pers.append(per)
+			self.flow = np.ascontiguousarray(np.stack(arrays))
+			self.flow_labels = [f'{per}day' for per in self.flow_pers]
+
+	def info(self):
+		return {
+			'date': self.date,
+			'SOIL_M': {'periods': self.soil_pers, 'layers': 0 if self.soil is None else self.soil.shape[1]},
+			'streamflow': {'periods': self.flow_pers, 'reaches': len(self.reach_columns)}
+		}
+
+	# Grid rows and columns of lon/lat arrays, -1 where outside the grid
+	def grid_cells(self, lons, lats):
+		x, y = self.transformer.transform(np.asarray(lons, dtype='float64'), np.asarray(lats, dtype='float64'))
+		ix = np.rint((x - self.x0) / self.dx).astype('int64')
+		iy = np.rint((y - self.y0) / self.dy).astype('int64')
+		inside = (ix >= 0) & (ix < self.nx) & (iy >= 0) & (iy < self.ny)
+		return np.where(inside, iy, -1), np.where(inside, ix, -1)
+
+	def points(self, lons, lats):
+		'''Soil moisture percentiles at each lon/lat, as {period: [value per layer]}, None outside the grid'''
+		if self.soil is None: return [None] * len(lons)
+		iy, ix = self.grid_cells(lons, lats)
+		# One gather for all points, converted to python values in a single call
+		cells = np.moveaxis(self.soil[:, :, np.maximum(iy, 0), np.maximum(ix, 0)], 2, 0).tolist()
+		results = []
+		for inside, cell in zip((iy >= 0).tolist(), cells):
+			results.append(dict(zip(self.soil_labels, [to_values(layers) for layers in cell])) if inside else None)
+		return results
+
+	# Single points skip the array setup of points(), which costs more than the lookup itself
+	def point(self, lon, lat):
+		if self.soil is None: return None
+		x, y = self.transformer.transform(float(lon), float(lat))
+		ix = round((x - self.x0) / self.dx)
+		iy = round((y - self.y0) / self.dy)
+		if not (0 <= ix < self.nx and 0 <= iy < self.ny): return None
+		return dict(zip(self.soil_labels, [to_values(layers) for layers in self.soil[:, :, iy, ix].tolist()]))
+
+	def reaches(self, comids):
+		'''Streamflow percentiles of each COMID, as {period: value}, None for unknown reaches'''
+		if self.flow is None: return [None] * len(comids)
+		columns = [self.reach_columns.get(int(comid)) for comid in comids]
+		values = self.flow[:, [0 if col is None else col for col in columns]].T.tolist()
+		results = []
+		for col, reach_values in zip(columns, values):
+			results.append(dict(zip(self.flow_labels, to_values(reach_values))) if col is not None else None)
+		return results
+
+	def reach(self, comid):
+		return self.reaches([comid])[0]
+
+	def bbox(self, west, south, east, north, edge_points=21):
+		'''Summary of the soil moisture cells whose centers are inside a lon/lat box:
+			the number of cells, and the count, mean, min and max of the values with data, by period and layer
+		'''
+		if self.soil is None: return None
+		# The box is curved in grid coordinates, so the grid window is taken from points along its edges
+		t = np.linspace(0., 1., edge_points)
+		lons = np.concatenate([west + (east - west) * t, np.full(edge_points, east), east - (east - west) * t, np.full(edge_points, west)])
+		lats = np.concatenate([np.full(edge_points, south), south + (north - south) * t, np.full(edge_points, north), north - (north - south) * t])
+		x, y = self.transformer.transform(lons, lats)
+		ix0 = max(int(np.floor((x.min() - self.x0) / self.dx)), 0)
+		ix1 = min(int(np.ceil((x.max() - self.x0) / self.dx)) + 1, self.nx)
+		iy0 = max(int(np.floor((y.min() - self.y0) / self.dy)), 0)
+		iy1 = min(int(np.ceil((y.max() - self.y0) / self.dy)) + 1, self.ny)
+		if ix0 >= ix1 or iy0 >= iy1: return {'cells': 0, 'values': {}}
+
+		cell_lon = self.cell_lon[iy0:iy1, ix0:ix1]
+		cell_lat = self.cell_lat[iy0:iy1, ix0:ix1]
+		in_box = (cell_lon >= west) & (cell_lon <= east) & (cell_lat >= south) & (cell_lat <= north)
+		values = self.soil[:, :, iy0:iy1, ix0:ix1][:, :, in_box]
+		summary = {}
+		for p, per in enumerate(self.soil_pers):
+			layers = []
+			for layer_values in values[p]:
+				valid = layer_values[layer_values != NODATA]
+				if len(valid):
+					layers.append({'count': int(len(valid)), 'mean': round(float(valid.mean()), 2), 'min': int(valid.min()), 'max': int(valid.max())})
+				else:
+					layers.append({'count': 0, 'mean': None, 'min': None, 'max': None})
+			summary[f'{per}day'] = layers
+		return {'cells': int(in_box.sum()), 'values': summary}
+
+	def batch(self, points=None, reaches=None):
+		points = points or []
+		result = {}
+		if points:
+			lons, lats = zip(*points)
+			result['points'] = self.points(lons, lats)
+		if reaches:
+			result['reaches'] = self.reaches(reaches)
+		return result
+
+# float() of a query parameter, refusing inf and nan, which cannot be located on the grid
+def finite_float(value):
+	value = float(value)
+	if not math.isfinite(value): raise ValueError(f'{value} is not a finite number')
+	return value
+
+class QueryHandler(BaseHTTPRequestHandler):
+	'''Answers queries from the server's current index (see serve).'''
+	# Keep connections open between requests, since every response has a Content-Length,
+	#   and send small responses immediately rather than waiting to coalesce them
+	protocol_version = 'HTTP/1.1'
+	disable_nagle_algorithm = True
+
+	def send_json(self, status, body):
+		data = json.dumps(body).encode()
+		self.send_response(status)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(data)))
+		self.end_headers()
+		self.wfile.write(data)
+
+	def do_GET(self):
+		url = urlparse(self.path)
+		params = {k: v[0] for k, v in parse_qs(url.query).items()}
+		index = self.server.index
+		try:
+			if url.path == '/info':
+				self.send_json(200, index.info())
+			elif url.path == '/point':
+				lon, lat = finite_float(params['lon']), finite_float(params['lat'])
+				self.send_json(200, {'lon': lon, 'lat': lat, 'SOIL_M': index.point(lon, lat)})
+			elif url.path == '/reach':
+				comid = int(params['comid'])
+				values = index.reach(comid)
+				self.send_json(200 if values is not None else 404, {'comid': comid, 'streamflow': values})
+			elif url.path == '/bbox':
+				self.send_json(200, index.bbox(*[finite_float(params[k]) for k in ['west', 'south', 'east', 'north']]))
+			else:
+				self.send_json(404, {'error': f'unknown path {url.path}'})
+		except (KeyError, ValueError, OverflowError) as e:
+			self.send_json(400, {'error': f'invalid query: {e}'})
+
+	def do_POST(self):
+		if urlparse(self.path).path != '/batch':
+			self.send_json(404, {'error': f'unknown path {self.path}'})
+			return
+		try:
+			body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+			points = [(finite_float(lon), finite_float(lat)) for lon, lat in body.get('points') or []]
+			self.send_json(200, self.server.index.batch(points, body.get('reaches')))
+		except (KeyError, ValueError, TypeError, OverflowError) as e:
+			self.send_json(400, {'error': f'invalid query: {e}'})
+
+	def log_message(self, format, *args):
+		pass
+
+# Swap in a new index whenever a newer output date is published or the current date is published again
+def watch_for_new_output(server, output_dir, interval):
+	while True:
+		time.sleep(interval)
+		try:
+			day_dir = find_latest_day_dir(output_dir)
+			if day_dir is None: continue
+			if day_dir != server.index.day_dir or get_published_signature(day_dir) != server.index.signature:
+				server.index = PercentileIndex(day_dir)
+				print(f'query service: loaded {day_dir}')
+		except Exception as e:
+			# Keep serving the current index, and try again at the next check
+			print(f'query service: could not reload from {output_dir}: {e}')
+
+def make_server(index, host='127.0.0.1', port=8080):
+	server = ThreadingHTTPServer((host, port), QueryHandler)
+	server.daemon_threads = True
+	server.index = index
+	return server
+
+def serve(config, day_dir=None, host='127.0.0.1', port=8080):
+	'''Serve queries for day_dir, or for the latest published date in config.output_dir (following new dates as they
+		are published). config is a domain config (see lib/domains.py), whose output_dir is that domain's.
+	'''
+	follow_latest = day_dir is None
+	if follow_latest: day_dir = find_latest_day_dir(config.output_dir)
+	if day_dir is None: raise FileNotFoundError(f'no published percentile artifacts found in {config.output_dir}')
+	server = make_server(PercentileIndex(day_dir), host, port)
+	if follow_latest:
+		threading.Thread(target=watch_for_new_output, args=(server, config.output_dir, config.query_reload_seconds), daemon=True).start()
+	print(f'query service: serving {day_dir} at http://{host}:{server.server_address[1]}')
+	server.serve_forever()
@@ -1,74 +1,80 @@
 import os
+from concurrent.futures import ThreadPoolExecutor
+
 import boto3
+from botocore.config import Config
+from boto3.s3.transfer import TransferConfig
+
+from .utils import record_transfer, file_md5
+
+# Top-level directories in the bucket that sync_bucket leaves alone
+IGNORE_DIRS = ['pre']
+
+# Keep uploads single part, so the ETag of every object is the MD5 of its content
+TRANSFER_CONFIG = TransferConfig(multipart_threshold=256 * 1024**2)
 
 class R2Bucket:
-  def __init__(self, bucket_name, cf_id, aws_id, aws_secret):
+  def __init__(self, bucket_name, cf_id, aws_id, aws_secret, endpoint_url=None):
+    # endpoint_url overrides the Cloudflare account endpoint, e.g. for a local S3-compatible stand-in
     r2 = boto3.resource(
       's3',
-      endpoint_url = f'https://{cf_id}.r2.cloudflarestorage.com',
+      endpoint_url = endpoint_url or f'https://{cf_id}.r2.cloudflarestorage.com',
       aws_access_key_id=aws_id,
-      aws_secret_access_key=aws_secret
+      aws_secret_access_key=aws_secret,
+      config=Config(max_pool_connections=16)
     )
     self.bucket = r2.Bucket(bucket_name)
   
-  def __sync_bucket_directories(self, local_dir_path, local_dirs, web_dirs, verbose=False):
-    # if directory in bucket is also in local, remove from list to copy
-    # if directory in bucket is not in local and is not in ignore list then it is not needed, delete all files in it
-    ignore_dirs = ['pre']
-    for web_dir in web_dirs:
-      if web_dir in ignore_dirs:
-        continue
-      elif web_dir in local_dirs:
-        if verbose: print('have:', web_dir)
-        local_dirs.remove(web_dir)
-      else:
-        if verbose: print('delete:', web_dir)
-        self.bucket.objects.filter(Prefix=web_dir).delete()
-    
-    # for each needed directory copy it's contents into the bucket
-    for local_dir in local_dirs:
-      if verbose: print('need:', local_dir)
-      dir_path = os.path.join(local_dir_path, local_dir)
-      for f_name in os.listdir(dir_path):
-        if verbose: print(f'   copying:', f_name)
-        self.bucket.upload_file(os.path.join(dir_path, f_name), f'{local_dir}/{f_name}')
-
-  def __sync_bucket_files(self, local_dir_path, local_files, web_files, verbose=False):
-    # remove all unneeded files from bucket
-    to_delete = []
-    for web_file in web_files:
-      if web_file not in local_files:
-        if verbose: print('delete:', web_file)
-        to_delete.append({'Key': web_file})
-    if len(to_delete):
-      self.bucket.delete_objects(Delete={'Objects': to_delete})
-    
-    # push all local files to the bucket, overwriting if necessary
-    for local_file in local_files:
-      if verbose: print('copying:', local_file)
-      self.bucket.upload_file(os.path.join(local_dir_path, local_file), local_file)
-  
-  def __separate_directories_from_files(self, dir_contents):
-    files = []
-    dirs = []
-    for name in dir_contents:
-      name_parts = name.split('/')
-      if len(name_parts) == 1 and '.' in name_parts[0]:
-        files.append(name)
-      elif name_parts[0] not in dirs:
-        dirs.append(name_parts[0])
-    return files, dirs
-
-
-  def sync_bucket(self, local_dir_path, verbose=False):
-    local_contents = os.listdir(local_dir_path)
-    local_files, local_dirs = self.__separate_directories_from_files(local_contents)
-
-    web_contents = [obj.key for obj in self.bucket.objects.all()]
-    web_files, web_dirs = self.__separate_directories_from_files(web_contents)
-
-    self.__sync_bucket_directories(local_dir_path, local_dirs, web_dirs, verbose)
-    self.__sync_bucket_files(local_dir_path, local_files, web_files, verbose)
+  # Uploads go through the client, which unlike the resource is safe to share between threads
+  def upload_file(self, local_path, key):
+    self.bucket.meta.client.upload_file(local_path, self.bucket.name, key, Config=TRANSFER_CONFIG)
+    record_transfer('upload', os.path.getsize(local_path))
+
+  # key -> (etag, size) for every object in the bucket, from one paginated listing
+  def __list_remote(self):
+    return {obj.key: (obj.e_tag.strip('"'), obj.size) for obj in self.bucket.objects.all()}
+
+  # key -> local path for every file below local_dir_path
+  def __list_local(self, local_dir_path):
+    local = {}
+    for dirpath, _, filenames in os.walk(local_dir_path):
+      for f_name in filenames:
+        f_path = os.path.join(dirpath, f_name)
+        local[os.path.relpath(f_path, local_dir_path).replace(os.sep, '/')] = f_path
+    return local
+
+  def __is_unchanged(self, local_path, remote):
+    # Size is free to check, so the MD5 is only computed when sizes match
+    etag, size = remote
+    return os.path.getsize(local_path) == size and file_md5(local_path) == etag
+
+  def sync_bucket(self, local_dir_path, verbose=False, max_workers=16):
+    '''Make the bucket match local_dir_path.
+      Files that are new or whose size/MD5 differ from the remote size/ETag are uploaded in parallel,
+      and remote objects with no local counterpart are deleted in batches of up to 1000 keys.
+      Objects in the top-level directories in IGNORE_DIRS are never deleted.
+      Returns the number of files uploaded, deleted and unchanged.
+    '''
+    local = self.__list_local(local_dir_path)
+    remote = self.__list_remote()
+
+    to_delete = [key for key in remote if key not in local and key.split('/')[0] not in IGNORE_DIRS]
+    with ThreadPoolExecutor(max_workers) as pool:
+      unchanged = list(pool.map(lambda key: key in remote and self.__is_unchanged(local[key], remote[key]), local))
+    to_upload = [key for key, same in zip(local, unchanged) if not same]
+
+    for i in range(0, len(to_delete), 1000):
+      if verbose:
+        for key in to_delete[i:i+1000]: print('delete:', key)
+      self.bucket.delete_objects(Delete={'Objects': [{'Key': key} for key in to_delete[i:i+1000]], 'Quiet': True})
+
+    def upload(key):
+      if verbose: print('copying:', key)
+      self.upload_file(local[key], key)
+    with ThreadPoolExecutor(max_workers) as pool:
+      list(pool.map(upload, to_upload))
+
+    return {'uploaded': len(to_upload), 'deleted': len(to_delete), 'unchanged': len(local) - len(to_upload)}
 
 
 # # Usage example
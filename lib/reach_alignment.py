@@ -0,0 +1,57 @@
+'''
+	Reach alignment table: the row of each drawn flowline in the streamflow arrays.
+
+	The flowlines (see lib/flowlines.py) and the reaches of the streamflow arrays (the feature_id order of the
+	subset NWM files) do not change from day to day, so the row of each flowline is worked out once and cached in
+	config.nhdplus_dir. Each map then takes the values of its flowlines with one fancy-index gather, instead of
+	looking up every COMID in a dict.
+
+	A flowline has no data when its COMID is not in the NWM v3 files, or when its reach has the same value in
+	every year of the climatology (at least some of these appear to be lakes). Which reaches are constant depends
+	on the dates of the climatology (e.g. reaches that are dry on those dates in every year), so that part of the
+	validity is taken from each lookback's climatology with get_constant_reaches.
+'''
+import os
+import glob
+import numpy as np
+
+from .percentile_artifacts import save_artifact
+from .zonal_stats import get_cache_key
+
+# Position of each COMID in feature_ids (which need not be sorted), -1 where missing
+def find_rows(comids, feature_ids):
+	if len(feature_ids) == 0: return np.full(len(comids), -1, dtype='int64')
+	order = np.argsort(feature_ids, kind='stable')
+	sorted_ids = feature_ids[order]
+	pos = np.minimum(np.searchsorted(sorted_ids, comids), len(sorted_ids) - 1)
+	return np.where(sorted_ids[pos] == comids, order[pos], -1).astype('int64')
+
+def get_reach_alignment(config, comids, feature_ids):
+	'''Row in the streamflow arrays of each flowline, cached.
+		comids : COMID of each flowline, in flowline order
+		feature_ids : feature ids of the streamflow arrays (as read by utils.read_product_file)
+		Returns (rows, present). present is False for flowlines whose COMID is not in feature_ids, and their row is 0.
+	'''
+	comids = np.asarray(comids, dtype='int64')
+	feature_ids = np.asarray(feature_ids, dtype='int64')
+	path = os.path.join(config.nhdplus_dir, f'reach-alignment-{get_cache_key(comids, feature_ids)}.npz')
+	if os.path.exists(path):
+		with np.load(path) as table:
+			return table['rows'], table['present']
+
+	rows = find_rows(comids, feature_ids)
+	present = rows >= 0
+	rows = np.where(present, rows, 0)
+	# Only the table for the current flowlines and reaches is kept
+	for old_path in glob.glob(os.path.join(config.nhdplus_dir, 'reach-alignment-*.npz')):
+		os.remove(old_path)
+	save_artifact(path, rows=rows, present=present)
+	return rows, present
+
+# Reaches with the same value in every year of a climatology (years, reaches)
+def get_constant_reaches(data_clim):
+	return np.min(data_clim, axis=0) == np.max(data_clim, axis=0)
+
+# Percentiles (0-100) of each flowline, NaN where it has no data
+def gather_line_percentiles(event_percentiles, rows, valid):
+	return np.where(valid, event_percentiles[rows] * 100., np.nan)
@@ -0,0 +1,141 @@
+'''
+	Incremental operational lookback averages.
+
+	Consecutive days share all but one of the files in a lookback window, so instead of re-reading every
+	file in the window each day, a rolling state is kept in config.rolling_state_dir for each product and
+	lookback. The state holds the running sum, the list of days it covers, and for each day the MD5 checksum,
+	size and modification time of the source file. A daily update subtracts the day that expired and adds the
+	new day, so only those two files are read no matter how long the lookback is.
+
+	The state is rebuilt from all files in the window when:
+		- there is no state, or it does not end on the previous day (a gap or out-of-order run)
+		- a retained day's file changed size or modification time, or the expired day's checksum does not match
+		- the new day's coordinates (feature ids or x/y) differ from those in the state
+		- config.rolling_state_max_updates incremental updates have been applied, to bound rounding drift
+	Sums are kept in float64, so the rounding of each addition and subtraction is far below the precision of the
+	float32 inputs, but it is not exact: it accumulates with every update, and the periodic rebuild bounds it.
+	The average is returned in the dtype of the input files, as the average of the files themselves would be.
+'''
+import os
+import datetime
+import numpy as np
+
+from .utils import read_product_file, file_md5, get_subset_file_name
+from .coordination import lease
+
+def get_oper_file_path(config, YYYYMMDD, varname):
+	if varname=='SOIL_M':
+		ncfilename = get_subset_file_name(config.domain_prefix, 'land', YYYYMMDD, config.hour, config.lookback)
+	elif varname=='streamflow':
+		ncfilename = get_subset_file_name(config.domain_prefix, 'channel_rt', YYYYMMDD, config.hour, config.lookback)
+	return os.path.join(config.oper_data_dir, ncfilename)
+
+def file_signature(path):
+	st = os.stat(path)
+	return [st.st_size, st.st_mtime_ns]
+
+# Days in the lookback window ending on YYYYMMDD, oldest first
+def window_dates(YYYYMMDD, per):
+	dt_date = datetime.datetime.strptime(YYYYMMDD, '%Y%m%d')
+	return [(dt_date - datetime.timedelta(days=i)).strftime('%Y%m%d') for i in range(per-1, -1, -1)]
+
+def load_state(path):
+	if not os.path.exists(path): return None
+	try:
+		with np.load(path, allow_pickle=False) as npz:
+			state = {k: npz[k] for k in npz.files}
+	except (OSError, ValueError):
+		return None
+	# States saved before the input dtype was kept are rebuilt
+	if 'dtype' not in state: return None
+	return {
+		'days': [str(d) for d in state['days']],
+		'md5s': [str(m) for m in state['md5s']],
+		'signatures': state['signatures'].tolist(),
+		'sum': state['sum'],
+		'updates': int(state['updates']),
+		'dtype': str(state['dtype']),
+		'meta': {k[5:]: (str(v) if v.dtype.kind == 'U' else v) for k, v in state.items() if k.startswith('meta_')}
+	}
+
+# Write to a temporary file first so an interrupted run never leaves a partial state behind
+def save_state(path, state):
+	tmp_path = f'{path}.{os.getpid()}.tmp.npz'
+	np.savez(
+		tmp_path,
+		days=np.array(state['days']),
+		md5s=np.array(state['md5s']),
+		signatures=np.array(state['signatures'], dtype='int64'),
+		sum=state['sum'],
+		updates=np.array(state['updates']),
+		dtype=np.array(state['dtype']),
+		**{f'meta_{k}': np.asarray(v) for k, v in state['meta'].items()}
+	)
+	os.replace(tmp_path, path)
+
+def same_coordinates(meta1, meta2):
+	return all([np.array_equal(np.asarray(meta1[k]), np.asarray(meta2[k])) for k in meta1 if k != 'proj4'])
+
+def build_state(config, days, varname):
+	state = {'days': days, 'md5s': [], 'signatures': [], 'sum': None, 'updates': 0, 'dtype': None, 'meta': None}
+	for day in days:
+		path = get_oper_file_path(config, day, varname)
+		data, meta = read_product_file(path, varname, with_meta=True)
+		if state['sum'] is None:
+			state['sum'] = data.astype('float64')
+			state['dtype'] = data.dtype.str
+			state['meta'] = meta
+		else:
+			state['sum'] += data
+		state['md5s'].append(file_md5(path))
+		state['signatures'].append(file_signature(path))
+	return state
+
+# Apply one day of change to a state covering the previous window. Returns None if the state cannot be trusted.
+def update_state(config, state, days, varname):
+	if state['days'][1:] != days[:-1] or state['updates'] >= config.rolling_state_max_updates:
+		return None
+
+	# Days that stay in the window must not have changed since they were added
+	for day, signature in zip(state['days'][1:], state['signatures'][1:]):
+		path = get_oper_file_path(config, day, varname)
+		if not os.path.exists(path) or file_signature(path) != signature: return None
+
+	# The expired day is read anyway, so verify its full checksum before subtracting it
+	expired_path = get_oper_file_path(config, state['days'][0], varname)
+	if not os.path.exists(expired_path) or file_md5(expired_path) != state['md5s'][0]: return None
+	new_path = get_oper_file_path(config, days[-1], varname)
+	new_data, new_meta = read_product_file(new_path, varname, with_meta=True)
+	if not same_coordinates(state['meta'], new_meta): return None
+	expired_data, _ = read_product_file(expired_path, varname)
+
+	state['sum'] += new_data
+	state['sum'] -= expired_data
+	state['days'] = days
+	state['md5s'] = state['md5s'][1:] + [file_md5(new_path)]
+	state['signatures'] = state['signatures'][1:] + [file_signature(new_path)]
+	state['meta'] = new_meta
+	state['updates'] += 1
+	return state
+
+# Same result as create_nwm_nedews_products.get_oper_period_average, maintained incrementally
+def get_rolling_period_average(config, YYYYMMDD, varname, per):
+	days = window_dates(YYYYMMDD, per)
+	state_path = os.path.join(config.rolling_state_dir, f'{varname}_{per}day.npz')
+	# Overlapping runs (e.g. a backfill and the daily run) take turns, so one run's update is not lost to the other's
+	with lease(config, 'rolling', f'{config.domain_prefix}-{varname}-{per}day'):
+		state = load_state(state_path)
+
+		# A rerun for the same day can use the state as is, if none of its files changed
+		unchanged = state is not None and state['days'] == days and all([
+			os.path.exists(get_oper_file_path(config, day, varname)) and file_signature(get_oper_file_path(config, day, varname)) == signature
+			for day, signature in zip(days, state['signatures'])
+		])
+		if not unchanged:
+			if state is not None: state = update_state(config, state, days, varname)
+			if state is None: state = build_state(config, days, varname)
+			save_state(state_path, state)
+
+	data_event = (state['sum'] / per).astype(state['dtype'])
+	if varname=='SOIL_M': data_event = np.ma.masked_where(data_event<0, data_event)
+	return data_event, dict(state['meta'])
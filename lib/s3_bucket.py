@@ -1,18 +1,164 @@
 import os
+import time
+import json
+import datetime
+import mimetypes
+from concurrent.futures import ThreadPoolExecutor
+
 import boto3
+from botocore.config import Config
+from boto3.s3.transfer import TransferConfig
 from dotenv import load_dotenv
 load_dotenv()
 
-def send_to_s3(local_dir_path):
+from .utils import record_transfer, file_md5
+
+# Keep uploads single part, so the ETag of every live object is the MD5 of its content
+TRANSFER_CONFIG = TransferConfig(multipart_threshold=256 * 1024**2)
+
+# Object naming the live run, in S3_PREFIX
+POINTER_NAME = 'current.json'
+
+def list_etags(s3_client, bucket, prefix):
+  etags = {}
+  paginator = s3_client.get_paginator('list_objects_v2')
+  for page in paginator.paginate(Bucket=bucket, Prefix=f'{prefix}/'):
+    for obj in page.get('Contents', []):
+      etags[obj['Key']] = obj['ETag'].strip('"')
+  return etags
+
+# Delete keys, up to 1000 per request
+def delete_keys(s3_client, bucket, keys):
+  keys = [{'Key': key} for key in keys]
+  for i in range(0, len(keys), 1000):
+    s3_client.delete_objects(Bucket=bucket, Delete={'Objects': keys[i:i+1000], 'Quiet': True})
+
+# Prefix of the run current.json points to, or None before the first publish
+def get_current_run(s3_client, bucket, prefix):
+  try:
+    response = s3_client.get_object(Bucket=bucket, Key=f'{prefix}/{POINTER_NAME}')
+  except s3_client.exceptions.NoSuchKey:
+    return None
+  return f'{prefix}/{json.loads(response["Body"].read())["run"]}'
+
+def send_to_s3(local_dir_path, endpoint_url=None, max_workers=16, subprefix=None, extensions=None, keep_runs=3, legacy_keys=True):
+  '''Publish the files in local_dir_path to S3_PREFIX in S3_BUCKET_NAME.
+    Each publish is a complete, unchanging set of files in its own prefix, <S3_PREFIX>/runs/<run id>/, and
+    <S3_PREFIX>/current.json names the live one. Clients read current.json first, then the files of that run.
+    1. Files whose MD5 matches the ETag of the same file in the live run are copied server-side into the new run.
+    2. Changed files are uploaded concurrently into the new run.
+    3. The run's manifest.json, listing every file and its MD5, is written.
+    4. Only once all of the above has succeeded is current.json overwritten to name the new run. This single
+       put is the switch, so clients see either the whole previous set of maps or the whole new one.
+    5. Runs other than the last keep_runs are deleted. Older runs are kept for a while, so clients that read
+       current.json just before the switch can still fetch the files of the run it named.
+    6. With legacy_keys, the run's files are also copied server-side to <S3_PREFIX>/<file>, where clients that do
+       not read current.json yet (the nedews site) find them. Only files whose MD5 differs from the ETag there are
+       copied, and those keys change one at a time, as before current.json existed.
+    If any upload or copy fails, the new run is deleted and current.json is left as it was.
+    endpoint_url overrides the AWS endpoint, e.g. for a local S3-compatible stand-in.
+    subprefix publishes under <S3_PREFIX>/<subprefix> instead, e.g. for a domain other than the first (see lib/domains.py).
+    extensions limits the published files to those with these extensions (all files when None).
+    Returns counts and sizes of uploaded and skipped (copied from the live run) files.
+  '''
+  start = time.perf_counter()
   s3_client = boto3.client(
     's3',
+    endpoint_url=endpoint_url,
     aws_access_key_id=os.environ['AWS_ACCESS_KEY_ID'],
     aws_secret_access_key=os.environ['AWS_SECRET_ACCESS_KEY'],
+    config=Config(max_pool_connections=max_workers)
   )
-  local_files = os.listdir(local_dir_path)
-  for f_name in local_files:
+  bucket = os.environ['S3_BUCKET_NAME']
+  prefix = os.environ['S3_PREFIX'] if subprefix is None else f'{os.environ["S3_PREFIX"]}/{subprefix}'
+  # Run ids start with the time, so they sort in publish order
+  run_id = f'{datetime.datetime.now().strftime("%Y%m%d%H%M%S")}-{os.path.basename(os.path.normpath(local_dir_path))}'
+  run_prefix = f'{prefix}/runs/{run_id}'
+
+  # Compare local content with the live run
+  local_files = sorted([f_name for f_name in os.listdir(local_dir_path) if extensions is None or os.path.splitext(f_name)[1] in extensions])
+  with ThreadPoolExecutor(max_workers) as pool:
+    local_md5s = dict(zip(local_files, pool.map(lambda f_name: file_md5(os.path.join(local_dir_path, f_name)), local_files)))
+  current_run = get_current_run(s3_client, bucket, prefix)
+  live_etags = list_etags(s3_client, bucket, current_run) if current_run else {}
+  changed_files = [f_name for f_name in local_files if live_etags.get(f'{current_run}/{f_name}') != local_md5s[f_name]]
+  unchanged_files = [f_name for f_name in local_files if f_name not in changed_files]
+  sizes = {f_name: os.path.getsize(os.path.join(local_dir_path, f_name)) for f_name in local_files}
+
+  def extra_args(f_name):
+    content_type = mimetypes.guess_type(f_name)[0]
+    return {'ContentType': content_type} if content_type else {}
+
+  def upload(f_name):
     s3_client.upload_file(
       os.path.join(local_dir_path, f_name),
-      os.environ['S3_BUCKET_NAME'],
-      f'{os.environ["S3_PREFIX"]}/{f_name}'
-    )
\ No newline at end of file
+      bucket,
+      f'{run_prefix}/{f_name}',
+      ExtraArgs=extra_args(f_name),
+      Config=TRANSFER_CONFIG
+    )
+    record_transfer('upload', sizes[f_name])
+
+  def copy(f_name):
+    s3_client.copy_object(
+      Bucket=bucket,
+      Key=f'{run_prefix}/{f_name}',
+      CopySource={'Bucket': bucket, 'Key': f'{current_run}/{f_name}'},
+      MetadataDirective='COPY'
+    )
+
+  try:
+    # list() so that the first failed upload or copy raises here, before the pointer is touched
+    with ThreadPoolExecutor(max_workers) as pool:
+      list(pool.map(upload, changed_files))
+      list(pool.map(copy, unchanged_files))
+    manifest = {
+      'published': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+      'source': os.path.basename(os.path.normpath(local_dir_path)),
+      'files': {f_name: {'md5': local_md5s[f_name], 'size': sizes[f_name]} for f_name in local_files}
+    }
+    s3_client.put_object(Bucket=bucket, Key=f'{run_prefix}/manifest.json', Body=json.dumps(manifest, indent=2).encode(), ContentType='application/json')
+  except Exception:
+    delete_keys(s3_client, bucket, list_etags(s3_client, bucket, run_prefix))
+    raise
+
+  # The switch. Not cached, unlike the files of a run, which never change.
+  pointer = {'run': f'runs/{run_id}', 'published': manifest['published'], 'source': manifest['source']}
+  s3_client.put_object(Bucket=bucket, Key=f'{prefix}/{POINTER_NAME}', Body=json.dumps(pointer).encode(), ContentType='application/json', CacheControl='no-cache')
+
+  # Prune older runs
+  run_keys = {}
+  for key in list_etags(s3_client, bucket, f'{prefix}/runs'):
+    run_keys.setdefault(key[len(f'{prefix}/runs/'):].split('/')[0], []).append(key)
+  old_runs = [r for r in sorted(run_keys)[:-keep_runs] if r != run_id]
+  delete_keys(s3_client, bucket, [key for r in old_runs for key in run_keys[r]])
+
+  # Keys read by clients from before current.json, kept up to date until every client reads the pointer
+  legacy_files = []
+  if legacy_keys:
+    legacy_etags = list_etags(s3_client, bucket, prefix)
+    legacy_files = [f_name for f_name in local_files if legacy_etags.get(f'{prefix}/{f_name}') != local_md5s[f_name]]
+    def copy_legacy(f_name):
+      s3_client.copy_object(
+        Bucket=bucket,
+        Key=f'{prefix}/{f_name}',
+        CopySource={'Bucket': bucket, 'Key': f'{run_prefix}/{f_name}'},
+        MetadataDirective='COPY'
+      )
+    with ThreadPoolExecutor(max_workers) as pool:
+      list(pool.map(copy_legacy, legacy_files))
+
+  stats = {
+    'uploaded_files': len(changed_files),
+    'uploaded_bytes': sum([sizes[f_name] for f_name in changed_files]),
+    'skipped_files': len(unchanged_files),
+    'skipped_bytes': sum([sizes[f_name] for f_name in unchanged_files]),
+    'pruned_runs': len(old_runs),
+    'legacy_copied_files': len(legacy_files),
+    'seconds': round(time.perf_counter() - start, 2)
+  }
+  # Estimate time saved by skipping unchanged files from the throughput of this publish
+  if stats['uploaded_bytes'] and stats['skipped_bytes']:
+    stats['estimated_seconds_saved'] = round(stats['skipped_bytes'] * stats['seconds'] / stats['uploaded_bytes'], 2)
+  print('published to S3:', ', '.join([f'{k}={v}' for k, v in stats.items()]))
+  return stats
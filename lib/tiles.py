@@ -0,0 +1,234 @@
+'''
+	Web map tile output.
+
+	When config.tile_output is set (main.py --tiles), each map's classified percentile layer is also
+	rendered into a web-mercator XYZ tile pyramid for zooms config.tile_min_zoom to config.tile_max_zoom,
+	covering the cropped domain (config.ll_lon/ll_lat/ur_lon/ur_lat). Each pyramid is stored as one
+	MBTiles archive next to the PNG maps, e.g. 'SOIL_M-1day-lev0.mbtiles' or 'streamflow-7day.mbtiles'.
+
+	Only the data layer is tiled; state outlines and titles are left to the map client. Pixels with no data
+	(masked soil moisture, reaches without a valid percentile) are transparent and fully transparent tiles
+	are not stored. Tiles with identical content are stored once, using the deduplicated MBTiles layout
+	in which a 'map' table points at an 'images' table keyed by the tile's content hash.
+'''
+import os
+import io
+import math
+import sqlite3
+import hashlib
+import numpy as np
+import pyproj
+
+from .utils import save_palette_png
+
+import matplotlib
+matplotlib.use('Agg')
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.collections import LineCollection, PathCollection
+from matplotlib.path import Path
+
+TILE_SIZE = 256
+
+### Web mercator pixel coordinates at a zoom level, counted from the top-left corner of the world
+def lonlat_to_pixels(lon, lat, zoom):
+	world = TILE_SIZE * 2**zoom
+	lat = np.clip(lat, -85.0511, 85.0511)
+	px = (np.asarray(lon) + 180.) / 360. * world
+	py = (1. - np.log(np.tan(np.radians(lat)) + 1. / np.cos(np.radians(lat))) / math.pi) / 2. * world
+	return px, py
+
+def pixels_to_lonlat(px, py, zoom):
+	world = TILE_SIZE * 2**zoom
+	lon = np.asarray(px) / world * 360. - 180.
+	lat = np.degrees(np.arctan(np.sinh(math.pi * (1. - 2. * np.asarray(py) / world))))
+	return lon, lat
+
+### Tile columns and rows (inclusive) covering a [ll_lon, ll_lat, ur_lon, ur_lat] bbox
+def tile_range(bbox, zoom):
+	px0, py1 = lonlat_to_pixels(bbox[0], bbox[1], zoom)
+	px1, py0 = lonlat_to_pixels(bbox[2], bbox[3], zoom)
+	return int(px0 // TILE_SIZE), int(py0 // TILE_SIZE), int(px1 // TILE_SIZE), int(py1 // TILE_SIZE)
+
+def palette_rgba(ccols_cmap):
+	return np.array([[int(round(c * 255)) for c in col[:3]] + [255] for col in ccols_cmap], dtype='uint8')
+
+# Canvas whose data coordinates are pixels, with (0, 0) at the top left
+def make_canvas(width, height):
+	fig = Figure(figsize=(width / 100., height / 100.), dpi=100)
+	fig.patch.set_alpha(0)
+	canvas = FigureCanvasAgg(fig)
+	ax = fig.add_axes([0, 0, 1, 1])
+	ax.set_xlim(0, width)
+	ax.set_ylim(height, 0)
+	ax.axis('off')
+	return fig, canvas, ax
+
+def canvas_to_array(canvas, width, height):
+	canvas.draw()
+	return np.asarray(canvas.buffer_rgba())[:height, :width].copy()
+
+class TileLayer:
+	'''Tile-aligned image extent for one zoom level, and the lon/lat of each pixel center.'''
+	def __init__(self, bbox, zoom):
+		self.zoom = zoom
+		self.tx0, self.ty0, tx1, ty1 = tile_range(bbox, zoom)
+		self.ntx, self.nty = tx1 - self.tx0 + 1, ty1 - self.ty0 + 1
+		self.width, self.height = self.ntx * TILE_SIZE, self.nty * TILE_SIZE
+
+	def pixel_centers_lonlat(self):
+		px = self.tx0 * TILE_SIZE + np.arange(self.width) + 0.5
+		py = self.ty0 * TILE_SIZE + np.arange(self.height) + 0.5
+		lon, _ = pixels_to_lonlat(px, np.zeros_like(px), self.zoom)
+		_, lat = pixels_to_lonlat(np.zeros_like(py), py, self.zoom)
+		return np.meshgrid(lon, lat)
+
+	# Convert lon/lat to pixel coordinates within this layer's image
+	def to_image_pixels(self, lon, lat):
+		px, py = lonlat_to_pixels(lon, lat, self.zoom)
+		return px - self.tx0 * TILE_SIZE, py - self.ty0 * TILE_SIZE
+
+	def rasterize_polygons(self, polygons):
+		'''Boolean mask of the pixels inside any of the shapely polygons.'''
+		fig, canvas, ax = make_canvas(self.width, self.height)
+		paths = []
+		for polygon in getattr(polygons, 'geoms', [polygons]):
+			rings = [polygon.exterior] + list(polygon.interiors)
+			vertices = []
+			codes = []
+			for ring in rings:
+				lon, lat = np.asarray(ring.coords).T
+				px, py = self.to_image_pixels(lon, lat)
+				vertices.append(np.column_stack([px, py]))
+				codes += [Path.MOVETO] + [Path.LINETO] * (len(lon) - 2) + [Path.CLOSEPOLY]
+			paths.append(Path(np.concatenate(vertices), codes))
+		ax.add_collection(PathCollection(paths, facecolors='black', edgecolors='none', antialiased=False))
+		return canvas_to_array(canvas, self.width, self.height)[:,:,3] > 0
+
+class GridTiler:
+	'''Samples a classified layer on the NWM land grid (nearest cell) into tile images.
+		The pixel -> grid cell lookup and the area mask are computed once per zoom and reused for every layer.
+	'''
+	def __init__(self, x, y, proj4, bbox, zooms, mask_polygons=None):
+		transformer = pyproj.Transformer.from_proj(pyproj.Proj(proj='latlong', datum='WGS84'), pyproj.Proj(proj4))
+		x = np.asarray(x)
+		y = np.asarray(y)
+		self.layers = {}
+		for zoom in zooms:
+			layer = TileLayer(bbox, zoom)
+			lon, lat = layer.pixel_centers_lonlat()
+			gx, gy = transformer.transform(lon, lat)
+			ix = np.rint((gx - x[0]) / (x[1] - x[0])).astype('int64')
+			iy = np.rint((gy - y[0]) / (y[1] - y[0])).astype('int64')
+			valid = (ix >= 0) & (ix < len(x)) & (iy >= 0) & (iy < len(y))
+			if mask_polygons is not None: valid &= layer.rasterize_polygons(mask_polygons)
+			self.layers[zoom] = (layer, np.where(valid, iy, 0), np.where(valid, ix, 0), valid)
+
+	def render(self, classes, palette):
+		'''classes : 2D (y, x) uint8 array of class indices, 255 for no data'''
+		images = {}
+		for zoom, (layer, iy, ix, valid) in self.layers.items():
+			sampled = np.where(valid, classes[iy, ix], 255)
+			images[zoom] = (layer, classes_to_rgba(sampled, palette))
+		return images
+
+class LineTiler:
+	'''Draws flowlines colored by class into tile images. Line coordinates are converted to pixels once per zoom.'''
+	def __init__(self, lines, bbox, zooms):
+		# lines : shapely LineStrings/MultiLineStrings, in the order of the classes passed to render
+		parts = []
+		owners = []
+		for idx, line in enumerate(lines):
+			for part in getattr(line, 'geoms', [line]):
+				parts.append(np.asarray(part.coords)[:,:2])
+				owners.append(idx)
+		self.owners = np.array(owners, dtype='int64')
+		self.layers = {}
+		for zoom in zooms:
+			layer = TileLayer(bbox, zoom)
+			segments = []
+			for coords in parts:
+				px, py = layer.to_image_pixels(coords[:,0], coords[:,1])
+				segments.append(np.column_stack([px, py]))
+			self.layers[zoom] = (layer, segments)
+
+	def render(self, classes, palette, linewidth=1.0):
+		'''classes : 1D uint8 array of class indices per line, 255 for no data'''
+		part_classes = classes[self.owners]
+		images = {}
+		for zoom, (layer, segments) in self.layers.items():
+			fig, canvas, ax = make_canvas(layer.width, layer.height)
+			drawn = np.flatnonzero(part_classes != 255)
+			colors = palette[part_classes[drawn]] / 255.
+			ax.add_collection(LineCollection([segments[i] for i in drawn], colors=colors, linewidths=linewidth, antialiased=False))
+			rgba = canvas_to_array(canvas, layer.width, layer.height)
+			# Snap any partially covered pixels to fully opaque or fully transparent
+			rgba[:,:,3] = np.where(rgba[:,:,3] >= 128, 255, 0)
+			images[zoom] = (layer, rgba)
+		return images
+
+def classes_to_rgba(classes, palette):
+	rgba = np.zeros(classes.shape + (4,), dtype='uint8')
+	has_data = classes != 255
+	rgba[has_data] = palette[classes[has_data]]
+	return rgba
+
+# Tiles only hold palette colors and fully transparent pixels, so they are stored as 8-bit palette images
+def encode_tile(tile, palette):
+	buffer = io.BytesIO()
+	save_palette_png(tile, buffer, palette[:,:3])
+	return buffer.getvalue()
+
+def write_mbtiles(path, images, name, bbox, palette):
+	'''Write {zoom: (TileLayer, rgba image)} to an MBTiles archive, replacing any existing file.
+		palette is the (ncolors, 4) array the images were colored with (see palette_rgba).
+		Returns counts of tiles referenced, unique tiles stored and empty tiles skipped.
+	'''
+	tmp_path = f'{path}.tmp'
+	if os.path.exists(tmp_path): os.remove(tmp_path)
+	db = sqlite3.connect(tmp_path)
+	db.executescript('''
+		CREATE TABLE metadata (name TEXT, value TEXT);
+		CREATE TABLE map (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_id TEXT);
+		CREATE TABLE images (tile_data BLOB, tile_id TEXT);
+		CREATE UNIQUE INDEX map_index ON map (zoom_level, tile_column, tile_row);
+		CREATE UNIQUE INDEX images_id ON images (tile_id);
+		CREATE VIEW tiles AS
+			SELECT map.zoom_level AS zoom_level, map.tile_column AS tile_column, map.tile_row AS tile_row, images.tile_data AS tile_data
+			FROM map JOIN images ON images.tile_id = map.tile_id;
+	''')
+	counts = {'tiles': 0, 'unique': 0, 'empty': 0}
+	stored_ids = set()
+	for zoom, (layer, rgba) in sorted(images.items()):
+		for row in range(layer.nty):
+			for col in range(layer.ntx):
+				tile = rgba[row*TILE_SIZE:(row+1)*TILE_SIZE, col*TILE_SIZE:(col+1)*TILE_SIZE]
+				if not tile[:,:,3].any():
+					counts['empty'] += 1
+					continue
+				data = encode_tile(tile, palette)
+				tile_id = hashlib.sha1(data).hexdigest()
+				if tile_id not in stored_ids:
+					db.execute('INSERT INTO images (tile_data, tile_id) VALUES (?, ?)', (sqlite3.Binary(data), tile_id))
+					stored_ids.add(tile_id)
+				# MBTiles rows are numbered from the bottom (TMS)
+				tms_row = 2**zoom - 1 - (layer.ty0 + row)
+				db.execute('INSERT INTO map VALUES (?, ?, ?, ?)', (zoom, layer.tx0 + col, tms_row, tile_id))
+				counts['tiles'] += 1
+	counts['unique'] = len(stored_ids)
+
+	zooms = sorted(images.keys())
+	metadata = {
+		'name': name,
+		'format': 'png',
+		'type': 'overlay',
+		'bounds': ','.join([str(v) for v in bbox]),
+		'center': f'{(bbox[0] + bbox[2]) / 2.},{(bbox[1] + bbox[3]) / 2.},{zooms[0]}',
+		'minzoom': str(zooms[0]),
+		'maxzoom': str(zooms[-1])
+	}
+	db.executemany('INSERT INTO metadata VALUES (?, ?)', metadata.items())
+	db.commit()
+	db.close()
+	os.replace(tmp_path, path)
+	return counts
@@ -1,15 +1,38 @@
 import os
+import re
 import traceback
+import hashlib
 import datetime
 import pyproj
 import requests
 import numpy as np
 from netCDF4 import Dataset
+from PIL import Image
 
 import boto3
 from botocore import UNSIGNED
 from botocore.config import Config
 
+### running totals of data moved to and from remote storage during this process
+transfer_stats = {'downloads': 0, 'download_bytes': 0, 'uploads': 0, 'upload_bytes': 0}
+
+### function to add a file transfer to transfer_stats
+def record_transfer(direction, nbytes):
+	'''Record a completed transfer.
+		direction : 'download' or 'upload'
+		nbytes : size of the transferred file in bytes
+	'''
+	transfer_stats[f'{direction}s'] += 1
+	transfer_stats[f'{direction}_bytes'] += nbytes
+
+### function to get the MD5 hex digest of a file, read in chunks to limit memory use
+def file_md5(path):
+	md5 = hashlib.md5()
+	with open(path, 'rb') as f:
+		for chunk in iter(lambda: f.read(1024 * 1024), b''):
+			md5.update(chunk)
+	return md5.hexdigest()
+
 ### function to log any errors that occur
 def log_errors(error, output_dir, filename):
 	with open(os.path.join(output_dir, filename),'a') as f:
@@ -24,44 +47,79 @@ def find_idx_of_nearest_value(array, value):
 	idx = (np.abs(array - value)).argmin()
 	return idx
 
+### function to get the name of a domain's subset of an NWM file (retrospective when lookback is None)
+def get_subset_file_name(prefix, ftype, day, hour, lookback=None):
+	if lookback == None:
+		return f'{prefix}_{day}{hour}00.{ftype}_DOMAIN1'
+	return f'{prefix}_{day}_nwm.t{hour}z.analysis_assim.{ftype}.tm{lookback}.conus.nc'
+
+SUBSET_FILE_PATTERN = re.compile(r'^[^_]+_(\d{8})')
+
+### function to get the date (YYYYMMDD) of a subset NWM file from its name, whatever its domain prefix.
+### Returns None for names that are not subset files (e.g. a stray file in the data directory).
+def get_subset_file_date(fname):
+	match = SUBSET_FILE_PATTERN.match(fname)
+	return match.group(1) if match else None
+
 ### function of check for existence of files for specific date
-def check_file_exists(ftype, day, hour, destdir, lookback=None):
+def check_file_exists(prefix, ftype, day, hour, destdir, lookback=None):
 	'''Check if file exists in directory.
+		prefix : domain prefix of the subset file (config.domain_prefix)
 		ftype : options include LDASOUT,CHRTOUT,GWOUT
 		day  : string date in format YYYYMMDD
 		hour : hour to get file for as string HH
 		destdir : directory to write data to
 	'''
-	if lookback == None:
-		fname = f'NEUS_{day}{hour}00.{ftype}_DOMAIN1'
-	else:
-		fname = f'NEUS_{day}_nwm.t{hour}z.analysis_assim.{ftype}.tm{lookback}.conus.nc'
-
+	fname = get_subset_file_name(prefix, ftype, day, hour, lookback)
 	savedFiles = os.listdir(destdir)
 	return fname in savedFiles
 
+### function to get the NOMADS URL of an operational NWM file
+def get_oper_url(nomads_url, ftype, day, hour='12', lookback='00'):
+	return f'{nomads_url}/nwm.{day}/analysis_assim/nwm.t{hour}z.analysis_assim.{ftype}.tm{lookback}.conus.nc'
+
 ### function to download NWM model output
-def download_nwm(ftype, day, hour='12', lookback=None, destdir='./'):
+def download_nwm(ftype, day, hour='12', lookback=None, destdir='./', retro_bucket='noaa-nwm-retrospective-3-0-pds', retro_endpoint_url=None, nomads_url='https://nomads.ncep.noaa.gov/pub/data/nccf/com/nwm/prod'):
 	'''Download NWM file.
 		ftype : options include LDASOUT, CHRTOUT (for retrospective data) or channel_rt, land (for operational data)
 		day  : string date in format YYYYMMDD
 		hour : hour to get file for as string HH
 		lookback : typically '00'
 		destdir : directory to write data to
+		retro_bucket : S3 bucket holding the retrospective output
+		retro_endpoint_url : S3 endpoint for retro_bucket, None for AWS
+		nomads_url : base URL of the operational output
 	'''
 	if lookback == None:
 		yr = day[:4]
 		fname = f'{day}{hour}00.{ftype}_DOMAIN1'
-		s3 = boto3.client('s3', config=Config(signature_version=UNSIGNED))
-		s3.download_file(Bucket='noaa-nwm-retrospective-3-0-pds', Key=f'CONUS/netcdf/{ftype}/{yr}/{fname}', Filename=os.path.join(destdir, fname))
+		s3 = boto3.client('s3', endpoint_url=retro_endpoint_url, config=Config(signature_version=UNSIGNED))
+		s3.download_file(Bucket=retro_bucket, Key=f'CONUS/netcdf/{ftype}/{yr}/{fname}', Filename=os.path.join(destdir, fname))
 	else:
 		fname = f'nwm.t{hour}z.analysis_assim.{ftype}.tm{lookback}.conus.nc'
-		url = f'https://nomads.ncep.noaa.gov/pub/data/nccf/com/nwm/prod/nwm.{day}/analysis_assim/{fname}'
-		r = requests.get(url)
-		with open(os.path.join(destdir, fname), 'wb') as f:
-			f.write(r.content)
+		download_file(get_oper_url(nomads_url, ftype, day, hour, lookback), os.path.join(destdir, fname))
+	record_transfer('download', os.path.getsize(os.path.join(destdir, fname)))
 	return fname
 
+### function to stream a URL to disk, so large files are never held in memory
+def download_file(url, path, chunk_size=1024 * 1024):
+	'''Download url to path.
+		Fails on error responses (e.g. a file that is not published yet) instead of saving the error page as the file.
+		The file is written under a temporary name and only moved to path once complete. The partial file of a
+		download that fails (e.g. a timeout or reset connection) is removed, as it can be large and outside any workspace.
+	'''
+	part_path = f'{path}.part'
+	try:
+		with requests.get(url, stream=True, timeout=60, allow_redirects=True) as r:
+			r.raise_for_status()
+			with open(part_path, 'wb') as f:
+				for chunk in r.iter_content(chunk_size=chunk_size):
+					f.write(chunk)
+	except BaseException:
+		if os.path.exists(part_path): os.remove(part_path)
+		raise
+	os.replace(part_path, path)
+
 ### function to remove NWM file
 def remove_nwm(ftype, day=None, hour='12', lookback=None, locdir='./'):
 	'''Remove NWM file.
@@ -76,36 +134,158 @@ def remove_nwm(ftype, day=None, hour='12', lookback=None, locdir='./'):
 		fname = f'nwm.t{hour}z.analysis_assim.{ftype}.tm{lookback}.conus.nc'
 	if os.path.exists(os.path.join(locdir, fname)): os.remove(os.path.join(locdir, fname))
 
+### function to read the variable of interest from a retro or oper file. When with_meta is set, the coordinate
+### information needed for mapping is returned as well (proj4 string and x/y or feature ids).
+### cache is an optional dict-like object (e.g. batch.SlidingWindowCache) used to reuse reads across calls.
+def read_product_file(path, varname, cache=None, with_meta=False):
+	if cache is not None and path in cache: return cache[path]
+
+	ncfile = Dataset(path,'r')
+	meta = {}
+	if with_meta: meta['proj4'] = ncfile.getncattr('proj4')
+	if varname=='SOIL_M':
+		data = ncfile.variables[varname][0,:,:,:]
+		if with_meta:
+			# Get x and y coords
+			meta['x'] = ncfile.variables['x'][:]
+			meta['y'] = ncfile.variables['y'][:]
+	elif varname=='streamflow':
+		data = ncfile.variables[varname][:]
+		if with_meta:
+			# Remove features that do not exist in v3 data
+			meta['feature_ids'] = np.array(ncfile.variables['feature_id'])
+	ncfile.close()
+
+	# Only the raw values are used once the days of a period are stacked together
+	result = (np.ma.getdata(data), meta)
+	if cache is not None: cache[path] = result
+	return result
+
+### function to convert percentiles (0-100) to class indices of a product's clevs_cmap.
+### Values in [clevs[i], clevs[i+1]) are class i, and masked or NaN values are 255.
+def classify_percentiles(percentiles, clevs):
+	values = np.ma.filled(np.ma.masked_invalid(percentiles), np.nan)
+	classes = np.digitize(values, clevs[1:-1]).astype('uint8')
+	classes[np.isnan(values)] = 255
+	return classes
+
+### function to convert percentiles (0-100) to whole-number uint8 values, with 255 for masked or NaN values.
+### Values are rounded down, which keeps each one in the same clevs_cmap class since the class edges are whole numbers.
+def percentiles_to_uint8(percentiles):
+	values = np.ma.filled(np.ma.masked_invalid(percentiles), np.nan)
+	result = np.full(values.shape, 255, dtype='uint8')
+	has_data = ~np.isnan(values)
+	result[has_data] = np.clip(np.floor(values[has_data]), 0, 100)
+	return result
+
+### function to build the palette used for 8-bit map images: the product colors, their blends with white and
+### black (for line and fill edges), and a gray ramp (for text and outlines). Returns a (ncolors, 3) uint8 array.
+def build_map_palette(ccols_cmap, nblend=3, ngray=16):
+	colors = np.array([col[:3] for col in ccols_cmap], dtype='float64')
+	entries = [colors]
+	for frac in np.arange(1, nblend + 1) / (nblend + 1.):
+		entries.append(colors * (1. - frac) + frac)
+		entries.append(colors * (1. - frac))
+	entries.append(np.repeat(np.linspace(0., 1., ngray)[:, None], 3, axis=1))
+	return np.rint(np.concatenate(entries) * 255).astype('uint8')
+
+### function to write an RGBA image array as an 8-bit palette PNG. Each pixel takes the nearest palette color,
+### and pixels that are more than half transparent are written as fully transparent.
+def save_palette_png(rgba, path, palette):
+	palette = np.asarray(palette, dtype='uint8')
+	transparent_idx = len(palette)
+
+	# Rendered maps hold few distinct colors, so the nearest palette entry is found once per distinct color
+	rgb = rgba[:,:,:3].astype('int32')
+	packed = (rgb[:,:,0] << 16) | (rgb[:,:,1] << 8) | rgb[:,:,2]
+	colors, inverse = np.unique(packed, return_inverse=True)
+	colors = np.stack([colors >> 16, (colors >> 8) & 255, colors & 255], axis=1)
+	distances = ((colors[:,None,:] - palette[None,:,:].astype('int32'))**2).sum(axis=2)
+	indexed = distances.argmin(axis=1).astype('uint8')[inverse].reshape(packed.shape)
+
+	transparent = rgba[:,:,3] < 128
+	save_args = {'optimize': True}
+	if transparent.any():
+		indexed[transparent] = transparent_idx
+		save_args['transparency'] = transparent_idx
+	image = Image.fromarray(indexed, 'P')
+	image.putpalette(np.concatenate([palette, np.zeros((1, 3), dtype='uint8')]).ravel().tolist())
+	image.save(path, format='PNG', **save_args)
+
 def increment_date(curr_date):
   dt_date = datetime.datetime.strptime(curr_date,'%Y%m%d')
   dt_next = dt_date + datetime.timedelta(days=1)
   return dt_next.strftime('%Y%m%d')
 
-def subset_soil_m_data(in_file, in_dir, out_file, out_dir, ll_lon, ll_lat, ur_lon, ur_lat):
-	ncfile = Dataset(os.path.join(in_dir, in_file),'r')
-	proj4_string = ncfile.getncattr('proj4')
-	x = ncfile.variables['x'][:]
-	y = ncfile.variables['y'][:]
-	ncfile.close()
-
+### function to find the grid indices (sw_x, ne_x, sw_y, ne_y) of the SW and NE corners of a lon/lat box
+def get_grid_window(x, y, proj4_string, ll_lon, ll_lat, ur_lon, ur_lat):
 	### define a transformer
 	p1 = pyproj.Proj(proj4_string)
 	p2 = pyproj.Proj(proj='latlong', datum='WGS84')
 	transformer = pyproj.Transformer.from_proj(p2, p1)
 
-	### SW corner of NEUS grid
+	### SW corner of domain grid
 	fx,fy = transformer.transform(ll_lon,ll_lat)
-	### Find indices of x,y arrays for SW corner of NEUS
+	### Find indices of x,y arrays for SW corner of domain
 	sw_x_idx = find_idx_of_nearest_value(x,fx)
 	sw_y_idx = find_idx_of_nearest_value(y,fy)
 
-	### NE corner of NEUS grid
+	### NE corner of domain grid
 	fx,fy = transformer.transform(ur_lon,ur_lat)
-	### Find indices of x,y arrays for NE corner of NEUS
+	### Find indices of x,y arrays for NE corner of domain
 	ne_x_idx = find_idx_of_nearest_value(x,fx)
 	ne_y_idx = find_idx_of_nearest_value(y,fy)
+	return sw_x_idx, ne_x_idx, sw_y_idx, ne_y_idx
+
+def subset_soil_m_data(in_file, in_dir, out_file, out_dir, ll_lon, ll_lat, ur_lon, ur_lat):
+	subset_soil_m_domains(in_file, in_dir, [(os.path.join(out_dir, out_file), [ll_lon, ll_lat, ur_lon, ur_lat])])
+
+### function to subset SOIL_M of an LDASOUT or land file for several domains, reading the CONUS file once
+def subset_soil_m_domains(in_file, in_dir, subsets):
+	'''subsets : list of (output path, [ll_lon, ll_lat, ur_lon, ur_lat]), one for each domain
+		With several domains, the grid window covering all of them is cut from the CONUS file first,
+		and each domain's window is then cut from that smaller file.
+	'''
+	ncfile = Dataset(os.path.join(in_dir, in_file),'r')
+	proj4_string = ncfile.getncattr('proj4')
+	x = ncfile.variables['x'][:]
+	y = ncfile.variables['y'][:]
+	ncfile.close()
+	windows = [get_grid_window(x, y, proj4_string, *bbox) for _, bbox in subsets]
+
+	### subset file (variables, domain region)
+	if len(subsets) == 1:
+		sw_x_idx, ne_x_idx, sw_y_idx, ne_y_idx = windows[0]
+		subset_region = f'-d x,{str(sw_x_idx)},{str(ne_x_idx)} -d y,{str(sw_y_idx)},{str(ne_y_idx)}'
+		crop_command = f'ncks {subset_region} -v SOIL_M {os.path.join(in_dir, in_file)} -O {subsets[0][0]}'
+		os.system(crop_command)
+		return
+
+	### window covering every domain, then each domain's window relative to it
+	union_x_idx = min([w[0] for w in windows])
+	union_y_idx = min([w[2] for w in windows])
+	union_path = os.path.join(in_dir, f'UNION_{in_file}')
+	subset_region = f'-d x,{str(union_x_idx)},{str(max([w[1] for w in windows]))} -d y,{str(union_y_idx)},{str(max([w[3] for w in windows]))}'
+	os.system(f'ncks {subset_region} -v SOIL_M {os.path.join(in_dir, in_file)} -O {union_path}')
+	for (out_path, _), (sw_x_idx, ne_x_idx, sw_y_idx, ne_y_idx) in zip(subsets, windows):
+		subset_region = f'-d x,{str(sw_x_idx - union_x_idx)},{str(ne_x_idx - union_x_idx)} -d y,{str(sw_y_idx - union_y_idx)},{str(ne_y_idx - union_y_idx)}'
+		os.system(f'ncks {subset_region} -v SOIL_M {union_path} -O {out_path}')
+	os.remove(union_path)
+
+### function to subset streamflow of a CHRTOUT file to the reaches in each domain's box, reading the CONUS file once
+def subset_streamflow_domains(in_file, in_dir, subsets):
+	'''subsets : list of (output path, [ll_lon, ll_lat, ur_lon, ur_lat]), one for each domain
+		With several domains, the reaches in the box covering all of them are cut from the CONUS file first,
+		and each domain's reaches are then cut from that smaller file.
+	'''
+	source_path = os.path.join(in_dir, in_file)
+	if len(subsets) > 1:
+		union_bbox = [min([b[0] for _, b in subsets]), min([b[1] for _, b in subsets]), max([b[2] for _, b in subsets]), max([b[3] for _, b in subsets])]
+		source_path = os.path.join(in_dir, f'UNION_{in_file}')
+		os.system(f'ncks -X {str(union_bbox[0])},{str(union_bbox[2])},{str(union_bbox[1])},{str(union_bbox[3])} -v streamflow {os.path.join(in_dir, in_file)} -O {source_path}')
 
-	### subset file (variables, NEUS region)
-	subset_region = f'-d x,{str(sw_x_idx)},{str(ne_x_idx)} -d y,{str(sw_y_idx)},{str(ne_y_idx)}'
-	crop_command = f'ncks {subset_region} -v SOIL_M {os.path.join(in_dir, in_file)} -O {os.path.join(out_dir, out_file)}'
-	os.system(crop_command)
\ No newline at end of file
+	for out_path, bbox in subsets:
+		subset_region = f'-X {str(bbox[0])},{str(bbox[2])},{str(bbox[1])},{str(bbox[3])}'
+		crop_command = f'ncks {subset_region} -v streamflow {source_path} -O {out_path}'
+		os.system(crop_command)
+	if len(subsets) > 1: os.remove(source_path)
@@ -0,0 +1,149 @@
+'''
+	Zonal drought statistics: the share of each zone (state, and optionally county) in each percentile class.
+
+	For SOIL_M the share is by area: every grid cell is weighted by its area on the ground. For streamflow it is by
+	reach length: every drawn flowline is weighted by its geodesic length and assigned to the zone containing its midpoint.
+
+	Which zone each grid cell and flowline falls in only depends on the grid, the flowlines and the zone shapes, so it
+	is worked out once and cached in config.zonal_cache_dir. Each day's statistics then take one np.bincount call
+	per map (product layer and lookback).
+
+	Results are written next to the maps as zonal-<varname>.csv, with one row per zone layer, zone, lookback and
+	product layer. The class columns are fractions of the zone's area (km2) or reach length (km) that has data.
+'''
+import os
+import csv
+import hashlib
+import numpy as np
+import pyproj
+import fiona
+import shapely
+from shapely.geometry import shape
+from shapely.ops import unary_union
+
+from .flowlines import get_flowline_artifact_path
+
+# Key for cached zone assignments, changing whenever any of the inputs they were built from changes
+def get_cache_key(*parts):
+	key = hashlib.sha1()
+	for part in parts:
+		if isinstance(part, np.ndarray):
+			key.update(np.ascontiguousarray(part).tobytes())
+		else:
+			key.update(repr(part).encode())
+	return key.hexdigest()[:16]
+
+def get_file_signature(path):
+	stat = os.stat(path)
+	return (os.path.basename(path), stat.st_size, stat.st_mtime_ns)
+
+# Zone names and shapes of a zone layer (see config.zonal_layers). Features sharing a name are merged into one zone.
+def load_zones(config, layer):
+	features = {}
+	with fiona.open(os.path.join(config.us_shp_dir, layer['shapefile']), 'r') as shp:
+		for feat in shp:
+			name = str(feat['properties'][layer['name_field']])
+			if layer.get('include') is not None and name not in layer['include']: continue
+			features.setdefault(name, []).append(shape(feat['geometry']))
+	names = sorted(features.keys())
+	geoms = [unary_union(features[name]) for name in names]
+	for geom in geoms: shapely.prepare(geom)
+	return names, geoms
+
+# Index of the zone containing each lon/lat point, -1 for points outside every zone
+def locate_in_zones(geoms, lon, lat):
+	zones = np.full(lon.shape, -1, dtype='int32')
+	for zone, geom in enumerate(geoms):
+		xmin, ymin, xmax, ymax = geom.bounds
+		candidates = np.flatnonzero((lon >= xmin) & (lon <= xmax) & (lat >= ymin) & (lat <= ymax) & (zones < 0))
+		inside = shapely.contains_xy(geom, lon[candidates], lat[candidates])
+		zones[candidates[inside]] = zone
+	return zones
+
+def get_grid_zones(config, layer, x, y, proj4):
+	'''Zones of the SOIL_M grid cells for a zone layer, cached.
+		Returns zone names, and for the cells inside a zone: their flat index in the (y, x) grid, their zone
+		and their area in km2 (the LCC grid is conformal, not equal area, so cell areas vary a little).
+	'''
+	x = np.asarray(x, dtype='float64')
+	y = np.asarray(y, dtype='float64')
+	key = get_cache_key(x, y, proj4, get_file_signature(os.path.join(config.us_shp_dir, layer['shapefile'])), layer['name_field'], layer.get('include'))
+	cache_path = os.path.join(config.zonal_cache_dir, f'grid_{layer["name"]}_{key}.npz')
+	if os.path.exists(cache_path):
+		with np.load(cache_path) as cached:
+			return list(cached['names']), cached['cells'], cached['zones'], cached['weights']
+
+	names, geoms = load_zones(config, layer)
+	x_mesh, y_mesh = np.meshgrid(x, y)
+	transformer = pyproj.Transformer.from_proj(pyproj.Proj(proj4), pyproj.Proj(proj='latlong', datum='WGS84'))
+	lon, lat = transformer.transform(x_mesh.ravel(), y_mesh.ravel())
+	zones = locate_in_zones(geoms, lon, lat)
+	cells = np.flatnonzero(zones >= 0)
+	areal_scale = pyproj.Proj(proj4).get_factors(lon[cells], lat[cells]).areal_scale
+	weights = abs((x[1] - x[0]) * (y[1] - y[0])) / 1e6 / areal_scale
+	save_cache(cache_path, names=np.array(names), cells=cells, zones=zones[cells], weights=weights)
+	return names, cells, zones[cells], weights
+
+def get_reach_zones(config, layer, comids, lines):
+	'''Zones of the drawn flowlines for a zone layer, cached.
+		comids and lines are the flowline COMIDs and shapes from load_basemap. Returns zone names, and for the
+		flowlines inside a zone: their position in the flowlines, their zone and their length in km.
+	'''
+	comids = np.asarray(comids, dtype='int64')
+	key = get_cache_key(comids, get_file_signature(get_flowline_artifact_path(config)), get_file_signature(os.path.join(config.us_shp_dir, layer['shapefile'])), layer['name_field'], layer.get('include'))
+	cache_path = os.path.join(config.zonal_cache_dir, f'reaches_{layer["name"]}_{key}.npz')
+	if os.path.exists(cache_path):
+		with np.load(cache_path) as cached:
+			return list(cached['names']), cached['lines'], cached['zones'], cached['weights']
+
+	names, geoms = load_zones(config, layer)
+	midpoints = shapely.line_interpolate_point(lines, 0.5, normalized=True)
+	zones = locate_in_zones(geoms, shapely.get_x(midpoints), shapely.get_y(midpoints))
+	inside = np.flatnonzero(zones >= 0)
+	geod = pyproj.Geod(ellps='WGS84')
+	weights = np.array([geod.geometry_length(lines[i]) / 1000. for i in inside])
+	save_cache(cache_path, names=np.array(names), lines=inside, zones=zones[inside], weights=weights)
+	return names, inside, zones[inside], weights
+
+def save_cache(path, **arrays):
+	tmp_path = f'{path}.{os.getpid()}.tmp.npz'
+	np.savez(tmp_path, **arrays)
+	os.replace(tmp_path, path)
+
+def zonal_class_totals(zones, classes, weights, nzones, nclasses):
+	'''Weight of each zone in each class, as a (nzones, nclasses + 1) array whose last column is no data.
+		zones, classes and weights are aligned 1D arrays (classes as from utils.classify_percentiles, 255 for no data).
+	'''
+	bins = np.where(classes == 255, nclasses, classes).astype('int64')
+	return np.bincount(zones.astype('int64') * (nclasses + 1) + bins, weights=weights, minlength=nzones * (nclasses + 1)).reshape(nzones, nclasses + 1)
+
+def get_csv_header(clevs_cmap, units):
+	class_columns = [f'{clevs_cmap[i]}-{clevs_cmap[i+1]}' for i in range(len(clevs_cmap) - 1)]
+	return ['zone_layer', 'zone', 'days', 'layer', f'total_{units}', f'no_data_{units}'] + class_columns
+
+# One CSV row per zone, with the class columns as fractions of the zone's total with data
+def get_csv_rows(layer_name, names, totals, per, varidx):
+	rows = []
+	for name, zone_totals in zip(names, totals):
+		with_data = zone_totals[:-1].sum()
+		fractions = zone_totals[:-1] / with_data if with_data > 0 else np.full(len(zone_totals) - 1, np.nan)
+		rows.append([layer_name, name, per, varidx, round(with_data, 2), round(zone_totals[-1], 2)] + [round(f, 4) for f in fractions])
+	return rows
+
+def write_zonal_csv(path, header, rows):
+	tmp_path = f'{path}.tmp'
+	with open(tmp_path, 'w', newline='') as f:
+		writer = csv.writer(f)
+		writer.writerow(header)
+		writer.writerows(rows)
+	os.replace(tmp_path, path)
+
+# Zone layers from config.zonal_layers whose shapefiles are present. The county layer is optional and may be missing.
+def get_zone_layers(config):
+	layers = []
+	for layer in config.zonal_layers:
+		if os.path.exists(os.path.join(config.us_shp_dir, layer['shapefile'])):
+			layers.append(layer)
+		else:
+			print(f'zonal statistics: skipping {layer["name"]} layer, {layer["shapefile"]} not found in {config.us_shp_dir}')
+	return layers
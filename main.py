@@ -3,102 +3,207 @@
     and operational data, then creates maps using the data. Lastly, moves the new maps to where they need to be.
   
   usage:
-		python main.py <YYYYMMDD>
+		python main.py <YYYYMMDD> [--profile] [--tiles]
+		python main.py <YYYYMMDD> --prepare
+		python main.py <YYYYMMDD_start> <YYYYMMDD_end> [--workers=N] [--tiles]
   
   YYYYMMDD : str : OPTIONAL, date of interest (defaults to today's date if not provided)
+  --profile : OPTIONAL, write cProfile and tracemalloc reports for each stage to config.profile_dir
+  --tiles : OPTIONAL, also write each map as an MBTiles web map tile pyramid (see lib/tiles.py)
+  --prepare : OPTIONAL, only build the retrospective climatologies of the date ahead of its run (see lib/prepare.py).
+    This also happens for the next day after every publish.
+
+  Given two dates, products are (re)created for every date in the range, inclusive, using N worker processes
+  (default 1). Existing maps are kept; delete a date's output directory to regenerate it. Range runs do not
+  publish to S3 or prune old output directories.
+
+  Data is fetched once for all domains in config.domains, then maps are made for each domain (see lib/domains.py).
   
   Other configuration available in config.py
 '''
 
 import datetime
+import time
 import sys
 import os
+import csv
 import shutil
 import gzip
+import numpy as np
 from zoneinfo import ZoneInfo
 
 import config
 
 from lib.get_shapefiles import get_shapefiles
 from lib.get_nwm_retro import get_nwm_retro
-from lib.get_nwm_oper import get_nwm_oper
-from lib.create_nwm_nedews_products import create_products
+from lib.get_nwm_oper import get_nwm_oper, restore_nwm_oper
+from lib.create_nwm_nedews_products import create_products, check_product_status
 from lib.s3_bucket import send_to_s3
 from lib.utils import log_errors
+from lib.profiling import StageProfiler
+from lib.prepare import prepare_climatologies, count_prepared
+from lib.batch import run_batch
+from lib.percentile_artifacts import write_published_marker
+from lib.coordination import lease, get_workspace, other_runs_active
+from lib.domains import get_domain_configs
 
 # Ensure that the defined directories exists
 def setup(config):
   for dir in [
     config.temp_dir,
+    config.lock_dir,
     config.retro_data_dir,
     config.oper_data_dir,
-    config.output_dir,
-    config.us_shp_dir,
-    config.nhdplus_dir
+    config.us_shp_dir
   ]:
     if not os.path.exists(dir): os.mkdir(dir)
-  
-  # Ensure precalculated streamflow_id file is extracted
-  streamflow_extracted_file_path = os.path.join(config.writable_dir, 'streamflow_ids.npy')
-  if not os.path.exists(streamflow_extracted_file_path):
-    streamflow_zip_file_path = os.path.join(config.lib_dir, 'streamflow_ids.npy.gz')
-    with gzip.open(streamflow_zip_file_path,"rb") as f_in, open(streamflow_extracted_file_path,"wb") as f_out:
-      shutil.copyfileobj(f_in, f_out)
+
+  # Each domain has its own output and cache directories (see lib/domains.py)
+  for dconfig in get_domain_configs(config):
+    for dir in [
+      dconfig.output_dir,
+      dconfig.rolling_state_dir,
+      dconfig.zonal_cache_dir,
+      dconfig.prepared_dir,
+      dconfig.nhdplus_dir
+    ]:
+      if not os.path.exists(dir): os.makedirs(dir)
+
+    # Ensure precalculated streamflow_id file is extracted
+    if not os.path.exists(dconfig.reach_ids_path):
+      streamflow_zip_file_path = os.path.join(config.lib_dir, dconfig.reach_ids_file)
+      with gzip.open(streamflow_zip_file_path,"rb") as f_in, open(dconfig.reach_ids_path,"wb") as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    # Reaches are looked up in the list with np.searchsorted (see lib/percentile_artifacts.py), so a domain's own
+    #   reach_ids_file that is not in ascending order is sorted once here
+    reach_ids = np.load(dconfig.reach_ids_path)
+    if np.any(np.diff(reach_ids) <= 0):
+      np.save(dconfig.reach_ids_path, np.unique(reach_ids))
+
+# Separate option flags (e.g. --profile) from positional arguments
+def get_options(args):
+  flags = [arg for arg in args if arg.startswith('--')]
+  positional = [arg for arg in args if not arg.startswith('--')]
+  return positional, flags
+
+# Get the value of a --name=value flag
+def get_flag_value(flags, name, default=None):
+  for flag in flags:
+    if flag.startswith(f'--{name}='):
+      return flag.split('=', 1)[1]
+  return default
+
+# Analyses for dates before Mar 15 will only include retro output for 1979.
+def get_retro_start_year(YYYYMMDD):
+  if YYYYMMDD[-4:]<'0315' or YYYYMMDD[-4:]>='1230':
+    return '1980'
+  else:
+    return '1979'
 
 # Determine if user provided a target date or if default should be used
 def get_date(args):
-  # Strip known irrelevant args out
-  dates = [arg for arg in args if arg not in ['python', 'main.py']]
+  # args are the positional arguments as in sys.argv, so the first is the script, under whatever path it was run as
+  dates = args[1:]
 
   # Assign date of interest (YYYYMMDD, defaults to current day).
   if len(dates)==1:
     # provided day from command line argument
-    YYYYMMDD = args[1] if (type(args[1]) is str) else str(args[1])
+    YYYYMMDD = str(dates[0])
   else:
     # current day, accounting for server being in GMT while files/cron trigger being in ExT
     YYYYMMDD = datetime.datetime.now(ZoneInfo('US/Eastern')).strftime('%Y%m%d')
 
-  # Analyses for dates before Mar 15 will only include retro output for 1979.
-  if YYYYMMDD[-4:]<'0315' or YYYYMMDD[-4:]>='1230':
-    retro_start_year = '1980'
-  else:
-    retro_start_year = '1979'
-      
-  return YYYYMMDD, retro_start_year
+  return YYYYMMDD, get_retro_start_year(YYYYMMDD)
 
-def main():
-  # Ensure proper file structure
-  setup(config)
+# Print the time from the start of the run to its maps being published, and add it to config.critical_path_log
+#   prepared is (climatologies prepared ahead of the run, total), as from count_prepared
+def report_critical_path(config, YYYYMMDD, run_started, timings, prepared):
+  elapsed = time.time() - run_started
+  stages = '; '.join([f'{name}={seconds:.1f}' for name, seconds in timings.items()])
+  print(f'critical path for {config.domain} {YYYYMMDD}: {elapsed:.1f} s, {prepared[0]} of {prepared[1]} climatologies prepared ({stages})')
+  new_log = not os.path.exists(config.critical_path_log)
+  with open(config.critical_path_log, 'a', newline='') as f:
+    writer = csv.writer(f)
+    if new_log: writer.writerow(['date', 'run_started', 'critical_path_s', 'prepared', 'total', 'stage_s'])
+    started = datetime.datetime.fromtimestamp(run_started).strftime('%Y-%m-%d %H:%M:%S')
+    writer.writerow([YYYYMMDD, started, round(elapsed, 1), prepared[0], prepared[1], stages])
 
-  # Get target date and start year
-  YYYYMMDD, retro_start_year = get_date(sys.argv)  
+# Build the next day's climatologies while nothing is waiting on them. Failures only cost the next run time.
+def prepare_next_day(config, YYYYMMDD):
+  next_YYYYMMDD = (datetime.datetime.strptime(YYYYMMDD, '%Y%m%d') + datetime.timedelta(days=1)).strftime('%Y%m%d')
+  try:
+    with lease(config, 'prepare', f'{config.domain_prefix}-{next_YYYYMMDD}'):
+      built, skipped = prepare_climatologies(config, next_YYYYMMDD, get_retro_start_year(next_YYYYMMDD))
+    print(f'prepared {built} {config.domain} climatologies for {next_YYYYMMDD}' + (f', skipped {skipped} whose retro files are not downloaded yet' if skipped else ''))
+  except Exception as e:
+    log_errors(e, config.writable_dir, 'error_logs.txt')
+    print(f'WARNING: could not prepare climatologies for {next_YYYYMMDD}: {e}')
 
-  # Ensure shapefiles are available
-  get_shapefiles(config)
+# Create products for every date from start to end. Data needed for the whole range is fetched once up front.
+def run_date_range(start_YYYYMMDD, end_YYYYMMDD, workers):
+  dt_start = datetime.datetime.strptime(start_YYYYMMDD, '%Y%m%d')
+  dt_end = datetime.datetime.strptime(end_YYYYMMDD, '%Y%m%d')
+  span = (dt_end - dt_start).days
+  if span < 0:
+    sys.exit('ERROR: end date is before start date')
+  # The retro window is selected by month and day, so it cannot wrap around a full year
+  if span + config.numdays_in_period > 366:
+    sys.exit(f'ERROR: date range must be at most {366 - config.numdays_in_period} days')
+
+  dates = [(dt_start + datetime.timedelta(days=i)).strftime('%Y%m%d') for i in range(span + 1)]
+  retro_start_years = {YYYYMMDD: get_retro_start_year(YYYYMMDD) for YYYYMMDD in dates}
+  domain_configs = get_domain_configs(config)
+
+  for dconfig in domain_configs:
+    with lease(dconfig, 'shapefiles', dconfig.flowline_region):
+      get_shapefiles(dconfig)
 
-  # Get necessary retrospective and operational data
-  get_nwm_retro(config, YYYYMMDD, retro_start_year)
-  get_nwm_oper(config, YYYYMMDD)
+  # One retro window covering every date in the range. Files of the daily window are kept, so the next daily run
+  #   does not download them again. The range's files are rotated out by that run.
+  get_nwm_retro(config, end_YYYYMMDD, min(retro_start_years.values()), numdays=config.numdays_in_period + span, rotate=False)
 
-  # Create maps from the new data
+  # Operational files for the range and its longest lookback are restored from the R2 archive
+  max_lookback = max([max(p['summary_lengths']) for dconfig in domain_configs for p in dconfig.products])
+  oper_dates = [(dt_start + datetime.timedelta(days=i)).strftime('%Y%m%d') for i in range(-(max_lookback - 1), span + 1)]
+  missing_dates = restore_nwm_oper(config, oper_dates)
+  if missing_dates:
+    print('WARNING: no operational files found for', ', '.join(missing_dates))
+
+  for dconfig in domain_configs:
+    results = run_batch(dconfig, dates, retro_start_years, workers)
+    for YYYYMMDD, statuses in results.items():
+      print(dconfig.domain, YYYYMMDD, ', '.join([f'{varname}: {status}' for varname, status in statuses.items()]))
+
+# Create, publish and prune the maps of one domain, once its data is in place
+#   stage_suffix tells the profiler stages of different domains apart
+def run_domain(config, YYYYMMDD, retro_start_year, profiler, run_started, prepared, stage_suffix=''):
+  # Create maps from the new data. A run that finds another making the same product waits for it. Maps that
+  #   already exist were made and published by an earlier run, so there is nothing left to do for the domain.
   for dataset_type_dict in config.products:
-    create_products(config, YYYYMMDD, retro_start_year, dataset_type_dict)
-  
-  ######################
-  # NOTE: if the products were created on a previous run then the code below will not execute!!!
-  #    create_products function has a sys.exit() statement to stop execution if the products already exist
-  ######################
+    varname = dataset_type_dict['varname']
+    with profiler.stage(f'create_products_{varname}{stage_suffix}'), lease(config, 'products', f'{config.domain_prefix}-{YYYYMMDD}-{varname}'):
+      if check_product_status(config, YYYYMMDD, varname)[1]: return
+      create_products(config, YYYYMMDD, retro_start_year, dataset_type_dict)
 
   # Move new maps to S3 bucket if the correct number of files exist, otherwise clear the
   #   output directory so that the next run can try again
   numExpectedImageProducts = sum([len(config.regions.keys())*len(p['summary_lengths'])*p['varlen'] for p in config.products])
   new_output_dir = os.path.join(config.output_dir, f'{YYYYMMDD}_method1')
-  new_dir_len = len(os.listdir(new_output_dir))
-  if new_dir_len == numExpectedImageProducts:
-    send_to_s3(new_output_dir)
-  else:
-    shutil.rmtree(new_output_dir)
-  
+  with lease(config, 'publish', f'{config.domain_prefix}-{YYYYMMDD}'):
+    new_dir_len = len([f for f in os.listdir(new_output_dir) if f.endswith('.png')])
+    if new_dir_len == numExpectedImageProducts:
+      with profiler.stage(f'send_to_s3{stage_suffix}'):
+        stats = send_to_s3(new_output_dir, endpoint_url=config.s3_endpoint_url, subprefix=config.s3_subprefix, extensions=config.publish_extensions, keep_runs=config.publish_keep_runs, legacy_keys=config.publish_legacy_keys)
+      # The query service (lib/query_service.py) only serves dates with this marker
+      write_published_marker(new_output_dir, stats)
+      report_critical_path(config, YYYYMMDD, run_started, profiler.timings, prepared)
+      with profiler.stage(f'prepare_next_day{stage_suffix}'):
+        prepare_next_day(config, YYYYMMDD)
+    else:
+      shutil.rmtree(new_output_dir)
+
+  # Output directories other runs may be writing to are left for a later run to prune
+  if other_runs_active(config): return
   # Keep three days of output files, delete oldest if there are more
   output_dirs_to_keep = []
   for i in range(3):
@@ -109,6 +214,59 @@ def main():
     if product_dir not in output_dirs_to_keep:
       shutil.rmtree(os.path.join(config.output_dir, product_dir))
 
+def main():
+  run_started = time.time()
+
+  # Ensure proper file structure
+  setup(config)
+  # Register this run, so overlapping runs (see lib/coordination.py) leave its files alone
+  get_workspace(config)
+
+  # Get target date and start year
+  args, flags = get_options(sys.argv)
+  if '--tiles' in flags: config.tile_output = True
+  domain_configs = get_domain_configs(config)
+
+  # Two dates given, reprocess the range instead of running the daily pipeline
+  if len(args) == 3:
+    run_date_range(args[1], args[2], int(get_flag_value(flags, 'workers', 1)))
+    return
+
+  YYYYMMDD, retro_start_year = get_date(args)
+
+  # Only prepare the date's climatologies, e.g. for a date whose previous day was not published
+  if '--prepare' in flags:
+    get_nwm_retro(config, YYYYMMDD, retro_start_year)
+    for dconfig in domain_configs:
+      with lease(dconfig, 'prepare', f'{dconfig.domain_prefix}-{YYYYMMDD}'):
+        built, skipped = prepare_climatologies(dconfig, YYYYMMDD, retro_start_year)
+      print(f'prepared {built} {dconfig.domain} climatologies for {YYYYMMDD}' + (f', skipped {skipped} whose retro files are not downloaded yet' if skipped else ''))
+    return
+  prepared = {dconfig.domain: count_prepared(dconfig, YYYYMMDD, retro_start_year) for dconfig in domain_configs}
+
+  # Profiling is off unless requested, in which case each stage writes its reports to a dated directory
+  profile_dir = None
+  if '--profile' in flags:
+    run_time = datetime.datetime.now().strftime('%H%M%S')
+    profile_dir = os.path.join(config.profile_dir, f'{YYYYMMDD}_{run_time}')
+  profiler = StageProfiler(profile_dir)
+
+  # Ensure shapefiles are available
+  for dconfig in domain_configs:
+    with lease(dconfig, 'shapefiles', dconfig.flowline_region):
+      get_shapefiles(dconfig)
+
+  # Get necessary retrospective and operational data. Each CONUS file is read once and subset for every domain.
+  with profiler.stage('get_nwm_retro'):
+    get_nwm_retro(config, YYYYMMDD, retro_start_year)
+  with profiler.stage('get_nwm_oper'):
+    get_nwm_oper(config, YYYYMMDD)
+
+  # Maps are made and published for each domain in turn
+  for dconfig in domain_configs:
+    stage_suffix = f'_{dconfig.domain}' if len(domain_configs) > 1 else ''
+    run_domain(dconfig, YYYYMMDD, retro_start_year, profiler, run_started, prepared[dconfig.domain], stage_suffix)
+
 
 if __name__ == '__main__':
   try:
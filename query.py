@@ -0,0 +1,62 @@
+'''
+	Query the percentiles behind the NEDEWS maps by location or reach, from the command line or over HTTP.
+	Reads the percentile artifacts written by main.py (see lib/percentile_artifacts.py).
+
+  usage:
+		python query.py serve [--domain NAME] [--day-dir DIR] [--host HOST] [--port PORT]
+		python query.py point <lon> <lat> [--domain NAME] [--day-dir DIR]
+		python query.py reach <COMID> [--domain NAME] [--day-dir DIR]
+		python query.py bbox <west> <south> <east> <north> [--domain NAME] [--day-dir DIR]
+
+  --domain : OPTIONAL, the domain in config.domains whose output is queried (see lib/domains.py). Defaults to the first.
+
+  --day-dir : OPTIONAL, an output date directory (e.g. nwm_drought_volume/nwm_drought_indicator_output/20250601_method1).
+			Defaults to the latest published date in the domain's output_dir. When serving without --day-dir, newer dates
+			are loaded as they are published.
+
+  See lib/query_service.py for the HTTP endpoints, and benchmarks/query_load_test.py for load testing.
+'''
+
+import sys
+import json
+import argparse
+
+import config
+from lib.query_service import PercentileIndex, find_latest_day_dir, serve
+from lib.domains import get_domain_configs
+
+def load_index(dconfig, day_dir):
+  if day_dir is None: day_dir = find_latest_day_dir(dconfig.output_dir)
+  if day_dir is None: sys.exit(f'no published percentile artifacts found in {dconfig.output_dir}')
+  return PercentileIndex(day_dir)
+
+def main():
+  parser = argparse.ArgumentParser(description='Query NWM drought percentiles')
+  parser.add_argument('command', choices=['serve', 'point', 'reach', 'bbox'])
+  parser.add_argument('args', nargs='*', type=float)
+  parser.add_argument('--domain', default=next(iter(config.domains)), choices=list(config.domains))
+  parser.add_argument('--day-dir', default=None)
+  parser.add_argument('--host', default=config.query_host)
+  parser.add_argument('--port', type=int, default=config.query_port)
+  args = parser.parse_args()
+
+  expected_args = {'serve': 0, 'point': 2, 'reach': 1, 'bbox': 4}[args.command]
+  if len(args.args) != expected_args:
+    parser.error(f'{args.command} takes {expected_args} arguments')
+
+  dconfig = {d.domain: d for d in get_domain_configs(config)}[args.domain]
+  if args.command == 'serve':
+    serve(dconfig, args.day_dir, args.host, args.port)
+    return
+
+  index = load_index(dconfig, args.day_dir)
+  if args.command == 'point':
+    result = {'lon': args.args[0], 'lat': args.args[1], 'SOIL_M': index.point(*args.args)}
+  elif args.command == 'reach':
+    result = {'comid': int(args.args[0]), 'streamflow': index.reach(int(args.args[0]))}
+  elif args.command == 'bbox':
+    result = index.bbox(*args.args)
+  print(json.dumps({'date': index.date, **result}, indent=2))
+
+if __name__ == '__main__':
+  main()
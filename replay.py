@@ -0,0 +1,190 @@
+'''
+	Replay the full pipeline for a historical date against recorded inputs, without touching NOAA,
+	Cloudflare or AWS. A local HTTP server stands in for NOMADS and a local S3-compatible endpoint stands
+	in for the retrospective bucket, the R2 archive bucket and the output S3 bucket. Reports end-to-end
+	wall time and transfer volume.
+
+  usage:
+		python replay.py <YYYYMMDD> <recording_dir> <volume_dir> [--s3-endpoint URL] [--nomads-delay SECONDS] [--profile]
+
+  YYYYMMDD : str : date to run main.py for
+  recording_dir : str : recorded inputs, laid out as
+			nomads/nwm.<YYYYMMDD>/analysis_assim/nwm.t12z.analysis_assim.{channel_rt,land}.tm00.conus.nc
+			s3/<bucket name>/<key>   (e.g. s3/noaa-nwm-retrospective-3-0-pds/CONUS/netcdf/LDASOUT/2020/...)
+			shapefiles/{us_shapefile,NHDPlus}/...   (copied into the volume so get_shapefiles has nothing to download)
+  volume_dir : str : writable directory used in place of /nwm_drought_volume
+  --s3-endpoint : OPTIONAL, an already running S3-compatible server (e.g. MinIO). When not given, a moto
+			server is started in-process (requires `pip install moto[server]`).
+  --nomads-delay : OPTIONAL, seconds after startup before the NOMADS stand-in starts serving files (404 until then)
+  --profile : OPTIONAL, passed through to main.py
+'''
+
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import argparse
+import traceback
+import datetime
+import threading
+import functools
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+
+import boto3
+
+# Serves a directory like NOMADS does, counting bytes sent. Files are hidden until available_after has passed.
+class NomadsHandler(SimpleHTTPRequestHandler):
+  def __init__(self, *args, stats=None, available_after=0., **kwargs):
+    self.stats = stats
+    self.available_after = available_after
+    super().__init__(*args, **kwargs)
+
+  def send_head(self):
+    if time.time() < self.available_after and os.path.isfile(self.translate_path(self.path)):
+      self.send_error(404, 'File not yet available')
+      return None
+    return super().send_head()
+
+  def copyfile(self, source, outputfile):
+    start = source.tell()
+    super().copyfile(source, outputfile)
+    with self.stats['lock']:
+      self.stats['requests'] += 1
+      self.stats['bytes'] += source.tell() - start
+
+  def log_message(self, format, *args):
+    pass
+
+def get_free_port():
+  with socket.socket() as s:
+    s.bind(('127.0.0.1', 0))
+    return s.getsockname()[1]
+
+def start_nomads_server(nomads_dir, delay=0.):
+  stats = {'lock': threading.Lock(), 'requests': 0, 'bytes': 0}
+  handler = functools.partial(NomadsHandler, directory=nomads_dir, stats=stats, available_after=time.time() + delay)
+  server = ThreadingHTTPServer(('127.0.0.1', get_free_port()), handler)
+  threading.Thread(target=server.serve_forever, daemon=True).start()
+  return server, f'http://127.0.0.1:{server.server_address[1]}', stats
+
+def start_moto_server():
+  try:
+    from moto.server import ThreadedMotoServer
+  except ImportError:
+    sys.exit('moto is not installed. Install moto[server] or pass --s3-endpoint')
+  port = get_free_port()
+  server = ThreadedMotoServer(ip_address='127.0.0.1', port=port, verbose=False)
+  server.start()
+  return server, f'http://127.0.0.1:{port}'
+
+# Create every bucket the pipeline uses and upload recorded objects into them.
+#   Public buckets (the NOAA retrospective bucket) are made anonymously readable, since they are read unsigned.
+def seed_buckets(endpoint_url, s3_recording_dir, bucket_names, public_buckets):
+  s3 = boto3.client('s3', endpoint_url=endpoint_url, region_name='us-east-1')
+  existing = [b['Name'] for b in s3.list_buckets().get('Buckets', [])]
+  recorded = os.listdir(s3_recording_dir) if os.path.exists(s3_recording_dir) else []
+  for bucket in set(bucket_names + recorded):
+    if bucket not in existing: s3.create_bucket(Bucket=bucket)
+  for bucket in public_buckets:
+    s3.put_bucket_policy(Bucket=bucket, Policy=json.dumps({
+      'Version': '2012-10-17',
+      'Statement': [{'Effect': 'Allow', 'Principal': '*', 'Action': ['s3:GetObject'], 'Resource': [f'arn:aws:s3:::{bucket}/*']}]
+    }))
+  for bucket in recorded:
+    bucket_dir = os.path.join(s3_recording_dir, bucket)
+    extra_args = {'ACL': 'public-read'} if bucket in public_buckets else None
+    for dirpath, _, filenames in os.walk(bucket_dir):
+      for f_name in filenames:
+        f_path = os.path.join(dirpath, f_name)
+        s3.upload_file(f_path, bucket, os.path.relpath(f_path, bucket_dir).replace(os.sep, '/'), ExtraArgs=extra_args)
+
+def main():
+  parser = argparse.ArgumentParser(description='Run main.py offline against recorded inputs')
+  parser.add_argument('date')
+  parser.add_argument('recording_dir')
+  parser.add_argument('volume_dir')
+  parser.add_argument('--s3-endpoint', default=None)
+  parser.add_argument('--nomads-delay', type=float, default=0.)
+  parser.add_argument('--profile', action='store_true')
+  args = parser.parse_args()
+
+  recording_dir = os.path.abspath(args.recording_dir)
+  volume_dir = os.path.abspath(args.volume_dir)
+  if not os.path.exists(volume_dir): os.makedirs(volume_dir)
+
+  # Copy recorded shapefiles so get_shapefiles finds them in place
+  shapefile_dir = os.path.join(recording_dir, 'shapefiles')
+  if os.path.exists(shapefile_dir):
+    shutil.copytree(shapefile_dir, volume_dir, dirs_exist_ok=True)
+
+  # Start the stand-ins
+  nomads_server, nomads_url, nomads_stats = start_nomads_server(os.path.join(recording_dir, 'nomads'), args.nomads_delay)
+  moto_server = None
+  if args.s3_endpoint:
+    s3_endpoint = args.s3_endpoint
+  else:
+    moto_server, s3_endpoint = start_moto_server()
+
+  # Point the pipeline at the stand-ins. These must be set before config is imported.
+  env = {
+    'NWM_DROUGHT_VOLUME': volume_dir,
+    'NOMADS_URL': nomads_url,
+    'NWM_RETRO_ENDPOINT_URL': s3_endpoint,
+    'R2_ENDPOINT_URL': s3_endpoint,
+    'S3_ENDPOINT_URL': s3_endpoint,
+    'R2_BUCKET_NAME': os.environ.get('R2_BUCKET_NAME', 'nwm-drought'),
+    'S3_BUCKET_NAME': os.environ.get('S3_BUCKET_NAME', 'nedews.nrcc.cornell.edu'),
+    'S3_PREFIX': os.environ.get('S3_PREFIX', 'NWM_maps'),
+    'CF_ACCOUNT_ID': 'replay',
+    'AWS_DEFAULT_REGION': 'us-east-1'
+  }
+  for key in ['AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY', 'R2_ACCESS_KEY_ID', 'R2_SECRET_ACCESS_KEY']:
+    env[key] = os.environ.get(f'REPLAY_{key}', 'replay')
+  os.environ.update(env)
+
+  import config
+  from lib.utils import transfer_stats
+  seed_buckets(
+    s3_endpoint,
+    os.path.join(recording_dir, 's3'),
+    [config.nwm_retro_bucket, env['R2_BUCKET_NAME'], env['S3_BUCKET_NAME']],
+    [config.nwm_retro_bucket]
+  )
+
+  # Run the pipeline exactly as the scheduled job would
+  import main as pipeline
+  sys.argv = ['main.py', args.date] + (['--profile'] if args.profile else [])
+  status = 'ok'
+  start = time.perf_counter()
+  try:
+    pipeline.main()
+  except SystemExit as e:
+    status = f'exit: {e.code}' if e.code else 'ok'
+  except Exception as e:
+    traceback.print_exc()
+    status = f'error: {e!r}'
+  elapsed = time.perf_counter() - start
+
+  report = {
+    'date': args.date,
+    'status': status,
+    'wall_seconds': round(elapsed, 3),
+    'nomads': {'requests': nomads_stats['requests'], 'bytes': nomads_stats['bytes']},
+    'transfers': dict(transfer_stats),
+    's3_endpoint': s3_endpoint
+  }
+  report_dir = os.path.join(volume_dir, 'replay_reports')
+  if not os.path.exists(report_dir): os.mkdir(report_dir)
+  report_path = os.path.join(report_dir, f'{args.date}_{datetime.datetime.now().strftime("%Y%m%d%H%M%S")}.json')
+  with open(report_path, 'w') as f:
+    json.dump(report, f, indent=2)
+  print(json.dumps(report, indent=2))
+
+  nomads_server.shutdown()
+  if moto_server: moto_server.stop()
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,13 @@
+import os
+import sys
+import tempfile
+
+# Tests import the pipeline modules the way main.py does, from the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# config reads the volume location on import, so a scratch volume is set before any test module imports it
+os.environ['NWM_DROUGHT_VOLUME'] = tempfile.mkdtemp(prefix='nwm_drought_test_')
+
+import config
+from main import setup
+setup(config)
@@ -0,0 +1,60 @@
+import os
+import time
+import multiprocessing
+from types import SimpleNamespace
+
+import pytest
+
+from lib.coordination import lease, get_lease_path
+
+@pytest.fixture
+def lease_config(tmp_path):
+	return SimpleNamespace(lock_dir=str(tmp_path), temp_dir=str(tmp_path), lease_timeout=30)
+
+# Holds the lease for hold seconds, recording when it was held in log
+def hold_lease(config, log, hold, ready=None):
+	with lease(config, 'test', '20200601') as taken:
+		assert taken
+		if ready is not None: ready.set()
+		with open(log, 'a') as f: f.write(f'start {time.time()}\n')
+		time.sleep(hold)
+		with open(log, 'a') as f: f.write(f'end {time.time()}\n')
+
+def test_lease_excludes_other_process(lease_config, tmp_path):
+	log = str(tmp_path / 'log')
+	ctx = multiprocessing.get_context('fork')
+	procs = [ctx.Process(target=hold_lease, args=(lease_config, log, 0.5)) for _ in range(2)]
+	for p in procs: p.start()
+	for p in procs: p.join(30)
+	assert [p.exitcode for p in procs] == [0, 0]
+	with open(log) as f:
+		events = [line.split() for line in f]
+	# The second process only starts once the first has ended
+	assert [e[0] for e in events] == ['start', 'end', 'start', 'end']
+	assert float(events[2][1]) >= float(events[1][1])
+
+def test_lease_times_out(lease_config, tmp_path):
+	ctx = multiprocessing.get_context('fork')
+	ready = ctx.Event()
+	holder = ctx.Process(target=hold_lease, args=(lease_config, str(tmp_path / 'log'), 5, ready))
+	holder.start()
+	try:
+		assert ready.wait(10)
+		lease_config.lease_timeout = 1
+		start = time.time()
+		with pytest.raises(TimeoutError):
+			with lease(lease_config, 'test', '20200601'):
+				pass
+		assert 1 <= time.time() - start < 4
+		with lease(lease_config, 'test', '20200601', wait=False) as taken:
+			assert not taken
+	finally:
+		holder.terminate()
+		holder.join()
+
+def test_release_removes_lease_file(lease_config):
+	path = get_lease_path(lease_config, 'test', '20200601')
+	with lease(lease_config, 'test', '20200601') as taken:
+		assert taken and os.path.exists(path)
+	assert not os.path.exists(path)
+	assert os.listdir(lease_config.lock_dir) == []
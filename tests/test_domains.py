@@ -0,0 +1,22 @@
+import numpy as np
+
+import config
+from main import setup
+from lib.domains import get_domain_configs
+from lib.utils import get_subset_file_name, get_subset_file_date
+
+def test_subset_file_date():
+	assert get_subset_file_date(get_subset_file_name('NEUS', 'CHRTOUT', '20200601', '12')) == '20200601'
+	assert get_subset_file_date(get_subset_file_name('MW', 'land', '20250601', '12', '00')) == '20250601'
+	for fname in ['README', 'notes.txt', 'NEUS_readme', '.nfs0001']:
+		assert get_subset_file_date(fname) is None
+
+def test_setup_sorts_reach_ids():
+	dconfig = get_domain_configs(config)[0]
+	reach_ids = np.load(dconfig.reach_ids_path)
+	try:
+		np.save(dconfig.reach_ids_path, np.concatenate([reach_ids[::-1], reach_ids[:1]]))
+		setup(config)
+		assert np.array_equal(np.load(dconfig.reach_ids_path), reach_ids)
+	finally:
+		np.save(dconfig.reach_ids_path, reach_ids)
@@ -0,0 +1,32 @@
+import os
+
+import config
+import lib.get_nwm_retro
+from lib.get_nwm_retro import get_nwm_retro
+from lib.utils import get_subset_file_name, get_subset_file_date
+
+# Stand-in for the download, writing empty subset files for every domain
+def touch_retro_date(config, domain_configs, thisdate, work_dir):
+	for d in domain_configs:
+		for dstype in ['CHRTOUT', 'LDASOUT']:
+			open(os.path.join(config.retro_data_dir, get_subset_file_name(d.domain_prefix, dstype, thisdate, config.hour)), 'w').close()
+
+def saved_dates():
+	return {get_subset_file_date(f) for f in os.listdir(config.retro_data_dir)}
+
+def test_range_run_keeps_daily_window(monkeypatch):
+	monkeypatch.setattr(lib.get_nwm_retro, 'get_retro_date', touch_retro_date)
+	for f in os.listdir(config.retro_data_dir): os.remove(os.path.join(config.retro_data_dir, f))
+
+	get_nwm_retro(config, '20250601', '2019')
+	daily = saved_dates()
+	assert '20200601' in daily and '20200301' not in daily
+
+	# A range run for an earlier season adds its window without removing the daily one
+	get_nwm_retro(config, '20250315', '2019', numdays=config.numdays_in_period + 14, rotate=False)
+	assert daily < saved_dates() and '20200301' in saved_dates()
+
+	# The next daily run rotates the range's files out, and leaves files that are not subset files alone
+	open(os.path.join(config.retro_data_dir, 'README'), 'w').close()
+	get_nwm_retro(config, '20250601', '2019')
+	assert saved_dates() == daily | {None}
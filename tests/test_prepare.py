@@ -0,0 +1,35 @@
+import os
+import numpy as np
+
+from benchmarks.synthetic_data import make_bench_config, generate
+from lib.create_nwm_nedews_products import get_retro_climatology
+from lib.prepare import prepare_climatologies, load_prepared_climatology, get_prepared_path
+
+YYYYMMDD = '20200815'
+
+def make_config(tmp_path):
+	bench_config = make_bench_config(str(tmp_path))
+	syear = generate(bench_config, YYYYMMDD, nx=20, ny=15, nreaches=200, nyears=3)
+	bench_config.products = [dict(p, summary_lengths=[1, 7]) for p in bench_config.products if p['varname'] == 'streamflow']
+	return bench_config, syear
+
+def test_prepared_climatology_matches_built(tmp_path):
+	bench_config, syear = make_config(tmp_path)
+	assert prepare_climatologies(bench_config, YYYYMMDD, syear) == (2, 0)
+	for per in [1, 7]:
+		expected = np.sort(get_retro_climatology(bench_config, YYYYMMDD, syear, 'streamflow', 'CHRTOUT', per), axis=0)
+		assert np.array_equal(load_prepared_climatology(bench_config, YYYYMMDD, syear, 'streamflow', per), expected)
+
+def test_missing_retro_files_are_skipped(tmp_path):
+	bench_config, syear = make_config(tmp_path)
+	# An earlier first year, as on 0315, whose files are not downloaded
+	assert prepare_climatologies(bench_config, YYYYMMDD, str(int(syear) - 1)) == (0, 2)
+	assert os.listdir(bench_config.prepared_dir) == []
+
+def test_other_dates_are_pruned(tmp_path):
+	bench_config, syear = make_config(tmp_path)
+	prepare_climatologies(bench_config, YYYYMMDD, syear)
+	prepare_climatologies(bench_config, '20200814', syear)
+	assert sorted(os.listdir(bench_config.prepared_dir)) == sorted([
+		os.path.basename(get_prepared_path(bench_config, 'streamflow', '20200814', syear, per)) for per in [1, 7]
+	])
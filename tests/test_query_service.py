@@ -0,0 +1,49 @@
+import json
+import threading
+import http.client
+import pytest
+
+from benchmarks.synthetic_data import make_bench_config
+from benchmarks.query_load_test import write_synthetic_artifacts
+from lib.query_service import PercentileIndex, make_server
+
+@pytest.fixture(scope='module')
+def server(tmp_path_factory):
+	bench_config = make_bench_config(str(tmp_path_factory.mktemp('query')))
+	day_dir = write_synthetic_artifacts(bench_config, 40, 30, 100)
+	server = make_server(PercentileIndex(day_dir), port=0)
+	threading.Thread(target=server.serve_forever, daemon=True).start()
+	yield server
+	server.shutdown()
+
+def request(server, method, path, body=None):
+	conn = http.client.HTTPConnection('127.0.0.1', server.server_address[1], timeout=10)
+	conn.request(method, path, body=None if body is None else body.encode())
+	response = conn.getresponse()
+	status, data = response.status, json.loads(response.read())
+	conn.close()
+	return status, data
+
+def test_point(server):
+	status, data = request(server, 'GET', '/point?lon=-73.2&lat=44.5')
+	assert status == 200 and data['SOIL_M'] is not None
+
+@pytest.mark.parametrize('path', [
+	'/point?lon=inf&lat=44.5',
+	'/point?lon=-73.2&lat=nan',
+	'/point?lon=-infinity&lat=44.5',
+	'/bbox?west=-74&south=nan&east=-73&north=45',
+	'/reach?comid=abc',
+])
+def test_invalid_get_is_400(server, path):
+	status, data = request(server, 'GET', path)
+	assert status == 400 and 'invalid query' in data['error']
+
+@pytest.mark.parametrize('body', [
+	'{"points": [[Infinity, 44.5]]}',
+	'{"points": [[-73.2, NaN]]}',
+	'{"reaches": [Infinity]}',
+])
+def test_invalid_batch_is_400(server, body):
+	status, data = request(server, 'POST', '/batch', body)
+	assert status == 400 and 'invalid query' in data['error']
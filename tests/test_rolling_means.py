@@ -0,0 +1,65 @@
+import os
+import datetime
+import numpy as np
+import pytest
+
+from benchmarks.synthetic_data import make_bench_config, generate
+from lib import rolling_means
+from lib.rolling_means import get_rolling_period_average, load_state, get_oper_file_path
+from lib.create_nwm_nedews_products import get_oper_period_average
+
+YYYYMMDD = '20200815'
+PER = 7
+
+def shifted(days):
+	return (datetime.datetime.strptime(YYYYMMDD, '%Y%m%d') + datetime.timedelta(days=days)).strftime('%Y%m%d')
+
+@pytest.fixture
+def bench_config(tmp_path):
+	# Operational streamflow files cover the longest summary length (28 days), so 7 day windows can shift back 21 days
+	bench_config = make_bench_config(str(tmp_path))
+	generate(bench_config, YYYYMMDD, nx=20, ny=15, nreaches=200, nyears=1)
+	return bench_config
+
+def state_path(bench_config):
+	return os.path.join(bench_config.rolling_state_dir, f'streamflow_{PER}day.npz')
+
+@pytest.fixture
+def build_count(monkeypatch):
+	count = [0]
+	build_state = rolling_means.build_state
+	def counting_build_state(*args):
+		count[0] += 1
+		return build_state(*args)
+	monkeypatch.setattr(rolling_means, 'build_state', counting_build_state)
+	return count
+
+def test_rolled_average_matches_recomputed(bench_config, build_count):
+	for i, day in enumerate([shifted(d) for d in range(-6, 1)]):
+		rolled, rolled_meta = get_rolling_period_average(bench_config, day, 'streamflow', PER)
+		expected, expected_meta = get_oper_period_average(bench_config, day, 'streamflow', PER)
+		assert rolled.dtype == expected.dtype == np.float32
+		assert np.allclose(rolled, expected, rtol=1e-6, atol=1e-6)
+		assert np.array_equal(rolled_meta['feature_ids'], expected_meta['feature_ids'])
+		assert load_state(state_path(bench_config))['updates'] == i
+	# Built once, then only updated
+	assert build_count[0] == 1
+
+def test_gap_rebuilds_state(bench_config, build_count):
+	get_rolling_period_average(bench_config, shifted(-3), 'streamflow', PER)
+	# The state ends two days before the new window, so it cannot be rolled forward
+	rolled, _ = get_rolling_period_average(bench_config, YYYYMMDD, 'streamflow', PER)
+	assert build_count[0] == 2
+	assert load_state(state_path(bench_config))['updates'] == 0
+	expected, _ = get_oper_period_average(bench_config, YYYYMMDD, 'streamflow', PER)
+	assert np.allclose(rolled, expected, rtol=1e-6, atol=1e-6)
+
+def test_changed_file_rebuilds_state(bench_config, build_count):
+	get_rolling_period_average(bench_config, shifted(-1), 'streamflow', PER)
+	# A file that stays in the window is replaced, e.g. by a rerun of its download
+	path = get_oper_file_path(bench_config, shifted(-3), 'streamflow')
+	stat = os.stat(path)
+	os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+	get_rolling_period_average(bench_config, YYYYMMDD, 'streamflow', PER)
+	assert build_count[0] == 2
+	assert load_state(state_path(bench_config))['updates'] == 0
@@ -0,0 +1,77 @@
+import json
+import time
+import pytest
+
+moto = pytest.importorskip('moto')
+import boto3
+import requests
+from moto.server import ThreadedMotoServer
+
+from lib.s3_bucket import send_to_s3, POINTER_NAME
+
+BUCKET = 'nwm-maps-test'
+PREFIX = 'NWM_maps'
+
+@pytest.fixture
+def s3(monkeypatch):
+	server = ThreadedMotoServer(ip_address='127.0.0.1', port=0, verbose=False)
+	server.start()
+	endpoint_url = f'http://127.0.0.1:{server._server.server_port}'
+	# moto keeps buckets between servers in the same process
+	requests.post(f'{endpoint_url}/moto-api/reset')
+	for k, v in {'AWS_ACCESS_KEY_ID': 'test', 'AWS_SECRET_ACCESS_KEY': 'test', 'AWS_DEFAULT_REGION': 'us-east-1', 'S3_BUCKET_NAME': BUCKET, 'S3_PREFIX': PREFIX}.items():
+		monkeypatch.setenv(k, v)
+	client = boto3.client('s3', endpoint_url=endpoint_url)
+	client.create_bucket(Bucket=BUCKET)
+	yield client, endpoint_url
+	server.stop()
+
+def write_day(tmp_path, contents):
+	day_dir = tmp_path / '20250601_method1'
+	day_dir.mkdir(exist_ok=True)
+	for f_name, data in contents.items():
+		(day_dir / f_name).write_bytes(data)
+	return str(day_dir)
+
+def read(client, key):
+	return client.get_object(Bucket=BUCKET, Key=key)['Body'].read()
+
+def test_publish_switches_pointer_and_updates_legacy_keys(s3, tmp_path):
+	client, endpoint_url = s3
+	day_dir = write_day(tmp_path, {'a.png': b'a1', 'b.png': b'b1', 'a.npz': b'n1'})
+	send_to_s3(day_dir, endpoint_url=endpoint_url, extensions=['.png'])
+	first_run = json.loads(read(client, f'{PREFIX}/{POINTER_NAME}'))['run']
+
+	# Run ids have a one second resolution
+	time.sleep(1.1)
+	write_day(tmp_path, {'a.png': b'a2'})
+	stats = send_to_s3(day_dir, endpoint_url=endpoint_url, extensions=['.png'])
+	run = json.loads(read(client, f'{PREFIX}/{POINTER_NAME}'))['run']
+
+	assert run != first_run
+	assert (stats['uploaded_files'], stats['skipped_files'], stats['legacy_copied_files']) == (1, 1, 1)
+	assert read(client, f'{PREFIX}/{run}/a.png') == b'a2'
+	assert read(client, f'{PREFIX}/{run}/b.png') == b'b1'
+	assert read(client, f'{PREFIX}/a.png') == b'a2'
+	assert read(client, f'{PREFIX}/b.png') == b'b1'
+	# Files of other types are not published
+	keys = [obj['Key'] for obj in client.list_objects_v2(Bucket=BUCKET)['Contents']]
+	assert not [key for key in keys if key.endswith('.npz')]
+
+def test_failed_publish_leaves_pointer(s3, tmp_path, monkeypatch):
+	client, endpoint_url = s3
+	day_dir = write_day(tmp_path, {'a.png': b'a1'})
+	send_to_s3(day_dir, endpoint_url=endpoint_url)
+	pointer = read(client, f'{PREFIX}/{POINTER_NAME}')
+
+	time.sleep(1.1)
+	write_day(tmp_path, {'a.png': b'a2'})
+	def fail(*args): raise RuntimeError('upload failed')
+	monkeypatch.setattr('lib.s3_bucket.record_transfer', fail)
+	with pytest.raises(RuntimeError):
+		send_to_s3(day_dir, endpoint_url=endpoint_url)
+
+	assert read(client, f'{PREFIX}/{POINTER_NAME}') == pointer
+	assert read(client, f'{PREFIX}/a.png') == b'a1'
+	runs = {obj['Key'].split('/')[2] for obj in client.list_objects_v2(Bucket=BUCKET, Prefix=f'{PREFIX}/runs/')['Contents']}
+	assert len(runs) == 1
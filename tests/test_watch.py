@@ -0,0 +1,34 @@
+import os
+import sys
+import textwrap
+
+import watch
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def test_watch_runs_main_for_its_date(tmp_path, monkeypatch):
+	# A stub main.py next to a stand-in watch.py, reading its date as main.py does and recording it
+	record = tmp_path / 'main_args.txt'
+	(tmp_path / 'main.py').write_text(textwrap.dedent(f'''
+		import sys
+		sys.path.insert(0, {REPO_DIR!r})
+		from main import get_options, get_date
+		args, flags = get_options(sys.argv)
+		open({str(record)!r}, 'w').write(' '.join([get_date(args)[0]] + flags))
+	'''))
+	monkeypatch.setattr(watch, '__file__', str(tmp_path / 'watch.py'))
+	monkeypatch.setattr(watch, 'setup', lambda config: None)
+	# Maps not made yet, and the files are already there, so nothing is waited for
+	monkeypatch.setattr(watch, 'check_product_status', lambda *args: (True, False))
+	monkeypatch.setattr(watch, 'check_file_exists', lambda *args: True)
+	monkeypatch.setattr(sys, 'argv', [os.path.join(REPO_DIR, 'watch.py'), '20250601', '--timeout=5', '--tiles'])
+
+	assert watch.main() == 0
+	assert record.read_text() == '20250601 --tiles'
+
+def test_watch_skips_dates_already_made(monkeypatch):
+	monkeypatch.setattr(watch, 'setup', lambda config: None)
+	monkeypatch.setattr(watch, 'check_product_status', lambda *args: (True, True))
+	monkeypatch.setattr(watch.subprocess, 'run', lambda *args, **kwargs: (_ for _ in ()).throw(AssertionError('main.py run')))
+	monkeypatch.setattr(sys, 'argv', ['watch.py', '20250601'])
+	assert watch.main() == 0
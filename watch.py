@@ -0,0 +1,63 @@
+'''
+	Wait for the operational files of a date to be published on NOMADS, then run main.py for that date.
+	Used in place of fixed-time retries, so that products are made as soon as the 12Z files appear.
+
+  usage:
+		python watch.py [YYYYMMDD] [--timeout=MINUTES] [--profile] [--tiles]
+
+  YYYYMMDD : str : OPTIONAL, date of interest (defaults to today's date if not provided)
+  --timeout : OPTIONAL, minutes to wait for the files before giving up (defaults to config.availability_timeout)
+  --profile, --tiles : OPTIONAL, passed through to main.py
+
+  Exits without running main.py if the date's maps already exist or the files do not appear before the timeout.
+  See lib/availability.py for how polling is scheduled.
+'''
+
+import os
+import sys
+import time
+import subprocess
+
+import config
+
+from main import setup, get_options, get_flag_value, get_date
+from lib.availability import AvailabilityWatcher, OPER_FTYPES, get_cycle_timestamp
+from lib.create_nwm_nedews_products import check_product_status
+from lib.utils import check_file_exists
+from lib.domains import get_domain_configs
+
+def main():
+  setup(config)
+  args, flags = get_options(sys.argv)
+  # get_date expects the arguments of main.py
+  YYYYMMDD, _ = get_date(['main.py'] + args[1:])
+
+  # Nothing to wait for if today's maps were already made for every domain
+  domain_configs = get_domain_configs(config)
+  if all([check_product_status(d, YYYYMMDD, p['varname'])[1] for d in domain_configs for p in d.products]):
+    print(f'products for {YYYYMMDD} already exist')
+    return 0
+
+  # Files already downloaded by an earlier run do not need to be waited on
+  have_files = all([check_file_exists(d.domain_prefix, ftype, YYYYMMDD, config.hour, config.oper_data_dir, config.lookback) for d in domain_configs for ftype in OPER_FTYPES])
+  if not have_files:
+    timeout = float(get_flag_value(flags, 'timeout', config.availability_timeout / 60.)) * 60.
+    watcher = AvailabilityWatcher(config, YYYYMMDD)
+    start = time.time()
+    if watcher.fast_from > start:
+      print(f'files for {YYYYMMDD} usually appear from {time.strftime("%H:%M:%S", time.localtime(watcher.fast_from + config.availability_lead))}')
+    if not watcher.wait(timeout):
+      print(f'files for {YYYYMMDD} were not available after {(time.time() - start) / 60.:.1f} minutes ({watcher.checks} checks)')
+      return 1
+    cycle_timestamp = get_cycle_timestamp(YYYYMMDD, config.hour)
+    for ftype, seen in watcher.first_seen.items():
+      print(f'{ftype} file found {(seen - cycle_timestamp) / 60.:.1f} minutes after {config.hour}Z')
+    print(f'waited {(time.time() - start) / 60.:.1f} minutes ({watcher.checks} checks)')
+
+  # Run the pipeline in its own process, as it exits early when there is nothing left to do
+  main_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')
+  passed_flags = [flag for flag in flags if not flag.startswith('--timeout')]
+  return subprocess.run([sys.executable, main_path, YYYYMMDD] + passed_flags).returncode
+
+if __name__ == '__main__':
+  sys.exit(main())